@@ -1,16 +1,35 @@
 import telebot
 from telebot import types
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import sqlite3
 from datetime import datetime, timedelta
 import random
 import string
 import os
 import csv
+import io
+import tempfile
 import config
 import photos
 import threading
+import heapq
+import bisect
+import queue
+import time
 import pytz
 import re  # Added for phone validation
+import logging
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, namedtuple
+from types import MappingProxyType
+import json
+import hashlib
+import atexit
+import signal
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 
 # Безопасная загрузка минимального холда
 try:
@@ -30,162 +49,610 @@ def convert_datetime(s):
 
 sqlite3.register_converter("DATETIME", convert_datetime)
 
+tz = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
 bot = telebot.TeleBot(config.BOT_TOKEN)
 
-conn = sqlite3.connect('bot.db', check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
-cursor = conn.cursor()
+DB_PATH = getattr(config, 'DB_PATH', 'bot.db')
+DB_BUSY_TIMEOUT_MS = 30000
+
+# Каждый поток (воркеры telebot, таймеры) держит своё соединение
+_db_local = threading.local()
+
+def get_conn(path=DB_PATH):
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        # isolation_level=None: транзакции открываются только явно через transaction()
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conns[path] = conn
+    return conn
+
+@contextmanager
+def transaction(path=DB_PATH):
+    """Write transaction on the calling thread's connection.
+
+    BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue
+    on busy_timeout instead of failing mid-transaction; WAL readers are never
+    blocked. Nested calls join the outer transaction.
+    """
+    conn = get_conn(path)
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    callbacks = _after_commit()[path] = []
+    try:
+        yield conn.cursor()
+        conn.execute("COMMIT")
+    except BaseException:
+        # COMMIT тоже может упасть (busy, диск) — иначе соединение осталось бы в незавершённой транзакции
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        del _after_commit()[path]
+    for callback in callbacks:
+        callback()
+
+def _after_commit():
+    hooks = getattr(_db_local, 'after_commit', None)
+    if hooks is None:
+        hooks = _db_local.after_commit = {}
+    return hooks
+
+def on_commit(callback, path=DB_PATH):
+    # Выполнить после COMMIT текущей транзакции (или сразу, если транзакции нет)
+    if get_conn(path).in_transaction:
+        _after_commit()[path].append(callback)
+    else:
+        callback()
+
+def execute(sql, params=(), path=DB_PATH):
+    with transaction(path) as cur:
+        cur.execute(sql, params)
+        return cur
+
+def query_one(sql, params=(), path=DB_PATH):
+    return get_conn(path).execute(sql, params).fetchone()
+
+def query_all(sql, params=(), path=DB_PATH):
+    return get_conn(path).execute(sql, params).fetchall()
 
 # Initialize database tables
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY,
-    username TEXT,
-    reputation REAL DEFAULT 10.0,
-    balance REAL DEFAULT 0.0,
-    subscription_type TEXT,
-    subscription_end DATETIME,
-    referral_code TEXT,
-    referrals_count INTEGER DEFAULT 0,
-    profit_level TEXT DEFAULT 'новичок',
-    card_number TEXT,
-    cvv TEXT,
-    card_balance REAL DEFAULT 0.0,
-    card_status TEXT DEFAULT 'inactive',
-    card_password TEXT,
-    card_activation_date DATETIME,
-    phone_number TEXT,
-    last_activity DATETIME,
-    api_token TEXT,
-    block_reason TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS admins (
-    id INTEGER PRIMARY KEY
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS queue (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT UNIQUE,
-    added_time DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS working (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT UNIQUE,
-    start_time DATETIME,
-    admin_id INTEGER,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS successful (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT,
-    hold_time TEXT,
-    acceptance_time DATETIME,
-    flight_time DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS blocked (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS referrals (
-    referer_id INTEGER,
-    referee_id INTEGER,
-    PRIMARY KEY (referer_id, referee_id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS withdraw_requests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    status TEXT DEFAULT 'pending'
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    action TEXT,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS admin_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    admin_id INTEGER,
-    action TEXT,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS status (
-    key TEXT PRIMARY KEY,
-    value TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS card_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    timestamp DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS transfers (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    from_user_id INTEGER,
-    to_user_id INTEGER,
-    amount REAL,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute("INSERT OR IGNORE INTO status (key, value) VALUES ('work_status', 'Full work 🟢')")
-conn.commit()
-
-# Add initial admin
-cursor.execute("INSERT OR IGNORE INTO admins (id) VALUES (?)", (config.ADMIN_IDS[0],))
-conn.commit()
-
-pending_activations = {}  # To store admin_id for pending activations
-pending_timers = {}  # To store timers for cancellation
+def init_db():
+    with transaction() as cur:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            reputation REAL DEFAULT 10.0,
+            balance REAL DEFAULT 0.0,
+            subscription_type TEXT,
+            subscription_end DATETIME,
+            referral_code TEXT,
+            referrals_count INTEGER DEFAULT 0,
+            profit_level TEXT DEFAULT 'новичок',
+            card_number TEXT,
+            cvv TEXT,
+            card_balance REAL DEFAULT 0.0,
+            card_status TEXT DEFAULT 'inactive',
+            card_password TEXT,
+            card_activation_date DATETIME,
+            phone_number TEXT,
+            last_activity DATETIME,
+            api_token TEXT,
+            block_reason TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone_number TEXT UNIQUE,
+            added_time DATETIME,
+            type TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS working (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone_number TEXT UNIQUE,
+            start_time DATETIME,
+            admin_id INTEGER,
+            type TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS successful (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone_number TEXT,
+            hold_time TEXT,
+            acceptance_time DATETIME,
+            flight_time DATETIME,
+            type TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS blocked (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone_number TEXT,
+            type TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            referer_id INTEGER,
+            referee_id INTEGER,
+            PRIMARY KEY (referer_id, referee_id)
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS withdraw_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            status TEXT DEFAULT 'pending'
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS card_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            timestamp DATETIME,
+            type TEXT
+        )
+        ''')
+
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS transfers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_user_id INTEGER,
+            amount REAL,
+            timestamp DATETIME
+        )
+        ''')
+
+def _migrate_referral_penalties(cur):
+    cur.execute("ALTER TABLE referrals ADD COLUMN penalized_at DATETIME")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referee ON referrals(referee_id)")
+    # Уже неактивных рефералов старая проверка успела оштрафовать — помечаем их, чтобы не списать повторно
+    now = datetime.now(tz)
+    cur.execute("""UPDATE referrals SET penalized_at = ?
+                   WHERE referee_id IN (SELECT id FROM users WHERE last_activity < ?)""", (now, now - timedelta(days=config.INACTIVITY_DAYS)))
 
-def is_subscribed(user_id):
-    try:
-        member = bot.get_chat_member(config.CHANNEL, user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except:
-        return False
+def get_price_increase(sub_type):
+    if not sub_type:
+        return config.PRICES['hour'], config.PRICES['30min']
+    sub = config.SUBSCRIPTIONS.get(sub_type, {})
+    return sub.get('price_increase_hour', 0), sub.get('price_increase_30min', 0)
+
+def hold_payout(sub_type, minutes):
+    # Полные часы по часовой цене, остаток — по цене за каждые полные 30 минут
+    hour_price, min30_price = get_price_increase(sub_type)
+    return minutes // 60 * hour_price + minutes % 60 // 30 * min30_price
+
+def _migrate_hold_minutes(cur):
+    # "ЧЧ:ММ" -> целые минуты; выплата фиксируется по текущему тарифу пользователя
+    cur.execute("ALTER TABLE successful ADD COLUMN hold_minutes INTEGER")
+    cur.execute("ALTER TABLE successful ADD COLUMN payout REAL")
+    cur.execute("ALTER TABLE users ADD COLUMN pending_payout REAL DEFAULT 0")
+    rows = cur.execute("""SELECT s.id, s.hold_time, u.subscription_type FROM successful s
+                          LEFT JOIN users u ON u.id = s.user_id WHERE s.hold_time IS NOT NULL AND s.hold_time != ''""").fetchall()
+    for row_id, hold_time, sub_type in rows:
+        hours, mins = map(int, hold_time.split(':'))
+        minutes = hours * 60 + mins
+        cur.execute("UPDATE successful SET hold_minutes = ?, payout = ? WHERE id = ?", (minutes, hold_payout(sub_type, minutes), row_id))
+    cur.execute("""UPDATE users SET pending_payout = p.total
+                   FROM (SELECT user_id, SUM(payout) AS total FROM successful GROUP BY user_id) AS p
+                   WHERE users.id = p.user_id AND p.total IS NOT NULL""")
+
+def _migrate_settings(cur):
+    # Админы, статус ворка и настройки переезжают в одну таблицу settings (значения в JSON)
+    cur.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    # В новой базе старых таблиц нет: значения по умолчанию и первого админа добавит Settings.load()
+    legacy = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('status', 'admins')")}
+    if 'status' in legacy:
+        for key, value in cur.execute("SELECT key, value FROM status").fetchall():
+            cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+    admin_ids = [row[0] for row in cur.execute("SELECT id FROM admins ORDER BY id").fetchall()] if 'admins' in legacy else []
+    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('admins', ?)", (json.dumps(admin_ids),))
+    cur.execute("DROP TABLE IF EXISTS admins")
+    cur.execute("DROP TABLE IF EXISTS status")
+
+# Логи действий живут в отдельной базе, чтобы их запись не конкурировала с балансами
+LOG_DB_PATH = getattr(config, 'LOG_DB_PATH', 'logs.db')
+LOG_RETENTION_MONTHS = getattr(config, 'LOG_RETENTION_MONTHS', 3)
+
+LOG_COLUMNS = {'logs': 'user_id', 'admin_logs': 'admin_id'}
+
+class LogPartitions:
+    """Monthly log tables (logs_2024_05, admin_logs_2024_05, ...) in the log database.
+
+    Ids keep growing across partitions: a new month's AUTOINCREMENT sequence
+    starts where the previous one ended, so (kind, id) stays unique.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._months = {kind: set() for kind in LOG_COLUMNS}
+
+    def load(self):
+        pattern = re.compile(r"(%s)_(\d{4}_\d{2})$" % "|".join(LOG_COLUMNS))
+        months = {kind: set() for kind in LOG_COLUMNS}
+        for (name,) in query_all("SELECT name FROM sqlite_master WHERE type = 'table'", path=self.path):
+            match = pattern.match(name)
+            if match:
+                months[match.group(1)].add(match.group(2))
+        with self._lock:
+            self._months = months
+
+    @staticmethod
+    def month_of(timestamp):
+        if timestamp is None:
+            return datetime.now(tz).strftime('%Y_%m')
+        if isinstance(timestamp, str):
+            return timestamp[:7].replace('-', '_')
+        return timestamp.strftime('%Y_%m')
+
+    def table(self, cur, kind, month):
+        # Вызывается внутри транзакции базы логов; создаёт партицию при первой записи за месяц
+        name = f"{kind}_{month}"
+        with self._lock:
+            if month in self._months[kind]:
+                return name
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY AUTOINCREMENT, {LOG_COLUMNS[kind]} INTEGER, action TEXT, timestamp DATETIME)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_user_time ON {name}({LOG_COLUMNS[kind]}, timestamp)")
+        last_id = max((seq for table, seq in cur.execute("SELECT name, seq FROM sqlite_sequence").fetchall()
+                       if table.startswith(kind + '_') and table[len(kind) + 1:][:1].isdigit()), default=0)
+        if last_id and not cur.execute("SELECT 1 FROM sqlite_sequence WHERE name = ?", (name,)).fetchone():
+            cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (name, last_id))
+        on_commit(lambda: self._add(kind, month), self.path)
+        return name
+
+    def _add(self, kind, month):
+        with self._lock:
+            self._months[kind].add(month)
+
+    def tables(self, kind, since=None, until=None):
+        # Партиции, пересекающиеся с [since, until), в хронологическом порядке
+        with self._lock:
+            months = sorted(self._months[kind])
+        first = self.month_of(since) if since else None
+        last = self.month_of(until - timedelta(microseconds=1)) if until else None
+        return [f"{kind}_{m}" for m in months if (not first or m >= first) and (not last or m <= last)]
+
+    def compact(self, keep_months=LOG_RETENTION_MONTHS):
+        # Партиции старше срока хранения сворачиваются в дневные счётчики по пользователям и удаляются
+        now = datetime.now(tz)
+        index = now.year * 12 + now.month - 1 - keep_months
+        cutoff = f"{index // 12:04d}_{index % 12 + 1:02d}"
+        compacted = []
+        for kind, column in LOG_COLUMNS.items():
+            for table in self.tables(kind):
+                month = table[len(kind) + 1:]
+                if month >= cutoff:
+                    continue
+                with transaction(self.path) as cur:
+                    cur.execute(f"""INSERT INTO log_rollups (kind, day, user_id, actions)
+                                    SELECT ?, substr(timestamp, 1, 10), {column}, COUNT(*) FROM {table} GROUP BY 2, 3
+                                    ON CONFLICT(kind, day, user_id) DO UPDATE SET actions = actions + excluded.actions""", (kind,))
+                    cur.execute(f"DROP TABLE {table}")
+                with self._lock:
+                    self._months[kind].discard(month)
+                compacted.append(table)
+        if compacted:
+            logger.info("compacted log partitions: %s", ", ".join(compacted))
+        return compacted
+
+log_partitions = LogPartitions(LOG_DB_PATH)
+
+def write_logs(cur, kind, rows):
+    # rows: (id или None, user_id, action, timestamp); раскладываются по месячным партициям
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(log_partitions.month_of(row[3]), []).append(row)
+    for month in sorted(by_month):
+        table = log_partitions.table(cur, kind, month)
+        cur.executemany(f"INSERT OR IGNORE INTO {table} (id, {LOG_COLUMNS[kind]}, action, timestamp) VALUES (?, ?, ?, ?)", by_month[month])
+
+def init_log_db():
+    log_partitions.load()
+    with transaction(LOG_DB_PATH) as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS log_rollups (
+            kind TEXT, day TEXT, user_id INTEGER, actions INTEGER,
+            PRIMARY KEY (kind, day, user_id))""")
+        # Несекционированные таблицы logs/admin_logs от прошлой версии раскладываются по месяцам
+        for kind in LOG_COLUMNS:
+            if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (kind,)).fetchone():
+                rows = get_conn(LOG_DB_PATH).execute(f"SELECT * FROM {kind} ORDER BY id")
+                while True:
+                    batch = rows.fetchmany(5000)
+                    if not batch:
+                        break
+                    write_logs(cur, kind, [tuple(r) for r in batch])
+                cur.execute(f"DROP TABLE {kind}")
+
+def _has_table(cur, name):
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _migrate_log_index(cur):
+    # Таблица logs в bot.db есть только у баз, созданных до выноса логов в отдельную базу
+    if _has_table(cur, 'logs'):
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_time ON logs(user_id, timestamp)")
+
+def _migrate_logs_out(cur):
+    # Переносим накопленные логи в базу логов; INSERT OR IGNORE по id делает повтор после сбоя безопасным
+    if os.path.abspath(LOG_DB_PATH) == os.path.abspath(DB_PATH) or not _has_table(cur, 'logs'):
+        return
+    for table in LOG_COLUMNS:
+        rows = cur.execute(f"SELECT * FROM {table} ORDER BY id")
+        while True:
+            batch = rows.fetchmany(5000)
+            if not batch:
+                break
+            with transaction(LOG_DB_PATH) as log_cur:
+                write_logs(log_cur, table, [tuple(r) for r in batch])
+        cur.execute(f"DROP TABLE {table}")
+
+# Нумерованные миграции схемы: (версия, список SQL или функция от курсора).
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (1, ["CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)"]),
+    (2, ["CREATE INDEX IF NOT EXISTS idx_queue_added_time ON queue(added_time)",
+         "CREATE INDEX IF NOT EXISTS idx_queue_user_id ON queue(user_id)"]),
+    (3, ["CREATE INDEX IF NOT EXISTS idx_working_user_id ON working(user_id)"]),
+    (4, ["CREATE INDEX IF NOT EXISTS idx_successful_user_id ON successful(user_id)"]),
+    (5, _migrate_log_index),
+    (6, ["CREATE INDEX IF NOT EXISTS idx_card_history_user_time ON card_history(user_id, timestamp)"]),
+    (7, ["CREATE INDEX IF NOT EXISTS idx_transfers_from ON transfers(from_user_id)",
+         "CREATE INDEX IF NOT EXISTS idx_transfers_to ON transfers(to_user_id)"]),
+    (8, ["CREATE INDEX IF NOT EXISTS idx_withdraw_requests_status ON withdraw_requests(status)"]),
+    (9, ["CREATE TABLE IF NOT EXISTS subscription_tiers (name TEXT PRIMARY KEY, priority INTEGER NOT NULL DEFAULT 0)",
+         "INSERT OR IGNORE INTO subscription_tiers (name, priority) VALUES ('VIP Nexus', 4), ('Prime Plus', 3), ('Gold Tier', 2), ('Elite Access', 1)"]),
+    (10, _migrate_settings),
+    (11, ["""CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            payload TEXT,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_message_id INTEGER,
+            created_at DATETIME,
+            finished_at DATETIME
+        )""",
+          """CREATE TABLE IF NOT EXISTS broadcast_targets (
+            job_id INTEGER,
+            chat_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            sent_at DATETIME,
+            PRIMARY KEY (job_id, chat_id)
+        )""",
+          "CREATE INDEX IF NOT EXISTS idx_broadcast_targets_status ON broadcast_targets(job_id, status, chat_id)"]),
+    (12, ["""CREATE TABLE IF NOT EXISTS pending_activations (
+            phone_number TEXT PRIMARY KEY,
+            user_id INTEGER,
+            admin_id INTEGER,
+            type TEXT,
+            message_id INTEGER,
+            deadline REAL
+        )"""]),
+    (13, _migrate_referral_penalties),
+    (14, _migrate_hold_minutes),
+    (15, _migrate_logs_out),
+    (16, ["ALTER TABLE transfers ADD COLUMN out_history_id INTEGER",
+          "ALTER TABLE transfers ADD COLUMN in_history_id INTEGER"]),
+    (17, ["ALTER TABLE card_history ADD COLUMN transfer_id INTEGER REFERENCES transfers(id)",
+          "UPDATE card_history SET transfer_id = (SELECT t.id FROM transfers t WHERE t.out_history_id = card_history.id OR t.in_history_id = card_history.id)",
+          # Старые переводы без ссылок: по участнику, сумме и времени с точностью до секунды (записи писались с разницей в доли секунды)
+          """UPDATE card_history SET transfer_id = (SELECT t.id FROM transfers t WHERE t.from_user_id = card_history.user_id
+                                                    AND t.amount = -card_history.amount
+                                                    AND ABS(julianday(t.timestamp) - julianday(card_history.timestamp)) < 1.0 / 86400)
+             WHERE type = 'transfer_out' AND transfer_id IS NULL""",
+          """UPDATE card_history SET transfer_id = (SELECT t.id FROM transfers t WHERE t.to_user_id = card_history.user_id
+                                                    AND t.amount = card_history.amount
+                                                    AND ABS(julianday(t.timestamp) - julianday(card_history.timestamp)) < 1.0 / 86400)
+             WHERE type = 'transfer_in' AND transfer_id IS NULL""",
+          "CREATE INDEX IF NOT EXISTS idx_card_history_user_id ON card_history(user_id, id)"]),
+    (18, ["""CREATE TABLE IF NOT EXISTS media_cache (
+            name TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at DATETIME
+        )"""]),
+    (19, ["""CREATE TABLE IF NOT EXISTS conversations (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+          "CREATE INDEX IF NOT EXISTS idx_conversations_expires_at ON conversations(expires_at)"]),
+]
+
+def run_migrations(path=DB_PATH):
+    execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at DATETIME)", path=path)
+    current = query_one("SELECT COALESCE(MAX(version), 0) FROM schema_version", path=path)[0]
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        # Каждая миграция применяется вместе с записью версии в одной транзакции
+        with transaction(path) as cur:
+            if callable(migration):
+                migration(cur)
+            else:
+                for statement in migration:
+                    cur.execute(statement)
+            cur.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, datetime.now(tz)))
+
+init_db()
+init_log_db()
+run_migrations()
+
+SETTINGS_DEFAULTS = {
+    'work_status': 'Full work 🟢',
+    'min_hold_minutes': MIN_HOLD_MINUTES,
+    'referral_reward': config.REFERRAL_REWARD,
+}
+
+SettingsSnapshot = namedtuple('SettingsSnapshot', ['version', 'values', 'admins'])
+
+class Settings:
+    """Admins, work status and runtime tunables persisted in the settings table.
+
+    Readers take the current immutable snapshot without locking; writers
+    persist the change and publish a new snapshot with a bumped version.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = SettingsSnapshot(0, MappingProxyType({}), frozenset())
+
+    def load(self):
+        with self._lock, transaction() as cur:
+            for key, value in SETTINGS_DEFAULTS.items():
+                cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+            values = {row[0]: json.loads(row[1]) for row in cur.execute("SELECT key, value FROM settings").fetchall()}
+            # Первый админ из конфига возвращается при каждом запуске, как и раньше
+            if config.ADMIN_IDS[0] not in values['admins']:
+                values['admins'] = values['admins'] + [config.ADMIN_IDS[0]]
+                cur.execute("UPDATE settings SET value = ? WHERE key = 'admins'", (json.dumps(values['admins']),))
+            self._publish(values)
+
+    def _publish(self, values):
+        self._snapshot = SettingsSnapshot(self._snapshot.version + 1, MappingProxyType(values), frozenset(values['admins']))
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def get(self, key, default=None):
+        return self._snapshot.values.get(key, default)
+
+    def is_admin(self, user_id):
+        return user_id in self._snapshot.admins
+
+    def set(self, key, value):
+        with self._lock:
+            self._write(key, value)
+
+    def update(self, key, fn):
+        # Чтение-изменение-запись под одной блокировкой, чтобы параллельные правки не терялись
+        with self._lock:
+            self._write(key, fn(self._snapshot.values.get(key)))
+
+    def _write(self, key, value):
+        execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        values = dict(self._snapshot.values)
+        values[key] = value
+        self._publish(values)
+
+    def add_admin(self, user_id):
+        self.update('admins', lambda admins: admins if user_id in admins else admins + [user_id])
+
+    def remove_admin(self, user_id):
+        self.update('admins', lambda admins: [a for a in admins if a != user_id])
+
+settings = Settings()
+settings.load()
+
+class Scheduler:
+    """One thread running timed callbacks from a heap.
+
+    Entries are cancelled lazily: cancel() drops the key from the index and
+    marks the heap entry, which is skipped when it reaches the top. Deadlines
+    are wall-clock timestamps so they can be persisted and re-armed after a
+    restart. Callbacks run on the scheduler thread and must stay short;
+    anything slow should hand off to its own worker.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def at(self, deadline, callback, *args, key=None):
+        with self._cond:
+            if key is not None:
+                self._cancel(key)
+            self._seq += 1
+            entry = [deadline, self._seq, key, callback, args, False]
+            heapq.heappush(self._heap, entry)
+            if key is not None:
+                self._entries[key] = entry
+            self._cond.notify()
+        return entry
+
+    def after(self, delay, callback, *args, key=None):
+        return self.at(time.time() + delay, callback, *args, key=key)
+
+    def every(self, interval, callback, first=None, key=None):
+        key = key or ('every', callback.__name__)
+        def tick():
+            self.after(interval, tick, key=key)
+            callback()
+        return self.after(interval if first is None else first, tick, key=key)
+
+    def _cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            entry[5] = True
+        return entry is not None
+
+    def cancel(self, key):
+        with self._cond:
+            return self._cancel(key)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                entry = heapq.heappop(self._heap)
+                _, _, key, callback, args, cancelled = entry
+                if cancelled:
+                    continue
+                if key is not None and self._entries.get(key) is entry:
+                    del self._entries[key]
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("scheduled job %s failed", getattr(callback, '__name__', callback))
+
+scheduler = Scheduler()
 
 def generate_referral_code(user_id):
     return f"ref_{user_id}"
@@ -205,80 +672,322 @@ def get_profit_level(referrals, is_admin=False):
         return 'VIP WORK'
 
 def is_admin(user_id):
-    cursor.execute("SELECT * FROM admins WHERE id = ?", (user_id,))
-    return cursor.fetchone() is not None
+    return settings.is_admin(user_id)
+
+class AuditLog:
+    """Append-only action log written in batches by a background thread.
+
+    Callers only enqueue; the writer flushes with executemany into the log
+    database once BATCH rows are buffered or FLUSH_INTERVAL seconds passed.
+    If the buffer stays full for a second the entry is dropped and counted.
+    """
+
+    BATCH = 500
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self._buffer = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, table, row):
+        try:
+            self._buffer.put((table, row), timeout=1)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self, timeout=10):
+        # Дописываем всё, что в буфере, перед выходом процесса; зависший писатель выход не держит
+        deadline = time.monotonic() + timeout
+        try:
+            self._buffer.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning("audit log still full on close, %d entries not written", self._buffer.qsize())
+            return
+        self._thread.join(max(0, deadline - time.monotonic()))
 
-tz = pytz.timezone('Europe/Moscow')
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = self._buffer.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+            if item:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.FLUSH_INTERVAL
+            if batch and (item is None or item is False or len(batch) >= self.BATCH):
+                self._flush(batch)
+                batch, deadline = [], None
+            if item is None:
+                return
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        rows = {}
+        for kind, row in batch:
+            rows.setdefault(kind, []).append((None,) + row)
+        try:
+            with transaction(self.path) as cur:
+                for kind, values in rows.items():
+                    write_logs(cur, kind, values)
+        except Exception:
+            logger.exception("audit log flush of %d rows failed", len(batch))
+            with self._lock:
+                self.failed += len(batch)
+            return
+        elapsed = (time.monotonic() - started) * 1000
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {'depth': self._buffer.qsize(), 'written': self.written, 'dropped': self.dropped, 'failed': self.failed,
+                    'batches': self.batches, 'last_flush_ms': self.last_flush_ms, 'max_flush_ms': self.max_flush_ms}
+
+audit_log = AuditLog(LOG_DB_PATH)
+atexit.register(audit_log.close)
 
 def log_action(user_id, action):
-    cursor.execute("INSERT INTO logs (user_id, action, timestamp) VALUES (?, ?, ?)", (user_id, action, datetime.now(tz)))
-    conn.commit()
+    audit_log.write('logs', (user_id, action, datetime.now(tz)))
 
 def log_admin_action(admin_id, action):
-    cursor.execute("INSERT INTO admin_logs (admin_id, action, timestamp) VALUES (?, ?, ?)", (admin_id, action, datetime.now(tz)))
-    conn.commit()
+    audit_log.write('admin_logs', (admin_id, action, datetime.now(tz)))
+
+USER_CACHE_SIZE = getattr(config, 'USER_CACHE_SIZE', 10000)
+
+class UserCache:
+    """Bounded LRU of user rows keyed by id, plus a username -> id map."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self._ids_by_username = {}
+        # Растёт при каждой инвалидации: чтение из БД, начатое до неё, не попадёт в кэш
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return dict(user)
+
+    def get_id(self, username):
+        with self._lock:
+            user_id = self._ids_by_username.get(username)
+            if user_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return user_id
+
+    def put(self, user, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._users[user['id']] = dict(user)
+            self._users.move_to_end(user['id'])
+            if user['username']:
+                self._ids_by_username[user['username']] = user['id']
+            while len(self._users) > self.maxsize:
+                _, evicted = self._users.popitem(last=False)
+                self._ids_by_username.pop(evicted['username'], None)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            user = self._users.pop(user_id, None)
+            if user:
+                self._ids_by_username.pop(user['username'], None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._users.clear()
+            self._ids_by_username.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._users), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+class TTLCache:
+    """Bounded cache whose entries expire; negative results can live shorter."""
+
+    def __init__(self, maxsize, ttl, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        ttl = self.ttl if value else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+_MISSING = object()
+
+# Подписку кэшируем дольше, отсутствие подписки — недолго: пользователь обычно подписывается сразу
+SUB_CACHE_TTL = getattr(config, 'SUB_CACHE_TTL', 600)
+SUB_CACHE_NEGATIVE_TTL = getattr(config, 'SUB_CACHE_NEGATIVE_TTL', 30)
+membership_cache = TTLCache(USER_CACHE_SIZE, SUB_CACHE_TTL, SUB_CACHE_NEGATIVE_TTL)
+bot_info_cache = TTLCache(1, 3600)
+
+class MembershipCheckFailed(Exception):
+    pass
+
+def _fetch_membership(user_id):
+    try:
+        member = bot.get_chat_member(config.CHANNEL, user_id)
+    except Exception as e:
+        raise MembershipCheckFailed(e)
+    return member.status in ['member', 'administrator', 'creator']
+
+def is_subscribed(user_id):
+    # Ошибки API не кэшируются: при сбое считаем, что подписки нет, и спросим снова в следующий раз
+    try:
+        return membership_cache.get_or_load(user_id, lambda: _fetch_membership(user_id))
+    except MembershipCheckFailed as e:
+        logger.warning("membership check for %s failed: %s", user_id, e)
+        return False
+
+def prewarm_subscriptions(user_ids):
+    # Заполняет кэш подписок пачкой в фоне, с тем же лимитом запросов, что и рассылки
+    def run():
+        for user_id in user_ids:
+            if user_id in membership_cache:
+                continue
+            send_bucket.acquire()
+            try:
+                membership_cache.put(user_id, _fetch_membership(user_id))
+            except MembershipCheckFailed:
+                pass
+    threading.Thread(target=run, daemon=True).start()
+
+def bot_username():
+    return bot_info_cache.get_or_load('me', bot.get_me).username
+
+def invalidate_user(user_id=None):
+    # Сбрасываем сразу и ещё раз после COMMIT, чтобы параллельное чтение не закэшировало старую строку
+    if user_id is None:
+        user_cache.clear()
+        on_commit(user_cache.clear)
+    else:
+        user_cache.invalidate(user_id)
+        on_commit(lambda: user_cache.invalidate(user_id))
 
 def get_user(user_id):
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    if row:
-        columns = [desc[0] for desc in cursor.description]
-        return dict(zip(columns, row))
-    return None
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    row = query_one("SELECT * FROM users WHERE id = ?", (user_id,))
+    if not row:
+        return None
+    user = dict(row)
+    # Внутри транзакции строка может быть ещё не закоммичена — не кэшируем
+    if not get_conn().in_transaction:
+        user_cache.put(user, generation)
+    return user
+
+def find_user_id(username):
+    user_id = user_cache.get_id(username)
+    if user_id is not None:
+        return user_id
+    row = query_one("SELECT id FROM users WHERE username = ?", (username,))
+    if not row:
+        return None
+    get_user(row[0])
+    return row[0]
 
 def update_user(user_id, **kwargs):
     set_clause = ', '.join(f"{k} = ?" for k in kwargs)
     values = list(kwargs.values()) + [user_id]
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
-    conn.commit()
-
-def get_queue():
-    cursor.execute("SELECT * FROM queue ORDER BY added_time ASC")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
-
-def get_user_queue(user_id):
-    cursor.execute("SELECT * FROM queue WHERE user_id = ? ORDER BY added_time ASC", (user_id,))
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
-
-def get_working(user_id=None):
-    if user_id:
-        cursor.execute("SELECT * FROM working WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM working")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+    execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
+    invalidate_user(user_id)
+    if 'reputation' in kwargs or 'subscription_type' in kwargs:
+        on_commit(lambda: number_queue.reprioritize_user(user_id, kwargs))
 
 def get_successful(user_id=None):
     if user_id:
-        cursor.execute("SELECT * FROM successful WHERE user_id = ?", (user_id,))
+        rows = query_all("SELECT * FROM successful WHERE user_id = ?", (user_id,))
     else:
-        cursor.execute("SELECT * FROM successful")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
-
-def get_blocked(user_id=None):
-    if user_id:
-        cursor.execute("SELECT * FROM blocked WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM blocked")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+        rows = query_all("SELECT * FROM successful")
+    return [dict(row) for row in rows]
 
 def get_status(key):
-    cursor.execute("SELECT value FROM status WHERE key = ?", (key,))
-    row = cursor.fetchone()
-    return row[0] if row else None
+    return settings.get(key)
 
 def set_status(key, value):
-    cursor.execute("REPLACE INTO status (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
+    settings.set(key, value)
 
 def generate_card_number():
     return ''.join(random.choices(string.digits, k=16))
@@ -292,36 +1001,737 @@ def generate_api_token():
     return f"{part1}:{part2}"
 
 def calculate_hold(accept_time, flight_time):
-    delta = flight_time - accept_time
-    minutes = delta.total_seconds() / 60
-    if minutes >= MIN_HOLD_MINUTES:
-        hours = int(minutes // 60)
-        mins = int(minutes % 60)
-        return f"{hours:02d}:{mins:02d}"
+    # Холд в целых минутах или None, если он короче минимального
+    minutes = int((flight_time - accept_time).total_seconds() // 60)
+    if minutes >= settings.get('min_hold_minutes'):
+        return minutes
     return None
 
-def get_price_increase(sub_type):
-    if not sub_type:
-        return config.PRICES['hour'], config.PRICES['30min']
-    sub = config.SUBSCRIPTIONS.get(sub_type, {})
-    return sub.get('price_increase_hour', 0), sub.get('price_increase_30min', 0)
+def format_hold(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+QUEUE_PAGE_SIZE = 30
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+# Порядок очереди: приоритет подписки (таблица subscription_tiers), репутация, время добавления
+def get_sorted_queue(limit=QUEUE_PAGE_SIZE, offset=0):
+    rows = query_all('''
+        SELECT q.*, COALESCE(u.reputation, 0) AS reputation, u.subscription_type, COALESCE(t.priority, 0) AS priority
+        FROM queue q
+        LEFT JOIN users u ON u.id = q.user_id
+        LEFT JOIN subscription_tiers t ON t.name = u.subscription_type
+        ORDER BY priority DESC, reputation DESC, q.added_time ASC, q.id ASC
+        LIMIT ? OFFSET ?
+    ''', (limit, offset))
+    return [dict(row) for row in rows]
+
+class NumberQueue:
+    """Process-resident number queue, written through to the queue table.
+
+    Sort keys are kept in a list ordered like get_sorted_queue() with bisect,
+    so a page is a slice from the cursor's position: O(log n + page) instead
+    of a scan of the whole queue. The list changes only after the surrounding
+    transaction commits, so a rollback leaves it matching the table.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []  # отсортированные ключи живых номеров
+        self._entries = {}  # phone -> (key, item)
+        self._items = {}  # key -> item
+        self._by_user = {}  # user_id -> set of phones
+        self._tiers = {}
+
+    def load(self):
+        with self._lock:
+            self._tiers = {row[0]: row[1] for row in query_all("SELECT name, priority FROM subscription_tiers")}
+            items = get_sorted_queue(limit=-1)
+            self._keys = [self._key(item) for item in items]
+            self._items = dict(zip(self._keys, items))
+            self._entries = {item['phone_number']: (key, item) for key, item in self._items.items()}
+            self._by_user = {}
+            for item in items:
+                self._by_user.setdefault(item['user_id'], set()).add(item['phone_number'])
+
+    def _key(self, item):
+        return (-item['priority'], -item['reputation'], item['added_time'], item['id'])
+
+    def _add(self, item):
+        key = self._key(item)
+        bisect.insort(self._keys, key)
+        self._items[key] = item
+        self._entries[item['phone_number']] = (key, item)
+        self._by_user.setdefault(item['user_id'], set()).add(item['phone_number'])
+
+    def _discard(self, phone):
+        key, item = self._entries.pop(phone)
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        del self._items[key]
+        phones = self._by_user.get(item['user_id'])
+        phones.discard(phone)
+        if not phones:
+            del self._by_user[item['user_id']]
+        return item
+
+    def __len__(self):
+        return len(self._entries)
+
+    def user_count(self, user_id):
+        return len(self._by_user.get(user_id, ()))
+
+    def reconcile(self):
+        # Сверка счётчиков в памяти с таблицей queue
+        with self._lock:
+            db_counts = {row[0]: row[1] for row in query_all("SELECT user_id, COUNT(*) FROM queue GROUP BY user_id")}
+            mem_counts = {user_id: len(phones) for user_id, phones in self._by_user.items()}
+            if db_counts != mem_counts:
+                logger.warning("queue counters out of sync: %d in table, %d in memory; reloading",
+                               sum(db_counts.values()), len(self._entries))
+                self.load()
+            return db_counts == mem_counts
+
+    def __contains__(self, phone):
+        return phone in self._entries
+
+    def get(self, phone):
+        entry = self._entries.get(phone)
+        return dict(entry[1]) if entry else None
+
+    def push(self, user_id, phone, number_type, added_time=None):
+        user = get_user(user_id)
+        with self._lock:
+            if phone in self._entries:
+                return None
+            added_time = added_time or datetime.now(tz)
+            try:
+                cur = execute("INSERT INTO queue (user_id, phone_number, added_time, type) VALUES (?, ?, ?, ?)", (user_id, phone, added_time, number_type))
+            except sqlite3.IntegrityError:
+                # Номер уже в таблице, но не в памяти (добавлен другим процессом или ещё не закоммичен)
+                return None
+            item = {'id': cur.lastrowid, 'user_id': user_id, 'phone_number': phone, 'added_time': added_time, 'type': number_type,
+                    'reputation': user['reputation'], 'subscription_type': user['subscription_type'],
+                    'priority': self._tiers.get(user['subscription_type'], 0)}
+        on_commit(lambda: self._add_committed(item))
+        return dict(item)
+
+    def _add_committed(self, item):
+        with self._lock:
+            if item['phone_number'] not in self._entries:
+                self._add(item)
+
+    def remove(self, phone, user_id=None):
+        with self._lock:
+            entry = self._entries.get(phone)
+            if not entry or (user_id is not None and entry[1]['user_id'] != user_id):
+                return None
+            item = dict(entry[1])
+        # Строка в таблице решает, кто удалил номер: второй параллельный remove получит rowcount 0
+        if not execute("DELETE FROM queue WHERE phone_number = ?", (phone,)).rowcount:
+            return None
+        on_commit(lambda: self._discard_committed(phone, item['id']))
+        return item
+
+    def _discard_committed(self, phone, item_id):
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry and entry[1]['id'] == item_id:
+                self._discard(phone)
+
+    def clear(self):
+        execute("DELETE FROM queue")
+        on_commit(self._clear_committed)
+
+    def _clear_committed(self):
+        with self._lock:
+            self._keys = []
+            self._entries = {}
+            self._items = {}
+            self._by_user = {}
+
+    def page(self, limit=QUEUE_PAGE_SIZE, offset=0):
+        with self._lock:
+            return [dict(self._items[key]) for key in self._keys[offset:offset + limit]]
+
+    def cursor(self, item):
+        # Ключ сортировки в виде чисел (время — в микросекундах) для курсора в callback_data
+        return (-item['priority'], -item['reputation'], (item['added_time'] - EPOCH) // timedelta(microseconds=1), item['id'])
+
+    def page_after(self, after=None, before=None, limit=QUEUE_PAGE_SIZE):
+        # Keyset-страница: номера строго после курсора after или строго перед курсором before
+        bound = after if after is not None else before
+        if bound is not None:
+            bound = (bound[0], bound[1], EPOCH + timedelta(microseconds=bound[2]), bound[3])
+        with self._lock:
+            if before is not None:
+                end = bisect.bisect_left(self._keys, bound)
+                keys = self._keys[max(0, end - limit):end]
+            elif after is not None:
+                start = bisect.bisect_right(self._keys, bound)
+                keys = self._keys[start:start + limit]
+            else:
+                keys = self._keys[:limit]
+            return [dict(self._items[key]) for key in keys]
+
+    def reprioritize_user(self, user_id, changes):
+        # Репутация или подписка пользователя изменились — пересчитываем ключи его номеров
+        with self._lock:
+            for phone in list(self._by_user.get(user_id, ())):
+                item = self._discard(phone)
+                if 'reputation' in changes:
+                    item['reputation'] = changes['reputation']
+                if 'subscription_type' in changes:
+                    item['subscription_type'] = changes['subscription_type']
+                    item['priority'] = self._tiers.get(changes['subscription_type'], 0)
+                self._add(item)
+
+number_queue = NumberQueue()
+number_queue.load()
+number_queue.reconcile()
+
+class CallbackRoute:
+    def __init__(self, name, handler, types=(), slow=False):
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.slow = slow
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def parse(self, tail):
+        # Хвост после префикса режется по "_" на столько частей, сколько типов; последняя забирает остаток
+        if not self.types:
+            return ()
+        parts = tail.split("_", len(self.types) - 1)
+        if len(parts) != len(self.types):
+            raise ValueError(f"{self.name}: expected {len(self.types)} args, got {tail!r}")
+        return tuple(conv(part) for conv, part in zip(self.types, parts))
+
+class CallbackRouter:
+    """Dispatches callback_data to one handler: exact actions via a dict,
+    prefixed actions (``select_number_<phone>``) via a prefix trie whose tail
+    is parsed into typed arguments. An exact action that a prefix also
+    matches, two prefixes where one starts the other, and duplicates are all
+    rejected at registration, so every payload has one owner.
+    """
+
+    _END = object()
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.routes = []
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def route(self, *actions, slow=False):
+        def decorator(handler):
+            for action in actions:
+                if action in self.exact:
+                    raise ValueError(f"callback {action!r} already routed to {self.exact[action].handler.__name__}")
+                shadow = self._match_prefix(action)
+                if shadow is not None:
+                    raise ValueError(f"callback {action!r} is shadowed by prefix {shadow.name!r}")
+                self.exact[action] = CallbackRoute(action, handler, slow=slow)
+                self.routes.append(self.exact[action])
+            return handler
+        return decorator
+
+    def prefix(self, prefix, *types, slow=False):
+        def decorator(handler):
+            node = self.trie
+            for char in prefix:
+                if self._END in node:
+                    raise ValueError(f"callback prefix {prefix!r} is shadowed by {node[self._END].name!r}")
+                node = node.setdefault(char, {})
+            if self._END in node:
+                raise ValueError(f"callback prefix {prefix!r} already routed to {node[self._END].handler.__name__}")
+            if node:
+                raise ValueError(f"callback prefix {prefix!r} shadows a longer prefix")
+            for action in self.exact:
+                if action.startswith(prefix):
+                    raise ValueError(f"callback prefix {prefix!r} shadows {action!r}")
+            node[self._END] = CallbackRoute(prefix, handler, types, slow)
+            self.routes.append(node[self._END])
+            return handler
+        return decorator
+
+    def _match_prefix(self, data):
+        node = self.trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                return None
+            if self._END in node:
+                return node[self._END]
+        return None
+
+    def resolve(self, data):
+        route = self.exact.get(data)
+        if route is not None:
+            return route, ()
+        route = self._match_prefix(data)
+        if route is None:
+            return None, ()
+        return route, route.parse(data[len(route.name):])
+
+    def dispatch(self, call):
+        try:
+            route, args = self.resolve(call.data or "")
+        except ValueError as e:
+            route = None
+            logger.warning("bad callback payload %r: %s", call.data, e)
+        if route is None:
+            with self._lock:
+                self.unmatched += 1
+            bot.answer_callback_query(call.id)
+            return
+        started = time.perf_counter()
+        try:
+            route.handler(call, *args)
+        except Exception:
+            with self._lock:
+                route.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                route.calls += 1
+                route.total_time += elapsed
+                route.max_time = max(route.max_time, elapsed)
+
+    def stats(self, top=10):
+        with self._lock:
+            busiest = sorted((r for r in self.routes if r.calls), key=lambda r: r.calls, reverse=True)[:top]
+            return {'routes': len(self.routes), 'unmatched': self.unmatched,
+                    'top': [(r.name, r.calls, r.errors, r.total_time / r.calls * 1000, r.max_time * 1000) for r in busiest]}
+
+callbacks = CallbackRouter()
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    callbacks.dispatch(call)
+
+CONVERSATION_TTL = getattr(config, 'CONVERSATION_TTL', 1800)
+# Сколько помнить, что у чата нет открытого шага; другой процесс может открыть его в этом окне
+CONVERSATION_NEGATIVE_TTL = getattr(config, 'CONVERSATION_NEGATIVE_TTL', 2)
+
+class ConversationStore:
+    """Which step each chat is answering, kept in SQLite so multi-step flows
+    survive restarts and can be shared by several bot processes.
+
+    A step is a handler registered with @conversations.step; expect() arms it
+    for a chat with keyword arguments stored as JSON, and the chat's next
+    message is passed to it. States that are not steps (drafts waiting for a
+    button) are stored the same way via set() and read back with claim().
+    Claiming is one DELETE ... RETURNING, so each answer is taken exactly once
+    whichever process sees it. The cache only decides whether a message needs
+    a claim; a miss costs one primary-key lookup.
+    """
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.steps = {}
+        self.slow_steps = set()
+        self.cache = TTLCache(USER_CACHE_SIZE, ttl, negative_ttl)
+
+    def step(self, handler=None, slow=False):
+        if handler is None:
+            return lambda handler: self.step(handler, slow)
+        if handler.__name__ in self.steps:
+            raise ValueError(f"conversation step {handler.__name__} already registered")
+        self.steps[handler.__name__] = handler
+        if slow:
+            self.slow_steps.add(handler.__name__)
+        return handler
+
+    def expect(self, chat_id, handler, **payload):
+        if self.steps.get(handler.__name__) is not handler:
+            raise ValueError(f"{handler.__name__} is not a conversation step")
+        self.set(chat_id, handler.__name__, **payload)
+
+    def set(self, chat_id, state, **payload):
+        expires_at = time.time() + self.ttl
+        execute("INSERT OR REPLACE INTO conversations (chat_id, state, payload, expires_at) VALUES (?, ?, ?, ?)",
+                (chat_id, state, json.dumps(payload), expires_at))
+        on_commit(lambda: self.cache.put(chat_id, (state, expires_at)))
+
+    def state(self, chat_id):
+        entry = self.cache.get(chat_id, _MISSING)
+        if entry is _MISSING:
+            row = query_one("SELECT state, expires_at FROM conversations WHERE chat_id = ?", (chat_id,))
+            entry = (row['state'], row['expires_at']) if row else None
+            self.cache.put(chat_id, entry)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def cached_state(self, chat_id):
+        # Как state(), но без похода в базу: промах кэша — None
+        entry = self.cache.get(chat_id)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def claim(self, chat_id, *states):
+        # Забирает состояние (одно из states, если заданы) и удаляет его; (state, payload) или None
+        sql = "DELETE FROM conversations WHERE chat_id = ? AND expires_at > ?"
+        params = [chat_id, time.time()]
+        if states:
+            sql += f" AND state IN ({', '.join('?' * len(states))})"
+            params.extend(states)
+        with transaction() as cur:
+            rows = cur.execute(sql + " RETURNING state, payload", params).fetchall()
+            row = rows[0] if rows else None
+            if row:
+                on_commit(lambda: self.cache.put(chat_id, None))
+        if row is None:
+            self.cache.invalidate(chat_id)
+            return None
+        return row['state'], json.loads(row['payload'])
+
+    def clear(self, chat_id):
+        execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+        on_commit(lambda: self.cache.put(chat_id, None))
+
+    def pending(self, message):
+        return self.state(message.chat.id) in self.steps
+
+    def handle(self, message):
+        claimed = self.claim(message.chat.id, *self.steps)
+        if claimed is None:
+            # Шаг истёк или его уже забрал другой процесс — обрабатываем как обычное сообщение
+            bot.process_new_messages([message])
+            return
+        state, payload = claimed
+        self.steps[state](message, **payload)
+
+    def purge(self):
+        execute("DELETE FROM conversations WHERE expires_at <= ?", (time.time(),))
+
+conversations = ConversationStore(CONVERSATION_TTL, CONVERSATION_NEGATIVE_TTL)
+
+# Зарегистрирован раньше команд: ответ на открытый шаг не уходит в /start и прочие обработчики
+@bot.message_handler(func=conversations.pending, content_types=telebot.util.content_type_media)
+def conversation_step(message):
+    conversations.handle(message)
+
+UPDATE_LANES = getattr(config, 'UPDATE_LANES', 8)
+SLOW_UPDATE_LANES = getattr(config, 'SLOW_UPDATE_LANES', 2)
+UPDATE_LANE_SIZE = getattr(config, 'UPDATE_LANE_SIZE', 100)
+SLOW_COMMANDS = {'export'}
+
+def update_chat_id(update):
+    chat = getattr(update, 'chat', None) or getattr(getattr(update, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'from_user', None)
+    return user.id if user else 0
+
+def is_slow_update(update):
+    # Выгрузки, выплаты и запуск рассылок — помечены slow у маршрутов, шагов и команд
+    if isinstance(update, types.CallbackQuery):
+        try:
+            route, _ = callbacks.resolve(update.data or "")
+        except ValueError:
+            return False
+        return bool(route and route.slow)
+    if isinstance(update, types.Message):
+        # Только по кэшу шагов: polling-поток не ходит в базу ради выбора полосы
+        if conversations.cached_state(update.chat.id) in conversations.slow_steps:
+            return True
+        return telebot.util.extract_command(update.text) in SLOW_COMMANDS
+    return False
+
+class LaneExecutor:
+    """Worker pool for telebot that keeps each chat's updates in order.
+
+    Tasks are hashed by chat id onto serial lanes: one chat never has two
+    handlers running at once, different chats run in parallel. Updates that
+    is_slow() picks go to lanes of their own so a payout does not hold up
+    users; is_slow() runs on the polling thread and must not touch the
+    database. A full lane blocks the polling thread instead of buffering
+    without bound, while submit() never blocks and returns False instead.
+    A task queued from the lane it targets runs inline. Handler errors are
+    logged; they do not stop the lane or polling.
+    """
+
+    def __init__(self, bot, lanes, slow_lanes, queue_size, is_slow=None):
+        self.bot = bot
+        self.is_slow = is_slow
+        # telebot ждёт на этом событии вместе с polling-потоком; наши ошибки его не взводят
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.lanes = [queue.Queue(queue_size) for _ in range(lanes)]
+        self.slow_lanes = [queue.Queue(queue_size) for _ in range(slow_lanes)]
+        self.waits = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        for i, lane in enumerate(self.lanes + self.slow_lanes):
+            thread = threading.Thread(target=self._run, args=(lane,), name=f"UpdateLane{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def lane_for(self, chat_id, slow=False):
+        lanes = self.slow_lanes if slow and self.slow_lanes else self.lanes
+        return lanes[hash(chat_id) % len(lanes)]
+
+    def put(self, func, *args, **kwargs):
+        update = args[0] if args else None
+        slow = self.is_slow is not None and self.is_slow(update)
+        self._put(self.lane_for(update_chat_id(update), slow), func, args, kwargs)
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        # Фоновые задачи по чату (таймеры) встают в ту же очередь, что и его апдейты; при полной полосе — False
+        return self._put(self.lane_for(chat_id), func, args, kwargs, block=False)
+
+    def _put(self, lane, func, args, kwargs, block=True):
+        if getattr(self._local, 'lane', None) is lane:
+            # Задача из самой полосы (повторная обработка апдейта) — выполняем сразу, иначе полоса ждала бы сама себя
+            self._execute(func, args, kwargs)
+            return True
+        try:
+            lane.put_nowait((func, args, kwargs))
+        except queue.Full:
+            with self._counter_lock:
+                self.waits += 1
+            if not block:
+                return False
+            logger.warning("update lane full (%d queued), waiting", lane.qsize())
+            lane.put((func, args, kwargs))
+        return True
+
+    def _run(self, lane):
+        self._local.lane = lane
+        while True:
+            task = lane.get()
+            if task is None:
+                return
+            self._execute(*task)
 
-def sort_queue(queue):
-    def key_func(item):
-        user = get_user(item['user_id'])
-        rep = user['reputation']
-        sub = user['subscription_type']
-        priority = 0
-        if sub == 'VIP Nexus':
-            priority = 4
-        elif sub == 'Prime Plus':
-            priority = 3
-        elif sub == 'Gold Tier':
-            priority = 2
-        elif sub == 'Elite Access':
-            priority = 1
-        return (-priority, -rep, item['added_time'])
-    return sorted(queue, key=key_func)
+    def _execute(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            with self._counter_lock:
+                self.failed += 1
+            if self.bot.exception_handler is None or not self.bot.exception_handler.handle(e):
+                logger.exception("update handler %s failed", getattr(func, '__name__', func))
+
+    def raise_exceptions(self):
+        pass
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        for lane in self.lanes + self.slow_lanes:
+            lane.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def stats(self):
+        with self._counter_lock:
+            waits, failed = self.waits, self.failed
+        return {'depth': [lane.qsize() for lane in self.lanes], 'slow_depth': [lane.qsize() for lane in self.slow_lanes],
+                'waits': waits, 'failed': failed}
+
+update_lanes = LaneExecutor(bot, UPDATE_LANES, SLOW_UPDATE_LANES, UPDATE_LANE_SIZE, is_slow_update)
+bot.worker_pool.close()
+bot.worker_pool = update_lanes
+
+PAGE_SIZE = 10
+
+def encode_cursor(key):
+    return "_".join(repr(v) for v in key)
+
+def decode_cursor(text):
+    return tuple(float(v) if '.' in v or 'e' in v else int(v) for v in text.split("_"))
+
+class KeysetQuery:
+    """Ordered SQL source for a PagedView.
+
+    keys are SQL expressions sorted ascending (negate a column to sort it
+    descending); the last one must be unique. They are selected as _k0.._kN
+    so the view can build a cursor from any row.
+    """
+
+    def __init__(self, columns, tables, keys, where=(), params=None):
+        self.columns = columns
+        self.tables = tables
+        self.keys = keys
+        self.where = list(where)
+        self.params = params  # chat_id -> параметры для условий where
+
+    def fetch(self, chat_id, after=None, before=None, limit=PAGE_SIZE):
+        conditions = list(self.where)
+        params = list(self.params(chat_id)) if self.params else []
+        bound = after if after is not None else before
+        if bound is not None:
+            conditions.append(f"({', '.join(self.keys)}) {'>' if after is not None else '<'} ({', '.join('?' * len(bound))})")
+            params.extend(bound)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        direction = "DESC" if before is not None else "ASC"
+        key_columns = ", ".join(f"{key} AS _k{i}" for i, key in enumerate(self.keys))
+        rows = query_all(f"SELECT {self.columns}, {key_columns} FROM {self.tables} {where} "
+                         f"ORDER BY {', '.join(f'{key} {direction}' for key in self.keys)} LIMIT ?", params + [limit])
+        return rows[::-1] if before is not None else rows
+
+    def key(self, row):
+        return tuple(row[f"_k{i}"] for i in range(len(self.keys)))
+
+class QueueSource:
+    """The in-memory number queue as a PagedView source."""
+
+    def fetch(self, chat_id, after=None, before=None, limit=PAGE_SIZE):
+        return number_queue.page_after(after, before, limit)
+
+    def key(self, item):
+        return number_queue.cursor(item)
+
+class PagedView:
+    """A list rendered one page at a time.
+
+    The page cursor travels in callback_data as pg_<name>_<n|p>_<key>: n shows
+    rows after the key, p the rows before it. Each render fetches at most
+    page_size + 1 rows; the extra row only tells whether another page exists.
+    render(chat_id, message_id, rows, nav) draws the page and must append nav
+    (a possibly empty list of buttons) to its keyboard.
+    """
+
+    views = {}
+
+    def __init__(self, name, source, render, page_size=PAGE_SIZE, allow=None):
+        if name in PagedView.views or '_' in name:
+            raise ValueError(f"bad or duplicate paged view name: {name}")
+        self.name = name
+        self.source = source
+        self.render = render
+        self.page_size = page_size
+        self.allow = allow
+        PagedView.views[name] = self
+
+    def page(self, chat_id, direction=None, cursor=None):
+        after = cursor if direction == 'n' else None
+        before = cursor if direction == 'p' else None
+        rows = self.source.fetch(chat_id, after, before, self.page_size + 1)
+        extra = len(rows) > self.page_size
+        if before is not None:
+            return rows[-self.page_size:], extra, True
+        return rows[:self.page_size], after is not None, extra
+
+    def nav(self, rows, has_prev, has_next):
+        buttons = []
+        if rows and has_prev:
+            buttons.append(types.InlineKeyboardButton("⬅️", callback_data=f"pg_{self.name}_p_{encode_cursor(self.source.key(rows[0]))}"))
+        if rows and has_next:
+            buttons.append(types.InlineKeyboardButton("➡️", callback_data=f"pg_{self.name}_n_{encode_cursor(self.source.key(rows[-1]))}"))
+        return buttons
+
+    def show(self, chat_id, message_id=None, direction=None, cursor=None):
+        rows, has_prev, has_next = self.page(chat_id, direction, cursor)
+        self.render(chat_id, message_id, rows, self.nav(rows, has_prev, has_next))
+        return rows
+
+def add_nav(markup, nav):
+    if nav:
+        markup.row(*nav)
+    return markup
+
+@callbacks.prefix("pg_", str, str, decode_cursor)
+def paged_view_nav(call, name, direction, cursor):
+    view = PagedView.views.get(name)
+    if view is None or direction not in ('n', 'p'):
+        bot.answer_callback_query(call.id)
+        return
+    if view.allow and not view.allow(call.from_user.id):
+        bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+        return
+    view.show(call.message.chat.id, call.message.message_id, direction, cursor)
+    bot.answer_callback_query(call.id)
+
+
+class MediaRegistry:
+    """Telegram file_ids for the pictures in photos.PHOTOS.
+
+    A local file or URL is uploaded on first use; the file_id Telegram returns
+    is stored in media_cache under the asset name and content hash and sent
+    from then on. A changed file (or URL) has a new hash and is uploaded again.
+    Values that are already file_ids are passed through untouched.
+    """
+
+    def __init__(self, assets):
+        self.assets = assets
+        self._lock = threading.Lock()
+        self._file_ids = {}  # name -> (content_hash, file_id)
+        self._file_hashes = {}  # path -> ((mtime, size), hash)
+        self.uploads = 0
+
+    def load(self):
+        rows = query_all("SELECT name, content_hash, file_id FROM media_cache")
+        with self._lock:
+            self._file_ids = {row[0]: (row[1], row[2]) for row in rows}
+
+    def _content_hash(self, value):
+        if value.startswith(('http://', 'https://')):
+            return hashlib.sha256(value.encode()).hexdigest()
+        if not os.path.isfile(value):
+            return None
+        stat = os.stat(value)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._file_hashes.get(value)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(value, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        self._file_hashes[value] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+    @contextmanager
+    def source(self, name):
+        # Отдаёт то, что передать в Telegram: file_id из кэша, URL или открытый файл
+        value = self.assets[name]
+        content_hash = self._content_hash(value)
+        with self._lock:
+            cached = self._file_ids.get(name)
+        if content_hash is None or (cached and cached[0] == content_hash):
+            yield (cached[1] if content_hash else value), None
+        elif value.startswith(('http://', 'https://')):
+            yield value, content_hash
+        else:
+            with open(value, 'rb') as f:
+                yield f, content_hash
+
+    def remember(self, name, content_hash, message):
+        if not content_hash or not getattr(message, 'photo', None):
+            return
+        file_id = message.photo[-1].file_id
+        execute("INSERT OR REPLACE INTO media_cache (name, content_hash, file_id, updated_at) VALUES (?, ?, ?, ?)",
+                (name, content_hash, file_id, datetime.now(tz)))
+        with self._lock:
+            self._file_ids[name] = (content_hash, file_id)
+            self.uploads += 1
+
+media = MediaRegistry(photos.PHOTOS)
+media.load()
+
+def send_asset(chat_id, name, **kwargs):
+    with media.source(name) as (photo, content_hash):
+        message = bot.send_photo(chat_id, photo, **kwargs)
+    media.remember(name, content_hash, message)
+    return message
+
+def edit_asset(chat_id, message_id, name, caption=None, reply_markup=None):
+    with media.source(name) as (photo, content_hash):
+        message = bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=types.InputMediaPhoto(photo, caption=caption), reply_markup=reply_markup)
+    media.remember(name, content_hash, message)
+    return message
 
 def show_main_menu(chat_id, edit_message_id=None):
     user = get_user(chat_id)
@@ -331,17 +1741,17 @@ def show_main_menu(chat_id, edit_message_id=None):
     status = get_status('work_status')
     reputation = user['reputation']
     balance = user['balance']
-    queue_count = len(get_queue())
-    user_queue_count = len(get_user_queue(chat_id))
+    queue_count = len(number_queue)
+    user_queue_count = number_queue.user_count(chat_id)
     caption = f"@{username} | Full Work\n➢Статус ворка: {status}\n➣Репутация: {reputation}\n➢Баланс: {balance}\n╓Общая очередь: {queue_count}\n║\n╚Твои номера в очереди: {user_queue_count}"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("Добавить номер 🚀", callback_data="add_number"), types.InlineKeyboardButton("Мои номера 📱", callback_data="my_numbers"))
     markup.add(types.InlineKeyboardButton("Очередь 🔄", callback_data="queue"), types.InlineKeyboardButton("Статистика 📊", callback_data="stats"))
     markup.row(types.InlineKeyboardButton("Мой профиль 👤", callback_data="profile"))
     if edit_message_id:
-        bot.edit_message_media(chat_id=chat_id, message_id=edit_message_id, media=types.InputMediaPhoto(photos.PHOTOS['start'], caption=caption), reply_markup=markup)
+        edit_asset(chat_id, edit_message_id, 'start', caption=caption, reply_markup=markup)
     else:
-        bot.send_photo(chat_id, photos.PHOTOS['start'], caption=caption, reply_markup=markup)
+        send_asset(chat_id, 'start', caption=caption, reply_markup=markup)
 
 @bot.message_handler(commands=['start'])
 def handle_start(message):
@@ -351,20 +1761,23 @@ def handle_start(message):
     user = get_user(user_id)
     if not user:
         referral_code = generate_referral_code(user_id)
-        cursor.execute("INSERT INTO users (id, username, referral_code, last_activity, profit_level) VALUES (?, ?, ?, ?, ?)", (user_id, username, referral_code, datetime.now(tz), 'новичок'))
-        conn.commit()
+        execute("INSERT INTO users (id, username, referral_code, last_activity, profit_level) VALUES (?, ?, ?, ?, ?)", (user_id, username, referral_code, datetime.now(tz), 'новичок'))
+        invalidate_user(user_id)
         if ref and ref.startswith('ref_'):
             referer_id = int(ref[4:])
             if referer_id != user_id:
-                cursor.execute("INSERT OR IGNORE INTO referrals (referer_id, referee_id) VALUES (?, ?)", (referer_id, user_id))
-                conn.commit()
-                referer = get_user(referer_id)
-                update_user(referer_id, balance=referer['balance'] + config.REFERRAL_REWARD, referrals_count=referer['referrals_count'] + 1)
-                referrals = get_user(referer_id)['referrals_count']
-                profit = get_profit_level(referrals, is_admin=is_admin(referer_id))
-                update_user(referer_id, profit_level=profit)
-                bot.send_message(referer_id, f"+${config.REFERRAL_REWARD} за нового реферала [{user_id}]")
-                bot.send_photo(referer_id, photos.PHOTOS['new_profit'])
+                reward = settings.get('referral_reward')
+                with transaction() as cur:
+                    cur.execute("INSERT OR IGNORE INTO referrals (referer_id, referee_id) VALUES (?, ?)", (referer_id, user_id))
+                    referer = get_user(referer_id)
+                    update_user(referer_id, balance=referer['balance'] + reward, referrals_count=referer['referrals_count'] + 1)
+                    referrals = get_user(referer_id)['referrals_count']
+                    profit = get_profit_level(referrals, is_admin=is_admin(referer_id))
+                    update_user(referer_id, profit_level=profit)
+                def notify_referer():
+                    bot.send_message(referer_id, f"+${reward} за нового реферала [{user_id}]")
+                    send_asset(referer_id, 'new_profit')
+                outbox.submit(referer_id, notify_referer)
     else:
         update_user(user_id, last_activity=datetime.now(tz))
     if not is_subscribed(user_id):
@@ -376,23 +1789,24 @@ def handle_start(message):
     else:
         show_main_menu(user_id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "check_sub")
+@callbacks.route("check_sub")
 def check_sub(call):
+    membership_cache.invalidate(call.from_user.id)
     if is_subscribed(call.from_user.id):
         bot.delete_message(call.message.chat.id, call.message.message_id)
         show_main_menu(call.message.chat.id)
     else:
         bot.answer_callback_query(call.id, "Вы еще не подписаны!", show_alert=True)
 
-@bot.callback_query_handler(func=lambda call: call.data == "add_number")
+@callbacks.route("add_number")
 def add_number_type_choice(call):
     caption = "Выберите тип номера"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("макс", callback_data="add_max"), types.InlineKeyboardButton("вц", callback_data="add_vc"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['start'], caption=caption), reply_markup=markup)
+    edit_asset(call.message.chat.id, call.message.message_id, 'start', caption=caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data in ["add_max", "add_vc"])
+@callbacks.route("add_max", "add_vc")
 def add_number(call):
     number_type = 'max' if call.data == "add_max" else 'vc'
     if number_type == 'max':
@@ -401,9 +1815,10 @@ def add_number(call):
         caption = "Введите номер в формате 9XXXXXXXXX"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="add_number"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['start'], caption=caption), reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_add_number, call.message.message_id, number_type)
+    edit_asset(call.message.chat.id, call.message.message_id, 'start', caption=caption, reply_markup=markup)
+    conversations.expect(call.message.chat.id, process_add_number, message_id=call.message.message_id, number_type=number_type)
 
+@conversations.step
 def process_add_number(message, message_id=None, number_type=None):
     phone = message.text.strip()
     if number_type == 'max':
@@ -416,70 +1831,117 @@ def process_add_number(message, message_id=None, number_type=None):
             bot.send_message(message.chat.id, "Неверный формат. Попробуйте снова.")
             add_number_type_choice(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="add_number"))
             return
-    cursor.execute("SELECT * FROM queue WHERE phone_number = ?", (phone,))
-    if cursor.fetchone():
+    if not number_queue.push(message.chat.id, phone, number_type):
         bot.send_message(message.chat.id, "Номер уже добавлен.")
         show_main_menu(message.chat.id)
         return
-    cursor.execute("INSERT INTO queue (user_id, phone_number, added_time, type) VALUES (?, ?, ?, ?)", (message.chat.id, phone, datetime.now(tz), number_type))
-    conn.commit()
     log_action(message.chat.id, f"Добавлен номер {phone} типа {number_type}")
     show_main_menu(message.chat.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "my_numbers")
+@callbacks.route("my_numbers")
 def my_numbers(call):
     caption = "Мои номера"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("В работе ⚙️", callback_data="my_working"), types.InlineKeyboardButton("Ожидает ⏳", callback_data="my_queue"))
     markup.add(types.InlineKeyboardButton("Успешные ✅", callback_data="my_successful"), types.InlineKeyboardButton("Блок 🛑", callback_data="my_blocked"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['start'], caption=caption), reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("my_"))
+    edit_asset(call.message.chat.id, call.message.message_id, 'start', caption=caption, reply_markup=markup)
+
+def my_list_view(name, table, title):
+    def render(chat_id, message_id, items, nav):
+        caption = f"{title}\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in items) if items else f"{title}: Пусто"
+        markup = add_nav(types.InlineKeyboardMarkup(), nav)
+        markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="my_numbers"))
+        bot.edit_message_caption(caption, chat_id, message_id, reply_markup=markup)
+    return PagedView(name, KeysetQuery("phone_number, type", table, ["id"], where=["user_id = ?"], params=lambda chat_id: (chat_id,)),
+                     render, page_size=20)
+
+MY_LISTS = {
+    "my_queue": my_list_view("mq", "queue", "Ожидает"),
+    "my_working": my_list_view("mw", "working", "В работе"),
+    "my_successful": my_list_view("ms", "successful", "Успешные"),
+    "my_blocked": my_list_view("mb", "blocked", "Блок"),
+}
+
+@callbacks.route(*MY_LISTS)
 def show_my_list(call):
-    data = call.data
-    if data == "my_queue":
-        items = get_user_queue(call.message.chat.id)
-        title = "Ожидает"
-    elif data == "my_working":
-        items = get_working(call.message.chat.id)
-        title = "В работе"
-    elif data == "my_successful":
-        items = get_successful(call.message.chat.id)
-        title = "Успешные"
-    elif data == "my_blocked":
-        items = get_blocked(call.message.chat.id)
-        title = "Блок"
-    caption = f"{title}\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in items) if items else f"{title}: Пусто"
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="my_numbers"))
-    bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    MY_LISTS[call.data].show(call.message.chat.id, call.message.message_id)
+
+QUEUE_SUBSCRIPTIONS = ['Gold Tier', 'Prime Plus', 'VIP Nexus']
+
+def can_see_queue(user_id):
+    user = get_user(user_id)
+    return bool(user) and user['subscription_type'] in QUEUE_SUBSCRIPTIONS
+
+def render_queue(chat_id, message_id, queue, nav):
+    caption = "Очередь:\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in queue) if queue else "Очередь пуста"
+    markup = add_nav(types.InlineKeyboardMarkup(), nav)
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
+    bot.edit_message_caption(caption, chat_id, message_id, reply_markup=markup)
+
+queue_view = PagedView("sq", QueueSource(), render_queue, page_size=20, allow=can_see_queue)
 
-@bot.callback_query_handler(func=lambda call: call.data == "queue")
+@callbacks.route("queue")
 def show_queue(call):
-    user = get_user(call.message.chat.id)
-    sub = user['subscription_type']
-    if sub in ['Gold Tier', 'Prime Plus', 'VIP Nexus']:
-        queue = sort_queue(get_queue())
-        caption = "Очередь:\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in queue) if queue else "Очередь пуста"
-    else:
-        caption = f"Общая очередь: {len(get_queue())}"
+    if can_see_queue(call.message.chat.id):
+        queue_view.show(call.message.chat.id, call.message.message_id)
+        return
+    caption = f"Общая очередь: {len(number_queue)}"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "stats")
+def render_stats(chat_id, message_id, rows, nav):
+    caption = "Статистика:\n" + "\n".join(f"{row['username']}-{row['phone_number']} ({row['type']})-холд: {format_hold(row['hold_minutes'])}" for row in rows)
+    markup = add_nav(types.InlineKeyboardMarkup(), nav)
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
+    bot.edit_message_caption(caption, chat_id, message_id, reply_markup=markup)
+
+# Список успешных номеров с холдом, общий для статистики и /holdall
+SUCCESSFUL_HOLDS = KeysetQuery("u.username, s.phone_number, s.type, s.hold_minutes", "successful s LEFT JOIN users u ON u.id = s.user_id",
+                               ["s.id"], where=["s.hold_minutes IS NOT NULL"])
+
+stats_view = PagedView("st", SUCCESSFUL_HOLDS, render_stats, page_size=20, allow=is_admin)
+
+class PayoutTotal:
+    """Cached SUM(users.pending_payout) for /holdall, dropped whenever payouts change."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = None
+        # Как в UserCache: сумма, посчитанная до инвалидации, не попадёт в кэш
+        self._generation = 0
+
+    def get(self):
+        with self._lock:
+            if self._value is not None:
+                return self._value
+            generation = self._generation
+        value = query_one("SELECT COALESCE(SUM(pending_payout), 0) FROM users")[0]
+        with self._lock:
+            if generation == self._generation:
+                self._value = value
+        return value
+
+    def _drop(self):
+        with self._lock:
+            self._value = None
+            self._generation += 1
+
+    def invalidate(self):
+        self._drop()
+        on_commit(self._drop)
+
+payout_total = PayoutTotal()
+
+@callbacks.route("stats")
 def show_stats(call):
     if not is_admin(call.from_user.id):
         bot.answer_callback_query(call.id, "Доступно только админам", show_alert=True)
         return
-    stats = get_successful()
-    caption = "Статистика:\n" + "\n".join(f"{get_user(item['user_id'])['username']}-{item['phone_number']} ({item['type']})-холд: {item['hold_time']}" for item in stats if item['hold_time'])
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
-    bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    stats_view.show(call.message.chat.id, call.message.message_id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "profile")
+@callbacks.route("profile")
 def show_profile(call):
     user = get_user(call.message.chat.id)
     username = user['username']
@@ -493,37 +1955,37 @@ def show_profile(call):
     markup.add(types.InlineKeyboardButton("Купить подписку 💳", callback_data="buy_sub"), types.InlineKeyboardButton("Реферальная система 🔗", callback_data="referral"))
     markup.add(types.InlineKeyboardButton("Карта 💳", callback_data="card"), types.InlineKeyboardButton("Правила 📜", callback_data="rules"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['profile'], caption=caption), reply_markup=markup)
+    edit_asset(call.message.chat.id, call.message.message_id, 'profile', caption=caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "rules")
+@callbacks.route("rules")
 def show_rules(call):
     rules_text = "Основные правила бота\n1️⃣ Что нельзя делать ни в коем случае!\n‼️‼️ ЮЗЫ НЕ МЕНЯТЬ, КТО БЫ ВАМ НИ ПИСАЛ! ЧТО БЫ ВАМ НИ ПИСАЛИ! ‼️‼️\n‼️‼️ СМЕНИТЕ ЮЗ – ОСТАНЕТЕСЬ БЕЗ ВЫПЛАТЫ! БУДЕТЕ ПОТОМ ЖАЛОВАТЬСЯ! ‼️‼️\n‼️‼️ ЕСЛИ ВАС ПО КАКОЙ-ТО ПРИЧИНЕ ЗАБАНИЛИ (РЕКЛАМА, СКАМ, ПЕРЕЛИВ И Т.Д.) – ЛИШЕНИЕ ВЫПЛАТЫ! ‼️‼️\n\n2️⃣ Если ваш номер отстоял, например, 1 час, вам не нужно делать никаких отчётов.\nМы сами скинем табель в эту группу.\nЧтобы посмотреть, сколько именно отстоял ваш номер, введите команду /hold – она покажет номер и холд! 📊\n\n3️⃣ Как пользоваться ботом?\n\nНажимаете кнопку «Добавить номер».\n\nВписываете номер в формате 9XXXXXXXXX.\n\nЖдёте, пока ваш номер возьмут в работу.\n\nПосле этого вам придёт сообщение:\n\n✆ (Ваш номер) ЗАПРОС АКТИВАЦИИ\n✎ Ограничение времени активации: 2 минуты\n✔ ТВОЙ КОД: (здесь будет код от скупа)\n\nНиже будут две кнопки: «Ввёл» и «Скип».\n\nЕсли нажали «Ввёл», номер перейдёт в раздел «В работе» – это значит, что вы ввели код. ✅\n\nЕсли нажали «Скип», номер удалится из очереди и не будет активирован. ❌\n\n4️⃣ Как узнать статус вашего номера?\nНажимаете кнопку «Мои номера» и выбираете нужный пункт (всего 4):\n\n🔹 В работе – номер ещё стоит.\n🔹 Ожидает – номер в очереди, его ещё не взяли в работу.\n🔹 Успешные – номер с холдом более 54 минут (будет выплата). 💰\n🔹 Блок – номер слетел без холда.\n\n5️⃣ Полезные команды:\n🔸 /hold – показывает ваш холд (только для номеров с холдом от 54 мин).\n🔸 /del – удалить номер из очереди (формат: /del номер).\n🔸 /menu – обновить меню.\n\n6️⃣ Как повысить прайс? 🚀\nВ нашем боте можно повысить прайс с помощью подписки! Цены низкие, а бонусы сочные! 😍\n\nДоступные подписки:\n\nElite Access (+6,4$) 💵 Цена: 2 USDT\n\nGold Tier (+7$) 💰 Цена: 2,3 USDT\n\nPrime Plus (+9$) 🚀 Цена: 3 USDT\n\nVIP Nexus (+15$) 🔥 Цена: 4 USDT\n\nВсе подписки действуют 1 месяц (потом можно купить снова)."
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['rules'], caption="Правила"))
+    edit_asset(call.message.chat.id, call.message.message_id, 'rules', caption="Правила")
     bot.send_message(call.message.chat.id, rules_text, reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile")))
 
-@bot.callback_query_handler(func=lambda call: call.data == "buy_sub")
+@callbacks.route("buy_sub")
 def buy_sub(call):
     caption = "Купить подписку"
     markup = types.InlineKeyboardMarkup()
     for sub, data in config.SUBSCRIPTIONS.items():
         markup.add(types.InlineKeyboardButton(sub, url=data['payment_link']))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['buy_sub'], caption=caption), reply_markup=markup)
+    edit_asset(call.message.chat.id, call.message.message_id, 'buy_sub', caption=caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "referral")
+@callbacks.route("referral")
 def show_referral(call):
     user = get_user(call.message.chat.id)
     referrals = user['referrals_count']
     profit = user['profit_level']
     balance = user['balance']
-    ref_link = f"https://t.me/{bot.get_me().username}?start={user['referral_code']}"
+    ref_link = f"https://t.me/{bot_username()}?start={user['referral_code']}"
     caption = f"▶Рефералы: {referrals}\n▶Профит: {profit}\n▶Баланс: {balance}\n▶Твоя рефералка: {ref_link}"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Вывод 💸", callback_data="withdraw"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['referral'], caption=caption), reply_markup=markup)
+    edit_asset(call.message.chat.id, call.message.message_id, 'referral', caption=caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "withdraw")
+@callbacks.route("withdraw")
 def withdraw(call):
     user = get_user(call.message.chat.id)
     if user['balance'] < config.MIN_WITHDRAW:
@@ -532,9 +1994,10 @@ def withdraw(call):
     caption = "Укажите сумму и юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="referral"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['withdraw'], caption=caption), reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_withdraw, call.message.message_id)
+    edit_asset(call.message.chat.id, call.message.message_id, 'withdraw', caption=caption, reply_markup=markup)
+    conversations.expect(call.message.chat.id, process_withdraw, message_id=call.message.message_id)
 
+@conversations.step
 def process_withdraw(message, message_id):
     text = message.text.split()
     if len(text) != 2 or not text[0].replace('.', '', 1).isdigit():
@@ -548,12 +2011,11 @@ def process_withdraw(message, message_id):
         bot.send_message(message.chat.id, "Недостаточно средств или ниже минимума")
         show_profile(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="profile"))
         return
-    cursor.execute("INSERT INTO withdraw_requests (user_id, amount) VALUES (?, ?)", (message.chat.id, amount))
-    conn.commit()
+    execute("INSERT INTO withdraw_requests (user_id, amount) VALUES (?, ?)", (message.chat.id, amount))
     bot.send_message(message.chat.id, "Заявка создана")
     show_profile(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="profile"))
 
-@bot.callback_query_handler(func=lambda call: call.data == "card")
+@callbacks.route("card")
 def show_card(call):
     user = get_user(call.message.chat.id)
     if user['card_status'] == 'blocked':
@@ -579,16 +2041,17 @@ def show_card(call):
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("Активировать 🔓", callback_data="activate_card"))
         markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-        bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['card'], caption="Карта не активирована"), reply_markup=markup)
+        edit_asset(call.message.chat.id, call.message.message_id, 'card', caption="Карта не активирована", reply_markup=markup)
         return
 
     # active
     caption = "Введите пароль от карты"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['card'], caption=caption), reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, check_card_password, call.message.message_id)
+    edit_asset(call.message.chat.id, call.message.message_id, 'card', caption=caption, reply_markup=markup)
+    conversations.expect(call.message.chat.id, check_card_password, message_id=call.message.message_id)
 
+@conversations.step
 def check_card_password(message, message_id):
     user = get_user(message.chat.id)
     if message.text != user['card_password']:
@@ -611,9 +2074,9 @@ def display_card(chat_id, edit_id):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Настройки ⚙️", callback_data="card_settings"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-    bot.edit_message_media(chat_id=chat_id, message_id=edit_id, media=types.InputMediaPhoto(photos.PHOTOS['card'], caption=caption), reply_markup=markup)
+    edit_asset(chat_id, edit_id, 'card', caption=caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "card_settings")
+@callbacks.route("card_settings")
 def card_settings(call):
     caption = "Настройки карты"
     markup = types.InlineKeyboardMarkup()
@@ -624,14 +2087,15 @@ def card_settings(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "transfer_money")
+@callbacks.route("transfer_money")
 def transfer_money(call):
     caption = "Введите юзернейм сумма"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_settings"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_transfer_money, call.message.message_id)
+    conversations.expect(call.message.chat.id, process_transfer_money, message_id=call.message.message_id)
 
+@conversations.step
 def process_transfer_money(message, message_id):
     text = message.text.split()
     if len(text) != 2 or not text[1].replace('.', '', 1).isdigit():
@@ -645,87 +2109,162 @@ def process_transfer_money(message, message_id):
         bot.send_message(message.chat.id, "Недостаточно средств или неверная сумма")
         card_settings(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="card_settings"))
         return
-    cursor.execute("SELECT id FROM users WHERE username = ?", (to_username,))
-    row = cursor.fetchone()
-    if not row:
+    to_user_id = find_user_id(to_username)
+    if not to_user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         card_settings(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="card_settings"))
         return
-    to_user_id = row[0]
+    if to_user_id == from_user['id']:
+        bot.send_message(message.chat.id, "Нельзя перевести самому себе")
+        card_settings(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="card_settings"))
+        return
     to_user = get_user(to_user_id)
-    if to_user['card_status'] != 'active' and to_user_id != from_user['id']:
+    if to_user['card_status'] != 'active':
         bot.send_message(message.chat.id, "Получатель не имеет активной карты")
         card_settings(types.CallbackQuery(id=str(random.randint(1,10000)), from_user=message.from_user, message=message, data="card_settings"))
         return
+    token = offer_transfer(from_user['id'], to_user_id, amount)
     caption = f"Юзернейм: {to_username}\nСумма: {amount}"
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Перевести ✅", callback_data=f"confirm_transfer_{to_user_id}_{amount}"))
+    markup.add(types.InlineKeyboardButton("Перевести ✅", callback_data=f"confirm_transfer_{token}"))
     markup.add(types.InlineKeyboardButton("Отмена ❌", callback_data="card_settings"))
     bot.edit_message_caption(caption, message.chat.id, message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_transfer_"))
-def confirm_transfer(call):
-    parts = call.data.split("_")
-    to_user_id = int(parts[2])
-    amount = float(parts[3])
+def offer_transfer(from_user_id, to_user_id, amount):
+    # Перевод ждёт кнопки в conversations: новое предложение или другой шаг заменяют его, старая кнопка не сработает
+    token = os.urandom(8).hex()
+    conversations.set(from_user_id, 'confirm_transfer', token=token, to_user_id=to_user_id, amount=amount)
+    return token
+
+def take_transfer(from_user_id, token):
+    # claim() гасит перевод при первом нажатии, повторное нажатие ничего не переводит
+    claimed = conversations.claim(from_user_id, 'confirm_transfer')
+    if claimed is None or claimed[1]['token'] != token:
+        return None
+    return claimed[1]['to_user_id'], claimed[1]['amount']
+
+def transfer_card_balance(from_user_id, to_user_id, amount):
+    """Move card balance between users in one transaction.
+
+    The debit is conditional on the balance inside the UPDATE itself, so
+    concurrent transfers from the same card cannot overdraw it. Returns the
+    transfers row id, or None if the balance is insufficient.
+    """
+    if amount <= 0 or from_user_id == to_user_id:
+        raise ValueError("Неверный перевод")
+    now = datetime.now(tz)
+    with transaction() as cur:
+        cur.execute("UPDATE users SET card_balance = card_balance - ? WHERE id = ? AND card_balance >= ?", (amount, from_user_id, amount))
+        if cur.rowcount != 1:
+            return None
+        cur.execute("UPDATE users SET card_balance = card_balance + ? WHERE id = ?", (amount, to_user_id))
+        if cur.rowcount != 1:
+            # Исключение откатывает и списание
+            raise ValueError("Получатель не найден")
+        transfer_id = cur.execute("INSERT INTO transfers (from_user_id, to_user_id, amount, timestamp) VALUES (?, ?, ?, ?)",
+                                  (from_user_id, to_user_id, amount, now)).lastrowid
+        out_id = cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type, transfer_id) VALUES (?, ?, ?, 'transfer_out', ?)",
+                             (from_user_id, -amount, now, transfer_id)).lastrowid
+        in_id = cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type, transfer_id) VALUES (?, ?, ?, 'transfer_in', ?)",
+                            (to_user_id, amount, now, transfer_id)).lastrowid
+        cur.execute("UPDATE transfers SET out_history_id = ?, in_history_id = ? WHERE id = ?", (out_id, in_id, transfer_id))
+        invalidate_user(from_user_id)
+        invalidate_user(to_user_id)
+    return transfer_id
+
+@callbacks.prefix("confirm_transfer_", str)
+def confirm_transfer(call, token):
     from_user_id = call.from_user.id
-    from_user = get_user(from_user_id)
-    if amount > from_user['card_balance']:
+    pending = take_transfer(from_user_id, token)
+    if pending is None:
+        bot.answer_callback_query(call.id, "Перевод уже выполнен или устарел", show_alert=True)
+        return
+    to_user_id, amount = pending
+    try:
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
+    except Exception as e:
+        logger.debug("transfer confirm markup clear failed: %s", e)
+    try:
+        transfer_id = transfer_card_balance(from_user_id, to_user_id, amount)
+    except ValueError as e:
+        bot.answer_callback_query(call.id, str(e), show_alert=True)
+        return
+    if transfer_id is None:
         bot.answer_callback_query(call.id, "Недостаточно средств", show_alert=True)
         return
+    from_user = get_user(from_user_id)
     to_user = get_user(to_user_id)
-    update_user(from_user_id, card_balance=from_user['card_balance'] - amount)
-    update_user(to_user_id, card_balance=to_user['card_balance'] + amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (from_user_id, -amount, datetime.now(tz), 'transfer_out'))
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (to_user_id, amount, datetime.now(tz), 'transfer_in'))
-    cursor.execute("INSERT INTO transfers (from_user_id, to_user_id, amount, timestamp) VALUES (?, ?, ?, ?)", (from_user_id, to_user_id, amount, datetime.now(tz)))
-    conn.commit()
     # Send check photo
     check_caption = f"Юзернейм: {to_user['username']}\nСумма: {amount}\nДата: {datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')}"
-    check_msg = bot.send_photo(call.message.chat.id, photos.PHOTOS['check'] if 'check' in photos.PHOTOS else photos.PHOTOS['start'], caption=check_caption)
-    check_link = f"t.me/{bot.get_me().username}/{call.message.chat.id}/{check_msg.message_id}"  # Approximate link
+    check_msg = send_asset(call.message.chat.id, 'check' if 'check' in photos.PHOTOS else 'start', caption=check_caption)
+    check_link = f"t.me/{bot_username()}/{call.message.chat.id}/{check_msg.message_id}"  # Approximate link
     bot.send_message(call.message.chat.id, f"Ссылка на чек: {check_link}")
     # Notify receiver
     notify_caption = f"Зачисление денежных средств\nЮзернейм: {from_user['username']}\nСумма: {amount}\nДата: {datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')}"
-    bot.send_message(to_user_id, notify_caption)
+    outbox.send(to_user_id, notify_caption)
     bot.answer_callback_query(call.id, "Перевод выполнен")
 
-@bot.callback_query_handler(func=lambda call: call.data == "card_history_user")
-def card_history_user(call):
+CARD_HISTORY_PAGE_SIZE = 10
+
+def card_history_page(user_id, before=None, after=None):
+    # Keyset-пагинация по id: (строки от новых к старым, есть ли старее, есть ли новее)
+    sql = """SELECT h.id, h.amount, h.timestamp, h.type,
+                    CASE h.type WHEN 'transfer_in' THEN fu.username WHEN 'transfer_out' THEN tu.username END AS other
+             FROM card_history h
+             LEFT JOIN transfers t ON t.id = h.transfer_id
+             LEFT JOIN users fu ON fu.id = t.from_user_id
+             LEFT JOIN users tu ON tu.id = t.to_user_id
+             WHERE h.user_id = ? {cond} ORDER BY h.id {order} LIMIT ?"""
+    if after is not None:
+        rows = query_all(sql.format(cond="AND h.id > ?", order="ASC"), (user_id, after, CARD_HISTORY_PAGE_SIZE + 1))
+        more = len(rows) > CARD_HISTORY_PAGE_SIZE
+        return rows[:CARD_HISTORY_PAGE_SIZE][::-1], True, more
+    if before is not None:
+        rows = query_all(sql.format(cond="AND h.id < ?", order="DESC"), (user_id, before, CARD_HISTORY_PAGE_SIZE + 1))
+    else:
+        rows = query_all(sql.format(cond="", order="DESC"), (user_id, CARD_HISTORY_PAGE_SIZE + 1))
+    return rows[:CARD_HISTORY_PAGE_SIZE], len(rows) > CARD_HISTORY_PAGE_SIZE, before is not None
+
+@callbacks.route("card_history_user")
+@callbacks.prefix("card_hist_", str, int)
+def card_history_user(call, direction=None, anchor=None):
     user_id = call.from_user.id
-    cursor.execute("SELECT amount, timestamp, type, id FROM card_history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-    rows = cursor.fetchall()
+    before = anchor if direction == "old" else None
+    after = anchor if direction == "new" else None
+    rows, has_older, has_newer = card_history_page(user_id, before, after)
     if not rows:
         caption = "Нет истории"
     else:
         caption = "История операций:"
     markup = types.InlineKeyboardMarkup()
     for row in rows:
-        if row[2] in ['deposit', 'transfer_in']:
+        if row['type'] in ['deposit', 'transfer_in']:
             sign = '+'
         else:
             sign = '-'
-        if row[2] == 'transfer_in':
-            cursor.execute("SELECT from_user_id FROM transfers WHERE to_user_id=? AND amount=? AND timestamp=?", (user_id, row[0], row[1]))
-            tr = cursor.fetchone()
-            other = get_user(tr[0])['username'] if tr else ''
-            text = f"{sign}{abs(row[0])} {row[1].strftime('%Y-%m-%d %H:%M')} от {other}"
-        elif row[2] == 'transfer_out':
-            cursor.execute("SELECT to_user_id FROM transfers WHERE from_user_id=? AND amount=? AND timestamp=?", (user_id, -row[0], row[1]))
-            tr = cursor.fetchone()
-            other = get_user(tr[0])['username'] if tr else ''
-            text = f"{sign}{abs(row[0])} {row[1].strftime('%Y-%m-%d %H:%M')} кому {other}"
+        when = row['timestamp'].strftime('%Y-%m-%d %H:%M')
+        if row['type'] == 'transfer_in':
+            text = f"{sign}{abs(row['amount'])} {when} от {row['other'] or ''}"
+        elif row['type'] == 'transfer_out':
+            text = f"{sign}{abs(row['amount'])} {when} кому {row['other'] or ''}"
         else:
-            text = f"{sign}{abs(row[0])} {row[1].strftime('%Y-%m-%d %H:%M')} {row[2]}"
-        markup.add(types.InlineKeyboardButton(text, callback_data=f"dummy_history_{row[3]}"))
+            text = f"{sign}{abs(row['amount'])} {when} {row['type']}"
+        markup.add(types.InlineKeyboardButton(text, callback_data=f"dummy_history_{row['id']}"))
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=f"card_hist_new_{rows[0]['id']}"))
+    if has_older:
+        nav.append(types.InlineKeyboardButton("Старее ➡️", callback_data=f"card_hist_old_{rows[-1]['id']}"))
+    if nav:
+        markup.row(*nav)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_settings"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("dummy_history_"))
+@callbacks.prefix("dummy_history_")
 def dummy_history(call):
     bot.answer_callback_query(call.id, "Информация об операции", show_alert=False)
 
-@bot.callback_query_handler(func=lambda call: call.data == "activate_card")
+@callbacks.route("activate_card")
 def activate_card(call):
     user = get_user(call.message.chat.id)
     if user['card_status'] != 'inactive':
@@ -735,8 +2274,9 @@ def activate_card(call):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, set_card_password, call.message.message_id)
+    conversations.expect(call.message.chat.id, set_card_password, message_id=call.message.message_id)
 
+@conversations.step
 def set_card_password(message, message_id):
     password = message.text
     if not password.isdigit() or len(password) != 4:
@@ -750,26 +2290,26 @@ def set_card_password(message, message_id):
     update_user(user_id, card_number=card_num, cvv=cvv, card_status='active', card_password=password, card_activation_date=datetime.now(tz), api_token=api_token)
     display_card(user_id, message_id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "block_card")
+@callbacks.route("block_card")
 def block_card(call):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Подтвердить ✅", callback_data="confirm_block_card"))
     markup.add(types.InlineKeyboardButton("Отмена ❌", callback_data="card_settings"))
     bot.edit_message_caption("Подтвердите блокировку карты", call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_block_card")
+@callbacks.route("confirm_block_card")
 def confirm_block_card(call):
     user_id = call.from_user.id
-    user = get_user(user_id)
-    balance = user['card_balance']
-    if balance > 0:
-        cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
-        conn.commit()
-    update_user(user_id, card_status='blocked', block_reason='user', card_balance=0, card_activation_date=datetime.now(tz))
+    with transaction() as cur:
+        user = get_user(user_id)
+        balance = user['card_balance']
+        if balance > 0:
+            cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
+        update_user(user_id, card_status='blocked', block_reason='user', card_balance=0, card_activation_date=datetime.now(tz))
     bot.edit_message_caption("Карта заблокирована, баланс списан", call.message.chat.id, call.message.message_id)
     show_card(call)
 
-@bot.callback_query_handler(func=lambda call: call.data == "api_card")
+@callbacks.route("api_card")
 def api_card(call):
     user = get_user(call.message.chat.id)
     api_token = user.get('api_token')  # Use .get to avoid KeyError
@@ -778,14 +2318,9 @@ def api_card(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_settings"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, parse_mode="HTML", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("back_"))
+@callbacks.route("back_main")
 def back(call):
-    data = call.data
-    if data == "back_main":
-        show_main_menu(call.message.chat.id, call.message.message_id)
-    elif data == "back_admin":
-        admin_panel(types.SimpleNamespace(chat=types.SimpleNamespace(id=call.message.chat.id)))
-        show_main_menu(call.message.chat.id, call.message.message_id)
+    show_main_menu(call.message.chat.id, call.message.message_id)
 
 @bot.message_handler(commands=['admin'])
 def admin_panel(message):
@@ -797,198 +2332,251 @@ def admin_panel(message):
     markup.row(types.InlineKeyboardButton("Дополнительно ⚙️", callback_data="admin_extra"))
     bot.send_message(message.chat.id, caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_number")
+@callbacks.route("get_number")
 def get_number(call):
-    queue = sort_queue(get_queue())
-    if not queue:
+    if not len(number_queue):
         bot.answer_callback_query(call.id, "Очередь пуста", show_alert=True)
         return
+    pick_number_view.show(call.message.chat.id, call.message.message_id)
+
+def render_pick_number(chat_id, message_id, queue, nav):
     markup = types.InlineKeyboardMarkup()
     for item in queue:
-        user = get_user(item['user_id'])
-        sub = user['subscription_type'] or ""
-        rep = user['reputation']
+        sub = item['subscription_type'] or ""
+        rep = item['reputation']
         button_text = f"{item['phone_number']} ({item['type']})-реп:{rep}-подписка:{sub}"
         markup.add(types.InlineKeyboardButton(button_text, callback_data=f"select_number_{item['phone_number']}"))
+    add_nav(markup, nav)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_admin"))
-    bot.edit_message_text("Выберите номер", call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.edit_message_text("Выберите номер", chat_id, message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("select_number_"))
-def select_number(call):
-    phone = call.data.split("_")[2]
-    cursor.execute("SELECT user_id, type FROM queue WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
-    user_id = row[0]
-    number_type = row[1]
-    user = get_user(user_id)
-    sub = user['subscription_type'] or ""
+pick_number_view = PagedView("q", QueueSource(), render_pick_number, allow=is_admin)
+
+@callbacks.prefix("select_number_", str)
+def select_number(call, phone):
+    item = number_queue.get(phone)
+    if not item:
+        bot.answer_callback_query(call.id, "Номер уже не в очереди", show_alert=True)
+        return
+    number_type = item['type']
+    sub = item['subscription_type'] or ""
     price_hour, price_30 = get_price_increase(sub)
-    rep = user['reputation']
+    rep = item['reputation']
     caption = f"Номер: {phone} ({number_type})\nПодписка: {sub}\nПрайс: час-{price_hour}$ 30мин-{price_30}$\nРепутация: {rep}"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Отправить код 🔑", callback_data=f"send_code_{phone}"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="get_number"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("send_code_"))
-def send_code(call):
-    phone = call.data.split("_")[2]
+@callbacks.prefix("send_code_", str)
+def send_code(call, phone):
     caption = "Отправьте код текстом или фото"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="select_number_" + phone))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_send_code, phone, call.from_user.id)
+    conversations.expect(call.message.chat.id, process_send_code, phone=phone, admin_id=call.from_user.id)
 
+@conversations.step
 def process_send_code(message, phone, admin_id):
-    cursor.execute("SELECT user_id, type FROM queue WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
-    user_id = row[0]
-    number_type = row[1]
+    # Активация записывается до отправки кода: упав между ними, бот истечёт её после рестарта, а не потеряет номер
+    with transaction():
+        item = number_queue.remove(phone)
+        if item:
+            start_activation(phone, item['user_id'], admin_id, item['type'])
+    if not item:
+        bot.send_message(message.chat.id, "Номер уже не в очереди")
+        return
+    user_id = item['user_id']
     caption_base = f"✆ {phone} ЗАПРОС АКТИВАЦИИ\n✎ Ограничение времени активации: 2 минуты"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Ввёл ✅", callback_data=f"entered_{phone}"))
     markup.add(types.InlineKeyboardButton("Скип ❌", callback_data=f"skip_{phone}"))
-    if message.photo:
-        caption = caption_base + "\n✔ ТВОЙ КОД: (на фото)"
-        sent = bot.send_photo(user_id, message.photo[-1].file_id, caption=caption, reply_markup=markup)
-    else:
-        code = message.text
-        caption = caption_base + f"\n✔ ТВОЙ КОД: {code}"
-        sent = bot.send_message(user_id, caption, reply_markup=markup)
+    # Код идёт вне очереди: рассылки и уведомления уступают ему следующий токен
+    try:
+        if message.photo:
+            caption = caption_base + "\n✔ ТВОЙ КОД: (на фото)"
+            sent = outbox.call(user_id, lambda: bot.send_photo(user_id, message.photo[-1].file_id, caption=caption, reply_markup=markup))
+        else:
+            code = message.text
+            caption = caption_base + f"\n✔ ТВОЙ КОД: {code}"
+            sent = outbox.call(user_id, lambda: bot.send_message(user_id, caption, reply_markup=markup))
+    except Exception as e:
+        logger.warning("activation code for %s not sent: %s", phone, e)
+        cancel_activation(phone, item)
+        bot.send_message(message.chat.id, "Не удалось отправить код, номер возвращён в очередь")
+        return
+    activation_sent(phone, sent.message_id)
     bot.send_message(message.chat.id, "Код отправлен")
-    cursor.execute("DELETE FROM queue WHERE phone_number = ?", (phone,))
-    conn.commit()
-    pending_activations[phone] = admin_id
-    # Timer to delete after 2 min if not responded
-    def delete_msg():
-        try:
-            bot.delete_message(user_id, sent.message_id)
-            bot.send_message(user_id, f"✎ {phone} Время для подтверждения активации истекло. Номер удален из очереди")
-            pending_activations.pop(phone, None)
-            pending_timers.pop(phone, None)
-        except:
-            pass
-    timer = threading.Timer(120, delete_msg)
-    pending_timers[phone] = timer
-    timer.start()
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("entered_"))
-def entered(call):
-    phone = call.data.split("_")[1]
+
+ACTIVATION_TIMEOUT = 120
+ACTIVATION_RETRY_DELAY = 1
+
+def start_activation(phone, user_id, admin_id, number_type):
+    # Дедлайн на случай падения до отправки кода; настоящий отсчёт взводит activation_sent()
+    execute("INSERT OR REPLACE INTO pending_activations (phone_number, user_id, admin_id, type, message_id, deadline) VALUES (?, ?, ?, ?, NULL, ?)",
+            (phone, user_id, admin_id, number_type, time.time() + ACTIVATION_TIMEOUT))
+
+def activation_sent(phone, message_id):
+    # Код у пользователя: запоминаем сообщение и только теперь запускаем отсчёт
+    deadline = time.time() + ACTIVATION_TIMEOUT
+    with transaction() as cur:
+        armed = cur.execute("UPDATE pending_activations SET message_id = ?, deadline = ? WHERE phone_number = ? RETURNING user_id",
+                            (message_id, deadline, phone)).fetchall()
+        if armed:
+            # Истечение идёт через полосу пользователя: не пересекается с его нажатием «Ввёл»/«Скип»
+            user_id = armed[0]['user_id']
+            on_commit(lambda: arm_activation(deadline, user_id, phone))
+
+def arm_activation(deadline, user_id, phone):
+    scheduler.at(deadline, hand_off_expiry, user_id, phone, key=('activation', phone))
+
+def hand_off_expiry(user_id, phone):
+    # Поток планировщика не ждёт забитую полосу: пробуем снова чуть позже
+    if not update_lanes.submit(user_id, expire_activation, phone):
+        logger.warning("update lane full, activation %s expiry postponed", phone)
+        arm_activation(time.time() + ACTIVATION_RETRY_DELAY, user_id, phone)
+
+def cancel_activation(phone, item):
+    # Код не ушёл: снимаем активацию и возвращаем номер на прежнее место в очереди
+    with transaction():
+        if claim_activation(phone):
+            number_queue.push(item['user_id'], phone, item['type'], added_time=item['added_time'])
+
+def claim_activation(phone):
+    # Забирает активацию ровно один раз: ответ пользователя и таймаут не могут сработать оба
+    with transaction() as cur:
+        row = cur.execute("SELECT * FROM pending_activations WHERE phone_number = ?", (phone,)).fetchone()
+        if row:
+            cur.execute("DELETE FROM pending_activations WHERE phone_number = ?", (phone,))
+    scheduler.cancel(('activation', phone))
+    return row
+
+def expire_activation(phone):
+    row = claim_activation(phone)
+    if not row:
+        return
+    try:
+        if row['message_id']:
+            bot.delete_message(row['user_id'], row['message_id'])
+        bot.send_message(row['user_id'], f"✎ {phone} Время для подтверждения активации истекло. Номер удален из очереди")
+    except Exception as e:
+        logger.warning("activation %s expiry notice failed: %s", phone, e)
+
+def recover_activations():
+    # После рестарта заново взводим дедлайны; просроченные истекут сразу
+    for row in query_all("SELECT phone_number, user_id, deadline FROM pending_activations"):
+        arm_activation(row['deadline'], row['user_id'], row['phone_number'])
+
+@callbacks.prefix("entered_", str)
+def entered(call, phone):
     user_id = call.from_user.id
-    admin_id = pending_activations.pop(phone, None)
-    if admin_id is None:
+    activation = claim_activation(phone)
+    if activation is None:
         bot.answer_callback_query(call.id, "Активация истекла", show_alert=True)
         return
-    if phone in pending_timers:
-        pending_timers[phone].cancel()
-        del pending_timers[phone]
-    cursor.execute("SELECT type FROM queue WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
-    number_type = row[0] if row else 'unknown'
-    cursor.execute("INSERT INTO working (user_id, phone_number, start_time, admin_id, type) VALUES (?, ?, ?, ?, ?)", (user_id, phone, datetime.now(tz), admin_id, number_type))
-    conn.commit()
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['entered'], caption="Номер в работе"))
+    admin_id = activation['admin_id']
+    number_type = activation['type'] or 'unknown'
+    execute("INSERT INTO working (user_id, phone_number, start_time, admin_id, type) VALUES (?, ?, ?, ?, ?)", (user_id, phone, datetime.now(tz), admin_id, number_type))
+    edit_asset(call.message.chat.id, call.message.message_id, 'entered', caption="Номер в работе")
     log_action(user_id, f"Ввёл код для {phone}")
     # Notify admin
     bot.send_message(admin_id, f"Пользователь {user_id} ввёл код для {phone}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("skip_"))
-def skip(call):
-    phone = call.data.split("_")[1]
-    admin_id = pending_activations.pop(phone, None)
-    if admin_id is None:
+@callbacks.prefix("skip_", str)
+def skip(call, phone):
+    activation = claim_activation(phone)
+    if activation is None:
         bot.answer_callback_query(call.id, "Активация истекла", show_alert=True)
         return
-    if phone in pending_timers:
-        pending_timers[phone].cancel()
-        del pending_timers[phone]
-    bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['skip'], caption="Номер скипнут"))
+    admin_id = activation['admin_id']
+    edit_asset(call.message.chat.id, call.message.message_id, 'skip', caption="Номер скипнут")
     log_action(call.from_user.id, f"Скип {phone}")
     # Notify admin
     bot.send_message(admin_id, f"Пользователь {call.from_user.id} скипнул {phone}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "report_flight")
+@callbacks.route("report_flight")
 def report_flight(call):
-    working = sorted(get_working(), key=lambda x: get_user(x['user_id'])['reputation'], reverse=True)
-    if not working:
+    if not query_one("SELECT 1 FROM working LIMIT 1"):
         bot.answer_callback_query(call.id, "Нет номеров в работе", show_alert=True)
         return
+    flight_view.show(call.message.chat.id, call.message.message_id)
+
+def render_flight(chat_id, message_id, working, nav):
     markup = types.InlineKeyboardMarkup()
     for item in working:
-        user = get_user(item['user_id'])
-        button_text = f"{item['phone_number']} ({item['type']})-реп:{user['reputation']}"
+        button_text = f"{item['phone_number']} ({item['type']})-реп:{item['reputation']}"
         markup.add(types.InlineKeyboardButton(button_text, callback_data=f"flight_number_{item['phone_number']}"))
+    add_nav(markup, nav)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_admin"))
-    bot.edit_message_text("Выберите номер для слёта", call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.edit_message_text("Выберите номер для слёта", chat_id, message_id, reply_markup=markup)
+
+# Номера в работе по убыванию репутации владельца
+flight_view = PagedView("fl", KeysetQuery("w.phone_number, w.type, u.reputation", "working w LEFT JOIN users u ON u.id = w.user_id",
+                                          ["-COALESCE(u.reputation, 0)", "w.id"]), render_flight, allow=is_admin)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("flight_number_"))
-def flight_number(call):
-    phone = call.data.split("_")[2]
+@callbacks.prefix("flight_number_", str)
+def flight_number(call, phone):
     caption = "Введите время слёта (ЧЧ:ММ)"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="report_flight"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_flight_time, phone)
+    conversations.expect(call.message.chat.id, process_flight_time, phone=phone)
 
+@conversations.step
 def process_flight_time(message, phone):
     flight_str = message.text
     try:
         flight_time = datetime.strptime(flight_str, "%H:%M")
         flight_time = datetime.now(tz).replace(hour=flight_time.hour, minute=flight_time.minute)
-    except:
+    except (TypeError, ValueError):
         bot.send_message(message.chat.id, "Неверный формат")
         return
-    cursor.execute("SELECT user_id, start_time, type FROM working WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
+    row = query_one("SELECT user_id, start_time, type FROM working WHERE phone_number = ?", (phone,))
     user_id = row[0]
     accept_time = row[1]
     number_type = row[2]
     hold = calculate_hold(accept_time, flight_time)
-    caption = f"{phone} ({number_type}) слетел\nхолд: {hold}"
+    caption = f"{phone} ({number_type}) слетел\nхолд: {format_hold(hold) if hold is not None else None}"
     markup = types.InlineKeyboardMarkup()
-    if hold:
+    if hold is not None:
         markup.add(types.InlineKeyboardButton("Слёт 🟢", callback_data=f"success_flight_{phone}_{flight_time.timestamp()}_{number_type}"))
     markup.add(types.InlineKeyboardButton("Блок 🛑", callback_data=f"block_flight_{phone}_{number_type}"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="flight_number_" + phone))
     bot.send_message(message.chat.id, caption, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("success_flight_"))
-def success_flight(call):
-    parts = call.data.split("_")
-    phone = parts[2]
-    ts = float(parts[3])
-    number_type = parts[4]
+@callbacks.prefix("success_flight_", str, float, str)
+def success_flight(call, phone, ts, number_type):
     flight_time = datetime.fromtimestamp(ts, pytz.UTC).astimezone(tz)
-    cursor.execute("SELECT user_id, start_time FROM working WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
+    row = query_one("SELECT user_id, start_time FROM working WHERE phone_number = ?", (phone,))
     user_id = row[0]
     accept_time = row[1]
     hold = calculate_hold(accept_time, flight_time)
-    if hold:
-        cursor.execute("INSERT INTO successful (user_id, phone_number, hold_time, acceptance_time, flight_time, type) VALUES (?, ?, ?, ?, ?, ?)", (user_id, phone, hold, accept_time, flight_time, number_type))
-        conn.commit()
-        bot.send_photo(user_id, photos.PHOTOS['success'], caption=f"{phone} слетел | 🟢успех🟢\n🗒️номер отображается в разделе Успешные\n🆙Введите команду /hold чтобы посмотреть свой холд")
-    cursor.execute("DELETE FROM working WHERE phone_number = ?", (phone,))
-    conn.commit()
+    with transaction() as cur:
+        if hold is not None:
+            # Выплата считается по тарифу на момент слёта и копится в users.pending_payout
+            payout = hold_payout(get_user(user_id)['subscription_type'], hold)
+            cur.execute("INSERT INTO successful (user_id, phone_number, hold_minutes, payout, acceptance_time, flight_time, type) VALUES (?, ?, ?, ?, ?, ?, ?)", (user_id, phone, hold, payout, accept_time, flight_time, number_type))
+            cur.execute("UPDATE users SET pending_payout = pending_payout + ? WHERE id = ?", (payout, user_id))
+            invalidate_user(user_id)
+            payout_total.invalidate()
+        cur.execute("DELETE FROM working WHERE phone_number = ?", (phone,))
+    if hold is not None:
+        outbox.submit(user_id, lambda: send_asset(user_id, 'success', caption=f"{phone} слетел | 🟢успех🟢\n🗒️номер отображается в разделе Успешные\n🆙Введите команду /hold чтобы посмотреть свой холд"),
+                      PRIORITY_FLIGHT)
     bot.answer_callback_query(call.id, "Обработано")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("block_flight_"))
-def block_flight(call):
-    parts = call.data.split("_")
-    phone = parts[2]
-    number_type = parts[3]
-    cursor.execute("SELECT user_id FROM working WHERE phone_number = ?", (phone,))
-    row = cursor.fetchone()
+@callbacks.prefix("block_flight_", str, str)
+def block_flight(call, phone, number_type):
+    row = query_one("SELECT user_id FROM working WHERE phone_number = ?", (phone,))
     user_id = row[0]
-    cursor.execute("INSERT INTO blocked (user_id, phone_number, type) VALUES (?, ?, ?)", (user_id, phone, number_type))
-    conn.commit()
-    cursor.execute("DELETE FROM working WHERE phone_number = ?", (phone,))
-    conn.commit()
-    bot.send_photo(user_id, photos.PHOTOS['block'], caption=f"{phone} Заблокирован | 🛑блок🛑\n🗒️номер отображается в разделе Блок\n🆙Введите команду /hold чтобы посмотреть свой холд")
+    with transaction() as cur:
+        cur.execute("INSERT INTO blocked (user_id, phone_number, type) VALUES (?, ?, ?)", (user_id, phone, number_type))
+        cur.execute("DELETE FROM working WHERE phone_number = ?", (phone,))
+    outbox.submit(user_id, lambda: send_asset(user_id, 'block', caption=f"{phone} Заблокирован | 🛑блок🛑\n🗒️номер отображается в разделе Блок\n🆙Введите команду /hold чтобы посмотреть свой холд"),
+                  PRIORITY_FLIGHT)
     bot.answer_callback_query(call.id, "Обработано")
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_extra")
+@callbacks.route("admin_extra")
 def admin_extra(call):
     caption = "Дополнительно"
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1002,7 +2590,444 @@ def admin_extra(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_admin"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "broadcast")
+# Классы приоритета исходящих сообщений: меньше — раньше
+PRIORITY_ACTIVATION = 0  # коды активации, дедлайн 2 минуты
+PRIORITY_FLIGHT = 1      # итог слёта пользователю
+PRIORITY_NOTICE = 2      # транзакционные уведомления: выплаты, переводы, рефералы
+PRIORITY_BULK = 3        # рассылки, напоминания, фоновые проверки
+
+class TokenBucket:
+    """Token bucket: `rate` tokens per second, bursts up to `capacity`.
+
+    While a more urgent caller (lower priority value) is waiting, less
+    urgent ones do not take tokens, so bulk senders yield the next token.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = {}  # priority -> сколько потоков ждут токен
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, tokens=1, priority=PRIORITY_BULK):
+        # 0, если токен взят; иначе сколько подождать до следующей попытки
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if any(count for p, count in self._waiting.items() if p < priority):
+                return 1.0 / self.rate
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1, priority=PRIORITY_BULK):
+        with self._lock:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+        try:
+            while True:
+                delay = self.wait_time(tokens, priority)
+                if not delay:
+                    return
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self._waiting[priority] -= 1
+
+    def pause(self, seconds):
+        # Telegram ответил 429 — никто не отправляет до истечения retry_after
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+class ChatRateLimiter:
+    """Per-chat token bucket: `rate` sends per second, bursts up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        # Время, к которому ведро чата снова полное (GCRA): одно число на чат вместо счётчика токенов
+        self._full_at = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._full_at) > 10000:
+                self._full_at = {c: t for c, t in self._full_at.items() if t > now}
+            full_at = max(now, self._full_at.get(chat_id, 0.0))
+            at = max(now, full_at - (self.burst - 1) * self.interval)
+            self._full_at[chat_id] = full_at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+def retry_after(error):
+    # Секунды из ответа 429 или None, если ошибка не про лимит
+    if isinstance(error, telebot.apihelper.ApiTelegramException) and error.error_code == 429:
+        return (error.result_json or {}).get('parameters', {}).get('retry_after', 1)
+    return None
+
+BROADCAST_WORKERS = getattr(config, 'BROADCAST_WORKERS', 4)
+BROADCAST_RATE = getattr(config, 'BROADCAST_RATE', 25)  # сообщений в секунду на весь бот
+SEND_MAX_ATTEMPTS = 5
+CHAT_SEND_RATE = getattr(config, 'CHAT_SEND_RATE', 1)  # сообщений в секунду в один чат
+CHAT_SEND_BURST = getattr(config, 'CHAT_SEND_BURST', 3)
+
+# Общие лимиты для всех фоновых отправителей (рассылки, уведомления)
+send_bucket = TokenBucket(BROADCAST_RATE)
+chat_limiter = ChatRateLimiter(CHAT_SEND_RATE, CHAT_SEND_BURST)
+
+# Пустой API_BASE_URL — api.telegram.org; иначе, например, локальный telegram-bot-api или фейковый сервер в тестах
+API_BASE_URL = getattr(config, 'API_BASE_URL', None)
+# Соединений столько же, сколько потоков, которые ходят в API: полосы апдейтов, рассылка, outbox, выгрузки, polling
+API_POOL_SIZE = getattr(config, 'API_POOL_SIZE', UPDATE_LANES + SLOW_UPDATE_LANES + BROADCAST_WORKERS + 4)
+API_MAX_ATTEMPTS = getattr(config, 'API_MAX_ATTEMPTS', 3)
+API_MAX_RETRY_WAIT = getattr(config, 'API_MAX_RETRY_WAIT', 10)
+# Методы, повтор которых не создаёт дублей: их можно повторять и после обрыва на середине запроса
+IDEMPOTENT_API_METHODS = frozenset({'getMe', 'getUpdates', 'getChat', 'getChatMember', 'getFile', 'deleteMessage',
+                                    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'})
+
+class ApiClient:
+    """HTTP transport for telebot (apihelper.CUSTOM_REQUEST_SENDER).
+
+    One keep-alive session with a connection pool sized to the threads that
+    call the API. This is the only layer that retries transport failures.
+    A 429 is always retried: it waits retry_after and also pauses the shared
+    send bucket so the background senders back off too. A retry_after longer
+    than max_wait is returned to the caller as is. A connection that was
+    never made is retried for any method. A dropped connection, a read
+    timeout or a 5xx may come after Telegram already executed the request,
+    so those are retried only for the idempotent methods.
+    """
+
+    def __init__(self, pool_size, max_attempts, max_wait, on_retry_after=None, idempotent=IDEMPOTENT_API_METHODS):
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self.on_retry_after = on_retry_after
+        self.idempotent = idempotent
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._methods = {}  # method -> [calls, errors, retries, total_time, max_time]
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit('/', 1)[-1]
+        for attempt in range(1, self.max_attempts + 1):
+            if files and attempt > 1:
+                for value in files.values():
+                    stream = value[1] if isinstance(value, tuple) else value
+                    if hasattr(stream, 'seek'):
+                        stream.seek(0)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retry = attempt < self.max_attempts and (name in self.idempotent or self._not_sent(e))
+                self._record(name, time.perf_counter() - started, ok=False, retry=retry)
+                if not retry:
+                    raise
+                time.sleep(min(2 ** attempt, self.max_wait))
+                continue
+            elapsed = time.perf_counter() - started
+            wait = self._retry_wait(name, response, attempt)
+            if wait is None or attempt == self.max_attempts:
+                self._record(name, elapsed, ok=response.status_code == 200)
+                return response
+            self._record(name, elapsed, ok=False, retry=True)
+            time.sleep(wait)
+
+    @staticmethod
+    def _not_sent(error):
+        # Соединение так и не установилось — запрос до Telegram не дошёл
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+    def _retry_wait(self, name, response, attempt):
+        if response.status_code == 429:
+            try:
+                wait = response.json().get('parameters', {}).get('retry_after', 1)
+            except ValueError:
+                wait = 1
+            if self.on_retry_after:
+                self.on_retry_after(wait)
+            return wait if wait <= self.max_wait else None
+        if response.status_code >= 500 and name in self.idempotent:
+            return min(2 ** attempt, self.max_wait)
+        return None
+
+    def _record(self, name, elapsed, ok, retry=False):
+        with self._lock:
+            stats = self._methods.setdefault(name, [0, 0, 0, 0.0, 0.0])
+            if retry:
+                stats[2] += 1
+                return
+            stats[0] += 1
+            stats[1] += not ok
+            stats[3] += elapsed
+            stats[4] = max(stats[4], elapsed)
+
+    def stats(self, top=10):
+        with self._lock:
+            busiest = sorted(self._methods.items(), key=lambda item: item[1][0], reverse=True)[:top]
+            return [(name, calls, errors, retries, total / calls * 1000 if calls else 0.0, worst * 1000)
+                    for name, (calls, errors, retries, total, worst) in busiest]
+
+api_client = ApiClient(API_POOL_SIZE, API_MAX_ATTEMPTS, API_MAX_RETRY_WAIT, on_retry_after=send_bucket.pause)
+telebot.apihelper.CUSTOM_REQUEST_SENDER = api_client
+if API_BASE_URL:
+    telebot.apihelper.API_URL = API_BASE_URL.rstrip('/') + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = API_BASE_URL.rstrip('/') + "/file/bot{0}/{1}"
+
+def deliver(send, chat_id, bucket, limiter, max_attempts=SEND_MAX_ATTEMPTS, priority=PRIORITY_BULK):
+    # Отправка с учётом лимитов; возвращает (status, attempts, error).
+    # Сбои сети и 5xx уже повторил ApiClient, где это безопасно; здесь ждём только долгий 429, который он вернул как есть
+    error = None
+    for attempt in range(1, max_attempts + 1):
+        bucket.acquire(priority=priority)
+        limiter.acquire(chat_id)
+        try:
+            send()
+            return 'sent', attempt, None
+        except Exception as e:
+            error = str(e)
+            wait = retry_after(e)
+            if wait is None:
+                return 'failed', attempt, error
+            bucket.pause(wait)
+    return 'failed', max_attempts, error
+BROADCAST_PROGRESS_INTERVAL = 5
+
+def message_payload(message, reply_markup=None):
+    # Содержимое сообщения в виде, пригодном для хранения в БД и повторной отправки
+    payload = {'kind': 'text', 'text': (message.text if message else None) or "Рассылка", 'caption': message.caption if message else None}
+    if message:
+        for kind in ('photo', 'sticker', 'video', 'animation', 'document', 'audio'):
+            content = getattr(message, kind)
+            if content:
+                payload['kind'] = kind
+                payload['file_id'] = content[-1].file_id if kind == 'photo' else content.file_id
+                break
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup.to_json()
+    return payload
+
+def send_payload(chat_id, payload):
+    kind = payload['kind']
+    markup = payload.get('reply_markup')
+    if kind == 'text':
+        return bot.send_message(chat_id, payload['text'], reply_markup=markup)
+    if kind == 'sticker':
+        return bot.send_sticker(chat_id, payload['file_id'], reply_markup=markup)
+    sender = getattr(bot, f"send_{kind}")
+    return sender(chat_id, payload['file_id'], caption=payload.get('caption'), reply_markup=markup)
+
+class BroadcastEngine:
+    """Persisted broadcast jobs delivered by a paced background sender pool.
+
+    Every recipient is a broadcast_targets row; the per-target status makes
+    a job resumable after a restart.
+    """
+
+    def __init__(self, workers, bucket, chat_limiter):
+        self._tasks = queue.Queue(maxsize=workers * 20)
+        self._bucket = bucket
+        self._chat_limiter = chat_limiter
+        self._lock = threading.Condition()
+        self._in_flight = {}
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def start_job(self, admin_id, payload):
+        with transaction() as cur:
+            cur.execute("INSERT INTO broadcast_jobs (admin_id, payload, status, created_at) VALUES (?, ?, 'running', ?)",
+                        (admin_id, json.dumps(payload), datetime.now(tz)))
+            job_id = cur.lastrowid
+            cur.execute("INSERT INTO broadcast_targets (job_id, chat_id) SELECT ?, id FROM users", (job_id,))
+            cur.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (cur.rowcount, job_id))
+        progress = bot.send_message(admin_id, f"Рассылка #{job_id} запущена")
+        execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?", (progress.message_id, job_id))
+        threading.Thread(target=self._run_job, args=(job_id,), daemon=True).start()
+        return job_id
+
+    def resume(self):
+        for row in query_all("SELECT id FROM broadcast_jobs WHERE status = 'running'"):
+            # Цели, взятые в работу до падения, остались pending — их и досылаем
+            threading.Thread(target=self._run_job, args=(row[0],), daemon=True).start()
+
+    def _run_job(self, job_id):
+        job = query_one("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+        payload = json.loads(job['payload'])
+        cursor = 0
+        last_report = 0.0
+        while True:
+            batch = [row[0] for row in query_all(
+                "SELECT chat_id FROM broadcast_targets WHERE job_id = ? AND status = 'pending' AND chat_id > ? ORDER BY chat_id LIMIT 100",
+                (job_id, cursor))]
+            if not batch:
+                break
+            for chat_id in batch:
+                with self._lock:
+                    self._in_flight[job_id] = self._in_flight.get(job_id, 0) + 1
+                self._tasks.put((job_id, chat_id, payload))
+            cursor = batch[-1]
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                self._report(job_id)
+                last_report = time.monotonic()
+        with self._lock:
+            while self._in_flight.get(job_id):
+                self._lock.wait(BROADCAST_PROGRESS_INTERVAL)
+                if self._in_flight.get(job_id):
+                    self._report(job_id)
+            self._in_flight.pop(job_id, None)
+        execute("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?", (datetime.now(tz), job_id))
+        self._report(job_id)
+        log_admin_action(job['admin_id'], f"Рассылка #{job_id}")
+
+    def _report(self, job_id):
+        job = query_one("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+        done = "завершена" if job['status'] == 'done' else "идёт"
+        text = f"Рассылка #{job_id} {done}\nОтправлено: {job['sent']} из {job['total']}\nОшибок: {job['failed']}"
+        # Пока правка ждёт очереди, следующие отчёты заменяют её текст
+        outbox.edit(job['admin_id'], job['progress_message_id'], text)
+
+    def _worker(self):
+        while True:
+            job_id, chat_id, payload = self._tasks.get()
+            try:
+                try:
+                    status, attempts, error = deliver(lambda: send_payload(chat_id, payload), chat_id, self._bucket, self._chat_limiter)
+                except Exception as e:
+                    logger.exception("broadcast #%s to %s failed", job_id, chat_id)
+                    status, attempts, error = 'failed', 1, str(e)
+                with transaction() as cur:
+                    cur.execute("UPDATE broadcast_targets SET status = ?, attempts = ?, error = ?, sent_at = ? WHERE job_id = ? AND chat_id = ?",
+                                (status, attempts, error, datetime.now(tz), job_id, chat_id))
+                    column = 'sent' if status == 'sent' else 'failed'
+                    cur.execute(f"UPDATE broadcast_jobs SET {column} = {column} + 1 WHERE id = ?", (job_id,))
+            except Exception:
+                # Цель останется pending и уйдёт при следующем resume(); поток живёт дальше
+                logger.exception("broadcast #%s target %s not recorded", job_id, chat_id)
+            finally:
+                # Иначе _run_job ждал бы эту цель вечно
+                with self._lock:
+                    self._in_flight[job_id] -= 1
+                    self._lock.notify_all()
+
+broadcast_engine = BroadcastEngine(BROADCAST_WORKERS, send_bucket, chat_limiter)
+
+OUTBOX_WORKERS = getattr(config, 'OUTBOX_WORKERS', 2)
+
+class Outbox:
+    """Background sender for messages that should not block a handler.
+
+    Tasks wait in one heap ordered by priority class (PRIORITY_*), then by
+    arrival, and go out through the shared global and per-chat limits, where
+    an urgent send gets the next token ahead of bulk. A chat has at most one
+    send in flight, so its messages keep their order. A queued edit of a
+    message is replaced by a newer edit of the same message instead of both
+    being sent. call() sends from the calling thread with the same limits,
+    for handlers that need the sent message back.
+    """
+
+    def __init__(self, bucket, chat_limiter, workers=1):
+        self._heap = []
+        self._queued_edits = {}  # (chat_id, message_id) -> задача в очереди
+        self._busy = set()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._bucket = bucket
+        self._chat_limiter = chat_limiter
+        self.coalesced = 0
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, chat_id, send, priority=PRIORITY_NOTICE, key=None):
+        with self._cond:
+            task = self._queued_edits.get(key) if key is not None else None
+            if task is not None:
+                task[3] = send
+                self.coalesced += 1
+                return
+            self._seq += 1
+            task = [priority, self._seq, chat_id, send, key]
+            if key is not None:
+                self._queued_edits[key] = task
+            heapq.heappush(self._heap, task)
+            self._cond.notify()
+
+    def send(self, chat_id, text, priority=PRIORITY_NOTICE, **kwargs):
+        self.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+    def edit(self, chat_id, message_id, text, priority=PRIORITY_NOTICE, **kwargs):
+        self.submit(chat_id, lambda: bot.edit_message_text(text, chat_id, message_id, **kwargs), priority, key=(chat_id, message_id))
+
+    def call(self, chat_id, send, priority=PRIORITY_ACTIVATION):
+        result, errors = [], []
+        def attempt():
+            try:
+                result.append(send())
+            except Exception as e:
+                errors.append(e)
+                raise
+        status, attempts, error = deliver(attempt, chat_id, self._bucket, self._chat_limiter, priority=priority)
+        if status != 'sent':
+            raise errors[-1]
+        return result[0]
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _next_task(self):
+        # Самая срочная задача для чата, в который сейчас ничего не отправляется
+        skipped = []
+        task = None
+        while self._heap:
+            candidate = heapq.heappop(self._heap)
+            if candidate[2] in self._busy:
+                skipped.append(candidate)
+                continue
+            task = candidate
+            break
+        for candidate in skipped:
+            heapq.heappush(self._heap, candidate)
+        return task
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+                priority, _, chat_id, send, key = task
+                if key is not None:
+                    self._queued_edits.pop(key, None)
+                self._busy.add(chat_id)
+            try:
+                status, attempts, error = deliver(send, chat_id, self._bucket, self._chat_limiter, priority=priority)
+                if status != 'sent':
+                    logger.info("outbox message to %s dropped after %d attempts: %s", chat_id, attempts, error)
+            finally:
+                with self._cond:
+                    self._busy.discard(chat_id)
+                    self._cond.notify_all()
+
+outbox = Outbox(send_bucket, chat_limiter, OUTBOX_WORKERS)
+
+@callbacks.route("broadcast")
 def broadcast(call):
     caption = "Выберите тип рассылки"
     markup = types.InlineKeyboardMarkup()
@@ -1011,39 +3036,19 @@ def broadcast(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "normal_broadcast")
+@callbacks.route("normal_broadcast")
 def normal_broadcast(call):
     caption = "Отправьте содержание для обычной рассылки"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="broadcast"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_broadcast)
+    conversations.expect(call.message.chat.id, process_broadcast)
 
+@conversations.step(slow=True)
 def process_broadcast(message):
-    cursor.execute("SELECT id FROM users")
-    users = cursor.fetchall()
-    for u in users:
-        try:
-            if message.photo:
-                bot.send_photo(u[0], message.photo[-1].file_id, caption=message.caption)
-            elif message.sticker:
-                bot.send_sticker(u[0], message.sticker.file_id)
-            elif message.video:
-                bot.send_video(u[0], message.video.file_id, caption=message.caption)
-            elif message.animation:
-                bot.send_animation(u[0], message.animation.file_id, caption=message.caption)
-            elif message.document:
-                bot.send_document(u[0], message.document.file_id, caption=message.caption)
-            elif message.audio:
-                bot.send_audio(u[0], message.audio.file_id, caption=message.caption)
-            else:
-                bot.send_message(u[0], message.text)
-        except:
-            pass
-    bot.send_message(message.chat.id, "Рассылка завершена")
-    log_admin_action(message.chat.id, "Рассылка")
+    broadcast_engine.start_job(message.chat.id, message_payload(message))
 
-@bot.callback_query_handler(func=lambda call: call.data == "mega_broadcast")
+@callbacks.route("mega_broadcast")
 def mega_broadcast(call):
     caption = "Выберите расположение кнопок"
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1054,54 +3059,63 @@ def mega_broadcast(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="broadcast"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("layout_"))
-def select_layout(call):
-    global mega_layout
-    mega_layout = int(call.data.split("_")[1])
+@callbacks.prefix("layout_", int)
+def select_layout(call, layout):
     caption = "Введите формат кнопок:\nназвание кнопки ссылка\n..."
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="mega_broadcast"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_mega_buttons)
+    conversations.expect(call.message.chat.id, process_mega_buttons, layout=layout)
 
-def process_mega_buttons(message):
-    global mega_buttons, mega_layout
-    lines = message.text.split('\n')
+# Черновик мега-рассылки живёт в состоянии чата админа: layout, кнопки [название, ссылка] и содержимое
+@conversations.step
+def process_mega_buttons(message, layout):
+    lines = (message.text or "").split('\n')
     if len(lines) > 10:
         bot.send_message(message.chat.id, "Максимум 10 кнопок")
         return
-    mega_buttons = []
+    buttons = []
     for line in lines:
         parts = line.split()
         if len(parts) < 2:
             continue
         name = ' '.join(parts[:-1])
         url = parts[-1]
-        mega_buttons.append(types.InlineKeyboardButton(name, url=url))
+        buttons.append([name, url])
     bot.send_message(message.chat.id, "Отправьте фото/видео/текст или пропустите")
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Пропустить", callback_data="skip_mega_content"))
+    markup.add(types.InlineKeyboardButton("Пропустить", callback_data="mega_skip_content"))
     bot.send_message(message.chat.id, "Или нажмите пропустить", reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(message.chat.id, process_mega_content)
+    conversations.expect(message.chat.id, process_mega_content, layout=layout, buttons=buttons)
 
-def process_mega_content(message):
-    global mega_content
-    mega_content = message
+@conversations.step
+def process_mega_content(message, layout, buttons):
+    conversations.set(message.chat.id, 'mega_confirm', layout=layout, buttons=buttons, content=message_payload(message))
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Отправить", callback_data="confirm_mega"))
     bot.send_message(message.chat.id, "Подтвердите отправку", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "skip_mega_content")
+@callbacks.route("mega_skip_content")
 def skip_mega_content(call):
-    global mega_content
-    mega_content = None
+    claimed = conversations.claim(call.message.chat.id, 'process_mega_content')
+    if claimed is None:
+        bot.answer_callback_query(call.id, "Черновик рассылки устарел", show_alert=True)
+        return
+    draft = claimed[1]
+    conversations.set(call.message.chat.id, 'mega_confirm', layout=draft['layout'], buttons=draft['buttons'], content=message_payload(None))
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Отправить", callback_data="confirm_mega"))
     bot.send_message(call.message.chat.id, "Подтвердите отправку кнопок без содержания", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_mega")
+@callbacks.route("confirm_mega", slow=True)
 def confirm_mega(call):
-    global mega_buttons, mega_layout, mega_content
+    claimed = conversations.claim(call.message.chat.id, 'mega_confirm')
+    if claimed is None:
+        bot.answer_callback_query(call.id, "Черновик рассылки устарел", show_alert=True)
+        return
+    draft = claimed[1]
+    mega_layout = draft['layout']
+    mega_buttons = [types.InlineKeyboardButton(name, url=url) for name, url in draft['buttons']]
     if not mega_buttons:
         bot.answer_callback_query(call.id, "Нет кнопок", show_alert=True)
         return
@@ -1142,80 +3156,170 @@ def confirm_mega(call):
         for btn in mega_buttons:
             markup.row(btn)
 
-    cursor.execute("SELECT id FROM users")
-    users = cursor.fetchall()
-    for u in users:
-        try:
-            if mega_content is None:
-                bot.send_message(u[0], "Рассылка", reply_markup=markup)
-            elif mega_content.photo:
-                bot.send_photo(u[0], mega_content.photo[-1].file_id, caption=mega_content.caption, reply_markup=markup)
-            elif mega_content.video:
-                bot.send_video(u[0], mega_content.video.file_id, caption=mega_content.caption, reply_markup=markup)
-            elif mega_content.text:
-                bot.send_message(u[0], mega_content.text, reply_markup=markup)
-            # Add other types if needed
-        except:
-            pass
-    bot.send_message(call.message.chat.id, "Мега рассылка завершена")
-    mega_buttons = []
-    mega_layout = None
-    mega_content = None
-
-@bot.callback_query_handler(func=lambda call: call.data == "reminder")
+    broadcast_engine.start_job(call.message.chat.id, dict(draft['content'], reply_markup=markup.to_json()))
+
+@callbacks.route("reminder")
 def reminder(call):
-    queue = sort_queue(get_queue())[:5]
+    queue = number_queue.page(limit=5)
     for i, item in enumerate(queue, 1):
-        bot.send_message(item['user_id'], f"📢 СКОРО АКТИВАЦИЯ ТВОЕГО НОМЕРА\n🗣️⚠️ НОМЕР: {item['phone_number']} ({item['type']}) ({i} в очереди)")
+        outbox.send(item['user_id'], f"📢 СКОРО АКТИВАЦИЯ ТВОЕГО НОМЕРА\n🗣️⚠️ НОМЕР: {item['phone_number']} ({item['type']}) ({i} в очереди)", priority=PRIORITY_BULK)
     bot.answer_callback_query(call.id, "Напоминания отправлены")
     log_admin_action(call.from_user.id, "Напоминалка")
 
-@bot.callback_query_handler(func=lambda call: call.data == "clear_stats")
+@callbacks.route("clear_stats")
 def clear_stats(call):
     caption = "Введите пароль (098890)"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_clear_stats)
+    conversations.expect(call.message.chat.id, process_clear_stats)
 
+@conversations.step
 def process_clear_stats(message):
     if message.text != "098890":
         bot.send_message(message.chat.id, "Неверный пароль")
         return
-    cursor.execute("DELETE FROM successful")
-    conn.commit()
+    with transaction() as cur:
+        cur.execute("DELETE FROM successful")
+        cur.execute("UPDATE users SET pending_payout = 0 WHERE pending_payout != 0")
+        invalidate_user()
+        payout_total.invalidate()
     bot.send_message(message.chat.id, "Статистика очищена")
     log_admin_action(message.chat.id, "Очистка статистики")
 
-@bot.callback_query_handler(func=lambda call: call.data == "clear_queue")
+@callbacks.route("clear_queue")
 def clear_queue(call):
     caption = "Введите пароль (098890)"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_clear_queue)
+    conversations.expect(call.message.chat.id, process_clear_queue)
 
+@conversations.step
 def process_clear_queue(message):
     if message.text != "098890":
         bot.send_message(message.chat.id, "Неверный пароль")
         return
-    cursor.execute("DELETE FROM queue")
-    conn.commit()
+    number_queue.clear()
     bot.send_message(message.chat.id, "Очередь очищена")
     log_admin_action(message.chat.id, "Очистка очереди")
 
-@bot.callback_query_handler(func=lambda call: call.data == "report")
+EXPORT_BATCH = 1000
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024  # до этого размера выгрузка держится в памяти, дальше — во временном файле
+
+# Описание выгрузки: line=None пишет CSV с header, иначе line(row) возвращает текст записи.
+# {where} в sql заменяется условиями из where и фильтров по времени/пользователю.
+# partitions — вид месячных логов: запрос ({table}) выполняется по каждой партиции из периода по очереди.
+Export = namedtuple('Export', ['filename', 'sql', 'where', 'header', 'line', 'time_column', 'user_column', 'empty', 'path', 'partitions'],
+                    defaults=((), None, None, None, None, None, DB_PATH, None))
+
+export_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='export')
+
+def export_filters(parts):
+    # [@юзернейм] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] -> (user_id, since, until); ValueError при ошибке
+    user_id, dates = None, []
+    for part in parts:
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", part):
+            dates.append(tz.localize(datetime.strptime(part, "%Y-%m-%d")))
+        else:
+            user_id = find_user_id(part.lstrip('@'))
+            if not user_id:
+                raise ValueError(f"Пользователь {part} не найден")
+    if len(dates) > 2:
+        raise ValueError("Слишком много дат")
+    since = dates[0] if dates else None
+    until = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+    return user_id, since, until
+
+def write_export(spec, out, user_id=None, since=None, until=None):
+    conditions, params = list(spec.where), []
+    if user_id is not None and spec.user_column:
+        conditions.append(f"{spec.user_column} = ?")
+        params.append(user_id)
+    if since is not None and spec.time_column:
+        conditions.append(f"{spec.time_column} >= ?")
+        params.append(since)
+    if until is not None and spec.time_column:
+        conditions.append(f"{spec.time_column} < ?")
+        params.append(until)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    writer = csv.writer(out) if spec.line is None else None
+    if writer and spec.header:
+        writer.writerow(spec.header)
+    count = 0
+    tables = log_partitions.tables(spec.partitions, since, until) if spec.partitions else [None]
+    for table in tables:
+        cur = get_conn(spec.path).execute(spec.sql.format(where=where, table=table), params)
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                out.writelines(spec.line(row) for row in rows)
+            count += len(rows)
+    if not count and spec.empty:
+        out.write(spec.empty)
+    return count
+
+def run_export(chat_id, spec, user_id=None, since=None, until=None):
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as buffer:
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as gz, io.TextIOWrapper(gz, encoding='utf-8', newline='') as out:
+                count = write_export(spec, out, user_id, since, until)
+            buffer.seek(0)
+            bot.send_document(chat_id, buffer, visible_file_name=f"{spec.filename}.gz")
+        logger.info("export %s: %d rows to %s", spec.filename, count, chat_id)
+    except Exception:
+        logger.exception("export %s failed", spec.filename)
+        bot.send_message(chat_id, "Не удалось сформировать выгрузку")
+
+def start_export(chat_id, spec, user_id=None, since=None, until=None):
+    # Выгрузка идёт в отдельном потоке, обработчик сразу освобождается
+    export_executor.submit(run_export, chat_id, spec, user_id, since, until)
+
+LOGS_EXPORT = Export("all_logs.csv", "SELECT * FROM {table} {where} ORDER BY id", header=['id', 'user_id', 'action', 'timestamp'],
+                     time_column='timestamp', user_column='user_id', path=LOG_DB_PATH, partitions='logs')
+ADMIN_LOGS_EXPORT = Export("admin_logs.csv", "SELECT * FROM {table} {where} ORDER BY id", header=['id', 'admin_id', 'action', 'timestamp'],
+                           time_column='timestamp', user_column='admin_id', path=LOG_DB_PATH, partitions='admin_logs')
+LOG_ROLLUPS_EXPORT = Export("log_rollups.csv", "SELECT kind, day, user_id, actions FROM log_rollups {where} ORDER BY day, user_id",
+                            header=['kind', 'day', 'user_id', 'actions'], user_column='user_id', path=LOG_DB_PATH)
+
+def _card_history_line(r):
+    sign = '+' if r[3] in ['deposit', 'transfer_in'] else '-'
+    return f"{r[0]} {sign}{abs(r[1])} {r[2]} {r[3]}\n"
+
+CARD_HISTORY_EXPORT = Export("card_history.txt", "SELECT u.username, h.amount, h.timestamp, h.type, h.id FROM card_history h JOIN users u ON h.user_id = u.id {where} ORDER BY h.timestamp DESC",
+                             line=_card_history_line, time_column='h.timestamp', user_column='h.user_id')
+
+EXPORTS = {'logs': LOGS_EXPORT, 'admin_logs': ADMIN_LOGS_EXPORT, 'log_rollups': LOG_ROLLUPS_EXPORT, 'card_history': CARD_HISTORY_EXPORT}
+
+@bot.message_handler(commands=['export'])
+def export_cmd(message):
+    if not is_admin(message.chat.id):
+        return
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1] not in EXPORTS:
+        bot.send_message(message.chat.id, f"Формат /export {'|'.join(EXPORTS)} [юзернейм] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    try:
+        user_id, since, until = export_filters(parts[2:])
+    except ValueError as e:
+        bot.send_message(message.chat.id, str(e))
+        return
+    start_export(message.chat.id, EXPORTS[parts[1]], user_id, since, until)
+    bot.send_message(message.chat.id, "Выгрузка формируется")
+    log_admin_action(message.chat.id, f"Выгрузка {' '.join(parts[1:])}")
+
+@callbacks.route("report", slow=True)
 def report(call):
-    stats = get_successful()
-    text = "\n".join(f"{get_user(item['user_id'])['username']}-{item['phone_number']} ({item['type']})-холд: {item['hold_time']}" for item in stats if item['hold_time'])
-    if not text:
-        text = "Нет данных"
-    with open("report.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("report.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "report.txt", "SELECT u.username, s.phone_number, s.type, s.hold_minutes FROM successful s LEFT JOIN users u ON u.id = s.user_id {where} ORDER BY s.id",
+        where=["s.hold_minutes IS NOT NULL"], line=lambda r: f"{r[0]}-{r[1]} ({r[2]})-холд: {format_hold(r[3])}\n", empty="Нет данных"))
     log_admin_action(call.from_user.id, "Отчёт")
 
-@bot.callback_query_handler(func=lambda call: call.data == "change_status")
+@callbacks.route("change_status")
 def change_status(call):
     caption = "Выберите статус"
     markup = types.InlineKeyboardMarkup()
@@ -1225,21 +3329,21 @@ def change_status(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("set_status_"))
-def set_status_call(call):
-    status = call.data.split("_")[2]
+@callbacks.prefix("set_status_", str)
+def set_status_call(call, status):
     set_status('work_status', status)
     bot.answer_callback_query(call.id, "Статус изменен")
     log_admin_action(call.from_user.id, f"Изменен статус на {status}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_rep")
+@callbacks.route("give_rep")
 def give_rep(call):
     caption = "Введите репутация юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_rep)
+    conversations.expect(call.message.chat.id, process_give_rep)
 
+@conversations.step
 def process_give_rep(message):
     parts = message.text.split()
     if len(parts) != 2 or not parts[0].replace('.', '', 1).isdigit():
@@ -1247,24 +3351,23 @@ def process_give_rep(message):
         return
     rep = float(parts[0])
     username = parts[1].lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     update_user(user_id, reputation=rep)
     bot.send_message(message.chat.id, "Репутация выдана")
     log_admin_action(message.chat.id, f"Выдал репутацию {rep} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_balance")
+@callbacks.route("give_balance")
 def give_balance(call):
     caption = "Введите сумма юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_balance)
+    conversations.expect(call.message.chat.id, process_give_balance)
 
+@conversations.step
 def process_give_balance(message):
     parts = message.text.split()
     if len(parts) != 2 or not parts[0].replace('.', '', 1).isdigit():
@@ -1272,32 +3375,30 @@ def process_give_balance(message):
         return
     amount = float(parts[0])
     username = parts[1].lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     update_user(user_id, balance=amount)
     bot.send_message(message.chat.id, "Баланс пополнен")
     log_admin_action(message.chat.id, f"Пополнил баланс {amount} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "subs_users")
+@callbacks.route("subs_users")
 def subs_users(call):
-    cursor.execute("SELECT username FROM users WHERE subscription_type IS NOT NULL")
-    users = cursor.fetchall()
+    users = query_all("SELECT username FROM users WHERE subscription_type IS NOT NULL")
     text = "\n".join(u[0] for u in users)
     bot.send_message(call.message.chat.id, text or "Нет пользователей с подпиской")
     log_admin_action(call.from_user.id, "Проверил пользователей с подпиской")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_sub")
+@callbacks.route("give_sub")
 def give_sub(call):
     caption = "Введите юзернейм подписка месяцы"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_sub)
+    conversations.expect(call.message.chat.id, process_give_sub)
 
+@conversations.step
 def process_give_sub(message):
     parts = message.text.split()
     if len(parts) < 3 or not parts[-1].isdigit() or int(parts[-1]) not in range(1,13):
@@ -1309,31 +3410,30 @@ def process_give_sub(message):
     if sub_type not in config.SUBSCRIPTIONS:
         bot.send_message(message.chat.id, "Неверная подписка")
         return
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     end = datetime.now(tz) + timedelta(days=30*months)
     update_user(user_id, subscription_type=sub_type, subscription_end=end)
     bot.send_message(message.chat.id, "Подписка выдана")
     log_admin_action(message.chat.id, f"Выдал подписку {sub_type} на {months} мес {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "manage_sub")
+@callbacks.route("manage_sub")
 def manage_sub(call):
     caption = "Управление подпиской\nВведите действие: изменить_цену подписка цена, изменить_описание подписка текст и т.д."
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_manage_sub)
+    conversations.expect(call.message.chat.id, process_manage_sub)
 
+@conversations.step
 def process_manage_sub(message):
     # Placeholder
     bot.send_message(message.chat.id, "Действие выполнено (placeholder)")
     log_admin_action(message.chat.id, f"Управление подпиской: {message.text}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "bot_settings")
+@callbacks.route("bot_settings")
 def bot_settings(call):
     caption = "Настройки бота"
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1348,139 +3448,117 @@ def bot_settings(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "add_admin")
+@callbacks.route("add_admin")
 def add_admin(call):
     caption = "Введите ID админа"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="bot_settings"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_add_admin)
+    conversations.expect(call.message.chat.id, process_add_admin)
 
+@conversations.step
 def process_add_admin(message):
     try:
         admin_id = int(message.text)
-        cursor.execute("INSERT OR IGNORE INTO admins (id) VALUES (?)", (admin_id,))
-        conn.commit()
-        bot.send_message(message.chat.id, "Админ добавлен")
-        log_admin_action(message.chat.id, f"Добавил админа {admin_id}")
-    except:
+    except (TypeError, ValueError):
         bot.send_message(message.chat.id, "Неверный ID")
+        return
+    settings.add_admin(admin_id)
+    bot.send_message(message.chat.id, "Админ добавлен")
+    log_admin_action(message.chat.id, f"Добавил админа {admin_id}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "remove_admin")
+@callbacks.route("remove_admin")
 def remove_admin(call):
     caption = "Введите ID админа"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="bot_settings"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_remove_admin)
+    conversations.expect(call.message.chat.id, process_remove_admin)
 
+@conversations.step
 def process_remove_admin(message):
     try:
         admin_id = int(message.text)
-        cursor.execute("DELETE FROM admins WHERE id = ?", (admin_id,))
-        conn.commit()
-        bot.send_message(message.chat.id, "Админ удален")
-        log_admin_action(message.chat.id, f"Удалил админа {admin_id}")
-    except:
+    except (TypeError, ValueError):
         bot.send_message(message.chat.id, "Неверный ID")
+        return
+    settings.remove_admin(admin_id)
+    bot.send_message(message.chat.id, "Админ удален")
+    log_admin_action(message.chat.id, f"Удалил админа {admin_id}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "list_admins")
+@callbacks.route("list_admins", slow=True)
 def list_admins(call):
-    cursor.execute("SELECT id FROM admins")
-    admins = cursor.fetchall()
-    text = "\n".join(get_user(a[0])['username'] for a in admins if get_user(a[0]))
-    with open("admins.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("admins.txt", "rb"))
+    admins = settings.get('admins')
+    start_export(call.message.chat.id, Export(
+        "admins.txt", "SELECT username FROM users {where} ORDER BY id",
+        where=[f"id IN ({','.join(str(int(a)) for a in admins) or 'NULL'})"], line=lambda r: f"{r[0]}\n"))
     log_admin_action(call.from_user.id, "Список админов")
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_logs_file")
+@callbacks.route("admin_logs_file", slow=True)
 def admin_logs_file(call):
-    cursor.execute("SELECT * FROM admin_logs")
-    rows = cursor.fetchall()
-    with open("admin_logs.csv", "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['id', 'admin_id', 'action', 'timestamp'])
-        writer.writerows(rows)
-    bot.send_document(call.message.chat.id, open("admin_logs.csv", "rb"))
+    start_export(call.message.chat.id, ADMIN_LOGS_EXPORT)
     log_admin_action(call.from_user.id, "Лог админов")
 
-@bot.callback_query_handler(func=lambda call: call.data == "all_logs")
+@callbacks.route("all_logs", slow=True)
 def all_logs(call):
-    cursor.execute("SELECT * FROM logs")
-    rows = cursor.fetchall()
-    with open("all_logs.csv", "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['id', 'user_id', 'action', 'timestamp'])
-        writer.writerows(rows)
-    bot.send_document(call.message.chat.id, open("all_logs.csv", "rb"))
+    start_export(call.message.chat.id, LOGS_EXPORT)
     log_admin_action(call.from_user.id, "All log")
 
-@bot.callback_query_handler(func=lambda call: call.data == "flight_settings")
+@callbacks.route("flight_settings")
 def flight_settings(call):
-    caption = f"Текущий минимальный холд для выплат: {MIN_HOLD_MINUTES} минут\nВведите новое значение (целое число):"
+    caption = f"Текущий минимальный холд для выплат: {settings.get('min_hold_minutes')} минут\nВведите новое значение (целое число):"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="bot_settings"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_flight_settings)
+    conversations.expect(call.message.chat.id, process_flight_settings)
 
+@conversations.step
 def process_flight_settings(message):
-    global MIN_HOLD_MINUTES
     try:
         new_min = int(message.text)
-        if new_min > 0:
-            MIN_HOLD_MINUTES = new_min
-            try:
-                config.MIN_HOLD_MINUTES = new_min
-            except Exception:
-                pass
-            bot.send_message(message.chat.id, f"Минимальный холд установлен на {new_min} минут")
-            log_admin_action(message.chat.id, f"Изменен мин холд на {new_min}")
-        else:
-            bot.send_message(message.chat.id, "Значение должно быть положительным")
-    except:
+    except (TypeError, ValueError):
         bot.send_message(message.chat.id, "Неверный формат")
+        return
+    if new_min > 0:
+        settings.set('min_hold_minutes', new_min)
+        bot.send_message(message.chat.id, f"Минимальный холд установлен на {new_min} минут")
+        log_admin_action(message.chat.id, f"Изменен мин холд на {new_min}")
+    else:
+        bot.send_message(message.chat.id, "Значение должно быть положительным")
 
-@bot.callback_query_handler(func=lambda call: call.data == "user_logs")
+@callbacks.route("user_logs")
 def user_logs(call):
-    caption = "Введите юзернейм"
+    caption = "Введите юзернейм (можно добавить период: с ГГГГ-ММ-ДД по ГГГГ-ММ-ДД)"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="bot_settings"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_user_logs)
+    conversations.expect(call.message.chat.id, process_user_logs)
 
+@conversations.step(slow=True)
 def process_user_logs(message):
-    username = message.text.lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    parts = (message.text or "").split()
+    username = parts[0].lstrip('@') if parts else ""
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
-    cursor.execute("SELECT * FROM logs WHERE user_id = ?", (user_id,))
-    rows = cursor.fetchall()
-    with open(f"{username}_logs.csv", "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['id', 'user_id', 'action', 'timestamp'])
-        writer.writerows(rows)
-    bot.send_document(message.chat.id, open(f"{username}_logs.csv", "rb"))
+    try:
+        _, since, until = export_filters(parts[1:])
+    except ValueError as e:
+        bot.send_message(message.chat.id, str(e))
+        return
+    start_export(message.chat.id, LOGS_EXPORT._replace(filename=f"{username}_logs.csv"), user_id, since, until)
     log_admin_action(message.chat.id, f"Логи {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "cards_data")
+@callbacks.route("cards_data", slow=True)
 def cards_data(call):
-    cursor.execute("SELECT username, card_number, cvv, api_token, card_password, card_balance, card_status FROM users WHERE card_number IS NOT NULL")
-    rows = cursor.fetchall()
-    text = ""
-    for row in rows:
-        text += f"Юзернейм- {row[0]}\nНомер карты- {row[1]}\nCvv код- {row[2]}\nАпи токен- {row[3]}\nПароль- {row[4]}\nБаланс- {row[5]}\nСтатус карты- {row[6]}\n\n"
-    if not text:
-        text = "Нет карт"
-    with open("cards_data.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("cards_data.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "cards_data.txt", "SELECT username, card_number, cvv, api_token, card_password, card_balance, card_status FROM users {where}",
+        where=["card_number IS NOT NULL"], empty="Нет карт",
+        line=lambda row: f"Юзернейм- {row[0]}\nНомер карты- {row[1]}\nCvv код- {row[2]}\nАпи токен- {row[3]}\nПароль- {row[4]}\nБаланс- {row[5]}\nСтатус карты- {row[6]}\n\n"))
     log_admin_action(call.from_user.id, "Данные карт")
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_referral")
+@callbacks.route("admin_referral")
 def admin_referral(call):
     caption = "Реферальная система админ"
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1493,36 +3571,35 @@ def admin_referral(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "ref_report")
+@callbacks.route("ref_report", slow=True)
 def ref_report(call):
-    cursor.execute("SELECT username, balance, referrals_count, profit_level FROM users")
-    rows = cursor.fetchall()
-    text = "\n".join(f"▶{r[0]}-\n▶Баланс- {r[1]}\n▶Рефералы- {r[2]}\n▶Профит- {r[3]}" for r in rows)
-    with open("ref_report.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("ref_report.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "ref_report.txt", "SELECT username, balance, referrals_count, profit_level FROM users {where}",
+        line=lambda r: f"▶{r[0]}-\n▶Баланс- {r[1]}\n▶Рефералы- {r[2]}\n▶Профит- {r[3]}\n"))
     log_admin_action(call.from_user.id, "Отчет по рефералам")
 
-@bot.callback_query_handler(func=lambda call: call.data == "ref_requests")
+@callbacks.route("ref_requests")
 def ref_requests(call):
-    cursor.execute("SELECT * FROM withdraw_requests WHERE status = 'pending'")
-    requests = cursor.fetchall()
-    if not requests:
+    if not query_one("SELECT 1 FROM withdraw_requests WHERE status = 'pending' LIMIT 1"):
         bot.answer_callback_query(call.id, "Нет заявок")
         return
+    ref_requests_view.show(call.message.chat.id, call.message.message_id)
+
+def render_ref_requests(chat_id, message_id, requests, nav):
     markup = types.InlineKeyboardMarkup()
     for req in requests:
-        user = get_user(req[1])
-        button_text = f"Заявка {req[0]} от {user['username']}"
-        markup.add(types.InlineKeyboardButton(button_text, callback_data=f"view_req_{req[0]}"))
+        button_text = f"Заявка {req['id']} от {req['username']}"
+        markup.add(types.InlineKeyboardButton(button_text, callback_data=f"view_req_{req['id']}"))
+    add_nav(markup, nav)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_referral"))
-    bot.edit_message_text("Заявки", call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.edit_message_text("Заявки", chat_id, message_id, reply_markup=markup)
+
+ref_requests_view = PagedView("rr", KeysetQuery("r.id, u.username", "withdraw_requests r LEFT JOIN users u ON u.id = r.user_id",
+                                                ["r.id"], where=["r.status = 'pending'"]), render_ref_requests, allow=is_admin)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("view_req_"))
-def view_req(call):
-    req_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT * FROM withdraw_requests WHERE id = ?", (req_id,))
-    req = cursor.fetchone()
+@callbacks.prefix("view_req_", int)
+def view_req(call, req_id):
+    req = query_one("SELECT * FROM withdraw_requests WHERE id = ?", (req_id,))
     user = get_user(req[1])
     caption = f"Юзернейм: {user['username']}\nСумма выплата: {req[2]}\nПрофит: {user['profit_level']}\nРефералы: {user['referrals_count']}"
     markup = types.InlineKeyboardMarkup()
@@ -1531,34 +3608,31 @@ def view_req(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="ref_requests"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("close_req_"))
-def close_req(call):
-    req_id = int(call.data.split("_")[2])
-    cursor.execute("UPDATE withdraw_requests SET status = 'closed' WHERE id = ?", (req_id,))
-    conn.commit()
+@callbacks.prefix("close_req_", int)
+def close_req(call, req_id):
+    execute("UPDATE withdraw_requests SET status = 'closed' WHERE id = ?", (req_id,))
     bot.answer_callback_query(call.id, "Заявка закрыта")
     log_admin_action(call.from_user.id, f"Закрыл заявку {req_id}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("paid_req_"))
-def paid_req(call):
-    req_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT user_id, amount FROM withdraw_requests WHERE id = ?", (req_id,))
-    req = cursor.fetchone()
-    update_user(req[0], balance = get_user(req[0])['balance'] - req[1])
-    cursor.execute("UPDATE withdraw_requests SET status = 'paid' WHERE id = ?", (req_id,))
-    conn.commit()
+@callbacks.prefix("paid_req_", int)
+def paid_req(call, req_id):
+    req = query_one("SELECT user_id, amount FROM withdraw_requests WHERE id = ?", (req_id,))
+    with transaction() as cur:
+        update_user(req[0], balance = get_user(req[0])['balance'] - req[1])
+        cur.execute("UPDATE withdraw_requests SET status = 'paid' WHERE id = ?", (req_id,))
     bot.send_message(req[0], "Выплата одобрена ✔️")
     bot.answer_callback_query(call.id, "Оплачено")
     log_admin_action(call.from_user.id, f"Оплачено заявка {req_id}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_profit")
+@callbacks.route("give_profit")
 def give_profit(call):
     caption = "Введите юзернейм профит"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_referral"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_profit)
+    conversations.expect(call.message.chat.id, process_give_profit)
 
+@conversations.step
 def process_give_profit(message):
     parts = message.text.split()
     if len(parts) < 2:
@@ -1566,24 +3640,23 @@ def process_give_profit(message):
         return
     username = parts[0].lstrip('@')
     profit = ' '.join(parts[1:])
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     update_user(user_id, profit_level=profit)
     bot.send_message(message.chat.id, "Профит выдан")
     log_admin_action(message.chat.id, f"Выдал профит {profit} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_refs")
+@callbacks.route("give_refs")
 def give_refs(call):
     caption = "Введите юзернейм рефералы"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_referral"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_refs)
+    conversations.expect(call.message.chat.id, process_give_refs)
 
+@conversations.step
 def process_give_refs(message):
     parts = message.text.split()
     if len(parts) != 2 or not parts[1].isdigit():
@@ -1591,49 +3664,46 @@ def process_give_refs(message):
         return
     username = parts[0].lstrip('@')
     refs = int(parts[1])
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     update_user(user_id, referrals_count=refs)
     profit = get_profit_level(refs, is_admin=is_admin(user_id))
     update_user(user_id, profit_level=profit)
     bot.send_message(message.chat.id, "Рефералы выданы")
     log_admin_action(message.chat.id, f"Выдал рефералов {refs} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "payout_report")
+@callbacks.route("payout_report", slow=True)
 def payout_report(call):
-    cursor.execute("SELECT * FROM withdraw_requests WHERE status = 'paid'")
-    rows = cursor.fetchall()
-    text = ""
-    for r in rows:
-        user = get_user(r[1])
-        text += f"▶ Юзернейм: {user['username']}\n▶ Дата: {datetime.now(tz)}\n▶ Сумма запроса на выплату: {r[2]}\n▶ Сумма выплаты: {r[2]}\n▶ Рефералы: {user['referrals_count']}\n▶ Профит: {user['profit_level']}\n╓ админ: {get_user(call.from_user.id)['username']}\n║ \n╚ время: {datetime.now(tz).strftime('%H:%M:%S')}\n\n"
-    with open("payout_report.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("payout_report.txt", "rb"))
+    admin_name = get_user(call.from_user.id)['username']
+    now = datetime.now(tz)
+    start_export(call.message.chat.id, Export(
+        "payout_report.txt", "SELECT u.username, r.amount, u.referrals_count, u.profit_level FROM withdraw_requests r JOIN users u ON u.id = r.user_id {where} ORDER BY r.id",
+        where=["r.status = 'paid'"],
+        line=lambda r: f"▶ Юзернейм: {r[0]}\n▶ Дата: {now}\n▶ Сумма запроса на выплату: {r[1]}\n▶ Сумма выплаты: {r[1]}\n▶ Рефералы: {r[2]}\n▶ Профит: {r[3]}\n╓ админ: {admin_name}\n║ \n╚ время: {now.strftime('%H:%M:%S')}\n\n"))
     log_admin_action(call.from_user.id, "Отчет по выплатам")
 
-@bot.callback_query_handler(func=lambda call: call.data == "ref_settings")
+@callbacks.route("ref_settings")
 def ref_settings(call):
     caption = "Введите новую цену за реферала"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_referral"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_ref_settings)
+    conversations.expect(call.message.chat.id, process_ref_settings)
 
+@conversations.step
 def process_ref_settings(message):
     try:
         new_price = float(message.text)
-        config.REFERRAL_REWARD = new_price
-        bot.send_message(message.chat.id, "Цена изменена")
-        log_admin_action(message.chat.id, f"Изменена цена рефералки на {new_price}")
-    except:
+    except (TypeError, ValueError):
         bot.send_message(message.chat.id, "Неверный формат")
+        return
+    settings.set('referral_reward', new_price)
+    bot.send_message(message.chat.id, "Цена изменена")
+    log_admin_action(message.chat.id, f"Изменена цена рефералки на {new_price}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "manage_cards")
+@callbacks.route("manage_cards")
 def manage_cards(call):
     caption = "Управления картами"
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1655,24 +3725,22 @@ def manage_cards(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="admin_extra"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "view_transfers")
+@callbacks.route("view_transfers")
 def view_transfers(call):
     caption = "Введите юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="manage_cards"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_view_transfers)
+    conversations.expect(call.message.chat.id, process_view_transfers)
 
+@conversations.step
 def process_view_transfers(message):
     username = message.text.lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
-    cursor.execute("SELECT from_user_id, to_user_id, amount, timestamp FROM transfers WHERE from_user_id = ? OR to_user_id = ?", (user_id, user_id))
-    rows = cursor.fetchall()
+    rows = query_all("SELECT from_user_id, to_user_id, amount, timestamp FROM transfers WHERE from_user_id = ? OR to_user_id = ?", (user_id, user_id))
     if not rows:
         bot.send_message(message.chat.id, "Нет переводов")
         return
@@ -1685,128 +3753,114 @@ def process_view_transfers(message):
     bot.send_message(message.chat.id, text)
     log_admin_action(message.chat.id, f"Просмотр переводов {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "card_db")
+@callbacks.route("card_db", slow=True)
 def card_db(call):
-    cursor.execute("SELECT username, card_number, cvv, card_password, card_activation_date FROM users WHERE card_number IS NOT NULL")
-    rows = cursor.fetchall()
-    text = ""
-    for row in rows:
-        text += f"{row[0]}\n{row[1]}\n{row[2]}\n{row[3]}\n{row[4]}\n\n"
-    if not text:
-        text = "Нет карт"
-    with open("cards_db.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("cards_db.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "cards_db.txt", "SELECT username, card_number, cvv, card_password, card_activation_date FROM users {where}",
+        where=["card_number IS NOT NULL"], empty="Нет карт", line=lambda row: f"{row[0]}\n{row[1]}\n{row[2]}\n{row[3]}\n{row[4]}\n\n"))
     log_admin_action(call.from_user.id, "Просмотр бд карт")
 
-@bot.callback_query_handler(func=lambda call: call.data == "block_card_admin")
+@callbacks.route("block_card_admin")
 def block_card_admin(call):
     caption = "Введите юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="manage_cards"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_block_card_admin)
+    conversations.expect(call.message.chat.id, process_block_card_admin)
 
+@conversations.step
 def process_block_card_admin(message):
     username = message.text.lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
-    user = get_user(user_id)
-    balance = user['card_balance']
-    if balance > 0:
-        cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
-        conn.commit()
-    update_user(user_id, card_status='blocked', block_reason='admin', card_balance=0.0, card_number=None, cvv=None, card_password=None, api_token=None, card_activation_date=None)
+    with transaction() as cur:
+        user = get_user(user_id)
+        balance = user['card_balance']
+        if balance > 0:
+            cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
+        update_user(user_id, card_status='blocked', block_reason='admin', card_balance=0.0, card_number=None, cvv=None, card_password=None, api_token=None, card_activation_date=None)
     bot.send_message(message.chat.id, "Карта заблокирована администратором")
     log_admin_action(message.chat.id, f"Заблокировал карту {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "unblock_card_admin")
+@callbacks.route("unblock_card_admin")
 def unblock_card_admin(call):
     caption = "Введите юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="manage_cards"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_unblock_card_admin)
+    conversations.expect(call.message.chat.id, process_unblock_card_admin)
 
+@conversations.step
 def process_unblock_card_admin(message):
     username = message.text.lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
     update_user(user_id, card_status='inactive', block_reason=None)
     bot.send_message(message.chat.id, "Карта разблокирована, пользователь может активировать заново")
     log_admin_action(message.chat.id, f"Разблокировал карту {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "payout_cards")
+def csv_file(header, rows):
+    # CSV во временном файле (в памяти, пока небольшой), готовый к отправке
+    buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    out = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    writer = csv.writer(out)
+    writer.writerow(header)
+    writer.writerows(rows)
+    out.detach()
+    buffer.seek(0)
+    return buffer
+
+@callbacks.route("payout_cards", slow=True)
 def payout_cards(call):
-    # Backup successful table to CSV
-    cursor.execute("SELECT * FROM successful")
-    rows = cursor.fetchall()
-    backup_filename = f"successful_backup_{datetime.now(tz).strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-    with open(backup_filename, "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['id', 'user_id', 'phone_number', 'hold_time', 'acceptance_time', 'flight_time', 'type'])
-        writer.writerows(rows)
-    bot.send_document(call.message.chat.id, open(backup_filename, "rb"))
-
-    # Generate report with payouts
-    stats = get_successful()
-    report_filename = f"payout_report_{datetime.now(tz).strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-    with open(report_filename, "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['username', 'phone_number', 'type', 'hold_time', 'payout'])
-        payouts = {}
-        for item in stats:
-            user_id = item['user_id']
-            user = get_user(user_id)
-            sub = user['subscription_type']
-            hour_price, min30_price = get_price_increase(sub)
-            hold = item['hold_time']
-            if hold:
-                hours, mins = map(int, hold.split(':'))
-                payout = hours * hour_price + (mins // 30) * min30_price
-                if user_id not in payouts:
-                    payouts[user_id] = 0
-                payouts[user_id] += payout
-                writer.writerow([user['username'], item['phone_number'], item['type'], hold, payout])
-
-    for user_id, total_payout in payouts.items():
-        user = get_user(user_id)
-        update_user(user_id, card_balance=user['card_balance'] + total_payout)
-        cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, total_payout, datetime.now(tz), 'deposit'))
-        bot.send_message(user_id, f"Вам пришла выплата {total_payout}$")
-
-    conn.commit()
-
-    bot.send_document(call.message.chat.id, open(report_filename, "rb"))
-    # Send to group/channel
-    try:
-        bot.send_document(config.CHANNEL, open(report_filename, "rb"))
-    except:
-        pass  # If fails, ignore
-
-    # Clear successful table
-    cursor.execute("DELETE FROM successful")
-    conn.commit()
+    now = datetime.now(tz)
+    stamp = now.strftime('%Y-%m-%d_%H-%M-%S')
+    # BEGIN IMMEDIATE держит блокировку записи: между чтением и очисткой successful новых строк не появится
+    with transaction() as cur:
+        rows = cur.execute("""SELECT s.id, s.user_id, s.phone_number, s.hold_minutes, s.payout, s.acceptance_time, s.flight_time, s.type, u.username
+                              FROM successful s LEFT JOIN users u ON u.id = s.user_id ORDER BY s.id""").fetchall()
+        # Суммы уже накоплены в users.pending_payout при каждом слёте
+        payouts = cur.execute("SELECT id, pending_payout FROM users WHERE pending_payout > 0").fetchall()
+        cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) SELECT id, pending_payout, ?, 'deposit' FROM users WHERE pending_payout > 0", (now,))
+        cur.execute("UPDATE users SET card_balance = card_balance + pending_payout, pending_payout = 0 WHERE pending_payout > 0")
+        cur.execute("DELETE FROM successful")
+        invalidate_user()
+        payout_total.invalidate()
+
+    for user_id, total_payout in payouts:
+        outbox.send(user_id, f"Вам пришла выплата {total_payout}$")
+
+    # Файлы собираются уже после коммита и живут только до отправки
+    backup = csv_file(['id', 'user_id', 'phone_number', 'hold_minutes', 'payout', 'acceptance_time', 'flight_time', 'type'],
+                      (row[:8] for row in rows))
+    report = csv_file(['username', 'phone_number', 'type', 'hold_time', 'payout'],
+                      ([row['username'], row['phone_number'], row['type'], format_hold(row['hold_minutes']), row['payout']]
+                       for row in rows if row['hold_minutes'] is not None))
+    with backup, report:
+        bot.send_document(call.message.chat.id, backup, visible_file_name=f"successful_backup_{stamp}.csv")
+        bot.send_document(call.message.chat.id, report, visible_file_name=f"payout_report_{stamp}.csv")
+        # Send to group/channel
+        try:
+            report.seek(0)
+            bot.send_document(config.CHANNEL, report, visible_file_name=f"payout_report_{stamp}.csv")
+        except Exception as e:
+            logger.warning("payout report to channel failed: %s", e)
 
     bot.answer_callback_query(call.id, "Выплаты начислены, отчет отправлен, статистика очищена")
     log_admin_action(call.from_user.id, "Начислил выплаты на карты")
 
-@bot.callback_query_handler(func=lambda call: call.data == "give_card_balance")
+@callbacks.route("give_card_balance")
 def give_card_balance(call):
     caption = "Введите сумма юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="manage_cards"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_give_card_balance)
+    conversations.expect(call.message.chat.id, process_give_card_balance)
 
+@conversations.step
 def process_give_card_balance(message):
     parts = message.text.split()
     if len(parts) != 2 or not parts[0].replace('.', '', 1).isdigit():
@@ -1814,28 +3868,27 @@ def process_give_card_balance(message):
         return
     amount = float(parts[0])
     username = parts[1].lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
-    user = get_user(user_id)
-    update_user(user_id, card_balance=user['card_balance'] + amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, amount, datetime.now(tz), 'deposit'))
-    conn.commit()
+    with transaction() as cur:
+        user = get_user(user_id)
+        update_user(user_id, card_balance=user['card_balance'] + amount)
+        cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, amount, datetime.now(tz), 'deposit'))
     bot.send_message(user_id, f"Вам пришла выплата {amount}$")
     bot.send_message(message.chat.id, "Баланс выдан")
     log_admin_action(message.chat.id, f"Выдал баланс карты {amount} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "deduct_card_balance")
+@callbacks.route("deduct_card_balance")
 def deduct_card_balance(call):
     caption = "Введите сумма юзернейм"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="manage_cards"))
     bot.edit_message_text(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_deduct_card_balance)
+    conversations.expect(call.message.chat.id, process_deduct_card_balance)
 
+@conversations.step
 def process_deduct_card_balance(message):
     parts = message.text.split()
     if len(parts) != 2 or not parts[0].replace('.', '', 1).isdigit():
@@ -1843,110 +3896,84 @@ def process_deduct_card_balance(message):
         return
     amount = float(parts[0])
     username = parts[1].lstrip('@')
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = find_user_id(username)
+    if not user_id:
         bot.send_message(message.chat.id, "Пользователь не найден")
         return
-    user_id = row[0]
-    user = get_user(user_id)
-    new_balance = user['card_balance'] - amount
-    if new_balance < 0:
-        new_balance = 0
-        amount = user['card_balance']
-    update_user(user_id, card_balance=new_balance)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -amount, datetime.now(tz), 'withdraw'))
-    conn.commit()
+    with transaction() as cur:
+        user = get_user(user_id)
+        new_balance = user['card_balance'] - amount
+        if new_balance < 0:
+            new_balance = 0
+            amount = user['card_balance']
+        update_user(user_id, card_balance=new_balance)
+        cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -amount, datetime.now(tz), 'withdraw'))
     bot.send_message(message.chat.id, "Баланс списан")
     log_admin_action(message.chat.id, f"Списал баланс карты {amount} {username}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "card_history")
+@callbacks.route("card_history", slow=True)
 def card_history(call):
-    cursor.execute("SELECT u.username, h.amount, h.timestamp, h.type, h.id FROM card_history h JOIN users u ON h.user_id = u.id ORDER BY h.timestamp DESC")
-    rows = cursor.fetchall()
-    text = ""
-    for r in rows:
-        if r[3] in ['deposit', 'transfer_in']:
-            sign = '+'
-        else:
-            sign = '-'
-        text += f"{r[0]} {sign}{abs(r[1])} {r[2]} {r[3]}\n"
-    with open("card_history.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("card_history.txt", "rb"))
+    start_export(call.message.chat.id, CARD_HISTORY_EXPORT)
     log_admin_action(call.from_user.id, "История карт")
 
-@bot.callback_query_handler(func=lambda call: call.data == "users_with_card")
+@callbacks.route("users_with_card", slow=True)
 def users_with_card(call):
-    cursor.execute("SELECT username, card_activation_date FROM users WHERE card_number IS NOT NULL")
-    rows = cursor.fetchall()
-    text = "\n".join(f"{r[0]} {r[1]}" for r in rows)
-    with open("users_with_card.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("users_with_card.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "users_with_card.txt", "SELECT username, card_activation_date FROM users {where}",
+        where=["card_number IS NOT NULL"], line=lambda r: f"{r[0]} {r[1]}\n"))
     log_admin_action(call.from_user.id, "Пользователи с картой")
 
-@bot.callback_query_handler(func=lambda call: call.data == "blocked_cards")
+@callbacks.route("blocked_cards", slow=True)
 def blocked_cards(call):
-    cursor.execute("SELECT username FROM users WHERE card_status = 'blocked'")
-    rows = cursor.fetchall()
-    text = "\n".join(r[0] for r in rows)
-    with open("blocked_cards.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("blocked_cards.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "blocked_cards.txt", "SELECT username FROM users {where}", where=["card_status = 'blocked'"], line=lambda r: f"{r[0]}\n"))
     log_admin_action(call.from_user.id, "Заблокированные карты")
 
-@bot.callback_query_handler(func=lambda call: call.data == "unblocked_cards")
+@callbacks.route("unblocked_cards", slow=True)
 def unblocked_cards(call):
-    cursor.execute("SELECT username FROM users WHERE card_status = 'active'")
-    rows = cursor.fetchall()
-    text = "\n".join(r[0] for r in rows)
-    with open("unblocked_cards.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("unblocked_cards.txt", "rb"))
+    start_export(call.message.chat.id, Export(
+        "unblocked_cards.txt", "SELECT username FROM users {where}", where=["card_status = 'active'"], line=lambda r: f"{r[0]}\n"))
     log_admin_action(call.from_user.id, "Разблокированы карты")
 
-@bot.callback_query_handler(func=lambda call: call.data == "block_all_cards")
+@callbacks.route("block_all_cards", slow=True)
 def block_all_cards(call):
-    cursor.execute("SELECT id, card_balance FROM users WHERE card_number IS NOT NULL")
-    rows = cursor.fetchall()
-    for row in rows:
-        user_id = row[0]
-        balance = row[1]
-        if balance > 0:
-            cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
-    cursor.execute("UPDATE users SET card_status = 'blocked', block_reason='admin', card_balance=0.0, card_number=NULL, cvv=NULL, card_password=NULL, api_token=NULL, card_activation_date=NULL WHERE card_number IS NOT NULL")
-    conn.commit()
+    with transaction() as cur:
+        rows = cur.execute("SELECT id, card_balance FROM users WHERE card_number IS NOT NULL").fetchall()
+        for row in rows:
+            user_id = row[0]
+            balance = row[1]
+            if balance > 0:
+                cur.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
+        cur.execute("UPDATE users SET card_status = 'blocked', block_reason='admin', card_balance=0.0, card_number=NULL, cvv=NULL, card_password=NULL, api_token=NULL, card_activation_date=NULL WHERE card_number IS NOT NULL")
+        invalidate_user()
     bot.answer_callback_query(call.id, "Все карты заблокированы администратором")
     log_admin_action(call.from_user.id, "Заблокировал все карты")
 
-@bot.callback_query_handler(func=lambda call: call.data == "unblock_all_cards")
+@callbacks.route("unblock_all_cards", slow=True)
 def unblock_all_cards(call):
-    cursor.execute("UPDATE users SET card_status = 'inactive', block_reason=NULL WHERE card_number IS NOT NULL")
-    conn.commit()
+    execute("UPDATE users SET card_status = 'inactive', block_reason=NULL WHERE card_number IS NOT NULL")
+    invalidate_user()
     bot.answer_callback_query(call.id, "Все карты разблокированы, пользователи могут активировать заново")
     log_admin_action(call.from_user.id, "Разблокировал все карты")
 
-@bot.callback_query_handler(func=lambda call: call.data == "users_report")
+@callbacks.route("users_report", slow=True)
 def users_report(call):
-    cursor.execute("SELECT username FROM users")
-    rows = cursor.fetchall()
-    text = "\n".join(r[0] for r in rows)
-    with open("users_report.txt", "w") as f:
-        f.write(text)
-    bot.send_document(call.message.chat.id, open("users_report.txt", "rb"))
+    start_export(call.message.chat.id, Export("users_report.txt", "SELECT username FROM users {where}", line=lambda r: f"{r[0]}\n"))
     log_admin_action(call.from_user.id, "Отчет по пользователям")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_admin")
+@callbacks.route("back_admin")
 def back_admin(call):
-    fake_message = types.Message(message_id=call.message.message_id, from_user=call.from_user, chat=call.message.chat, text='/admin', date=0)
-    admin_panel(fake_message)
+    # Как и раньше: админ-панель приходит новым сообщением, а текущее возвращается к главному меню
+    admin_panel(call.message)
+    show_main_menu(call.message.chat.id, call.message.message_id)
 
 @bot.message_handler(commands=['hold'])
 def hold(message):
     successful = get_successful(message.chat.id)
-    text = "\n".join(f"{item['phone_number']} ({item['type']}) холд: {item['hold_time']}" for item in successful if item['hold_time'])
-    bot.send_message(message.chat.id, text or f"Нет холдов >= {MIN_HOLD_MINUTES} мин")
+    text = "\n".join(f"{item['phone_number']} ({item['type']}) холд: {format_hold(item['hold_minutes'])}" for item in successful if item['hold_minutes'] is not None)
+    if text:
+        text += f"\n\nК выплате: {get_user(message.chat.id)['pending_payout']}$"
+    bot.send_message(message.chat.id, text or f"Нет холдов >= {settings.get('min_hold_minutes')} мин")
 
 @bot.message_handler(commands=['del'])
 def del_number(message):
@@ -1954,9 +3981,8 @@ def del_number(message):
     if not phone:
         bot.send_message(message.chat.id, "Формат /del номер")
         return
-    cursor.execute("DELETE FROM queue WHERE phone_number = ? AND user_id = ?", (phone, message.chat.id))
-    conn.commit()
-    bot.send_message(message.chat.id, "Номер удален" if cursor.rowcount > 0 else "Номер не найден")
+    removed = number_queue.remove(phone, user_id=message.chat.id)
+    bot.send_message(message.chat.id, "Номер удален" if removed else "Номер не найден")
     log_action(message.chat.id, f"Удалил номер {phone}")
 
 @bot.message_handler(commands=['menu'])
@@ -1967,20 +3993,58 @@ def menu(message):
 def holdall(message):
     if not is_admin(message.chat.id):
         return
-    successful = get_successful()
-    text = "\n".join(f"{get_user(item['user_id'])['username']} {item['phone_number']} ({item['type']}) холд: {item['hold_time']}" for item in successful if item['hold_time'])
-    bot.send_message(message.chat.id, text or "Нет холдов")
+    holdall_view.show(message.chat.id)
+
+def render_holdall(chat_id, message_id, rows, nav):
+    text = "\n".join(f"{row['username']} {row['phone_number']} ({row['type']}) холд: {format_hold(row['hold_minutes'])}" for row in rows)
+    if text:
+        text += f"\n\nК выплате всего: {payout_total.get()}$"
+    markup = add_nav(types.InlineKeyboardMarkup(), nav)
+    if message_id is None:
+        bot.send_message(chat_id, text or "Нет холдов", reply_markup=markup)
+    else:
+        bot.edit_message_text(text or "Нет холдов", chat_id, message_id, reply_markup=markup)
+
+holdall_view = PagedView("ha", SUCCESSFUL_HOLDS, render_holdall, page_size=30, allow=is_admin)
+
+@bot.message_handler(commands=['metrics'])
+def metrics(message):
+    if not is_admin(message.chat.id):
+        return
+    users = user_cache.stats()
+    text = f"Кэш пользователей: {users['size']}/{user_cache.maxsize}\nПопадания: {users['hits']}\nПромахи: {users['misses']}\nHit rate: {users['hit_rate']:.1%}"
+    subs = membership_cache.stats()
+    text += f"\n\nКэш подписок: {subs['size']}, попадания {subs['hits']}, промахи {subs['misses']} ({subs['hit_rate']:.1%})"
+    text += f"\nИсходящие: в очереди {len(outbox)}, склеено правок {outbox.coalesced}"
+    lanes = update_lanes.stats()
+    text += f"\n\nОчереди апдейтов: {sum(lanes['depth'])} (медленные {sum(lanes['slow_depth'])}), ожиданий {lanes['waits']}, ошибок {lanes['failed']}"
+    logs = audit_log.stats()
+    text += f"\n\nЛоги: в очереди {logs['depth']}, записано {logs['written']} ({logs['batches']} пачек)\nПотеряно: {logs['dropped']}, ошибок записи: {logs['failed']}\nFlush: {logs['last_flush_ms']:.1f} мс (макс {logs['max_flush_ms']:.1f} мс)"
+    text += "\n\nTelegram API:"
+    for name, calls, errors, retries, avg_ms, max_ms in api_client.stats():
+        text += f"\n{name}: {calls} (ошибок {errors}, повторов {retries}), {avg_ms:.1f} мс (макс {max_ms:.1f} мс)"
+    routes = callbacks.stats()
+    text += f"\n\nКолбэки: {routes['routes']} маршрутов, без обработчика {routes['unmatched']}"
+    for name, calls, errors, avg_ms, max_ms in routes['top']:
+        text += f"\n{name}: {calls} (ошибок {errors}), {avg_ms:.1f} мс (макс {max_ms:.1f} мс)"
+    bot.send_message(message.chat.id, text)
 
 @bot.message_handler(commands=['queue'])
 def queue_cmd(message):
-    user = get_user(message.chat.id)
-    sub = user['subscription_type']
-    if sub not in ['Gold Tier', 'Prime Plus', 'VIP Nexus']:
+    if not can_see_queue(message.chat.id):
         bot.send_message(message.chat.id, "Доступно только с подпиской")
         return
-    queue = sort_queue(get_queue())
+    queue_text_view.show(message.chat.id)
+
+def render_queue_text(chat_id, message_id, queue, nav):
     text = "\n".join(f"{item['phone_number']} ({item['type']})" for item in queue)
-    bot.send_message(message.chat.id, text or "Очередь пуста")
+    markup = add_nav(types.InlineKeyboardMarkup(), nav)
+    if message_id is None:
+        bot.send_message(chat_id, text or "Очередь пуста", reply_markup=markup)
+    else:
+        bot.edit_message_text(text or "Очередь пуста", chat_id, message_id, reply_markup=markup)
+
+queue_text_view = PagedView("uq", QueueSource(), render_queue_text, page_size=QUEUE_PAGE_SIZE, allow=can_see_queue)
 
 @bot.message_handler(commands=['moder'])
 def moder(message):
@@ -2014,22 +4078,48 @@ def help_cmd(message):
     bot.send_message(message.chat.id, text)
 
 def check_inactivity():
-    threshold = datetime.now(tz) - timedelta(days=config.INACTIVITY_DAYS)
-    cursor.execute("SELECT id FROM users WHERE last_activity < ?", (threshold,))
-    inactive = cursor.fetchall()
-    for u in inactive:
-        cursor.execute("SELECT referer_id FROM referrals WHERE referee_id = ?", (u[0],))
-        referers = cursor.fetchall()
-        for ref in referers:
-            referer = get_user(ref[0])
-            update_user(ref[0], balance=max(0, referer['balance'] - config.REFERRAL_REWARD), referrals_count=referer['referrals_count'] - 1)
-            bot.send_message(ref[0], f"-$ {config.REFERRAL_REWARD}: реферал {u[0]} неактивен")
-
-threading.Timer(86400, check_inactivity).start()
-
-# Global variables for mega broadcast
-mega_layout = None
-mega_buttons = []
-mega_content = None
+    # Каждый реферал штрафуется один раз: penalized_at помечает обработанные пары
+    now = datetime.now(tz)
+    threshold = now - timedelta(days=config.INACTIVITY_DAYS)
+    reward = settings.get('referral_reward')
+    with transaction() as cur:
+        # RETURNING отдаёт ровно пары этого прогона, а не всё, что помечено тем же временем
+        penalized = cur.execute("""UPDATE referrals SET penalized_at = ?
+                                   WHERE penalized_at IS NULL
+                                     AND referee_id IN (SELECT id FROM users WHERE last_activity < ?)
+                                   RETURNING referer_id, referee_id""", (now, threshold)).fetchall()
+        if not penalized:
+            return
+        counts = Counter(referer_id for referer_id, _ in penalized)
+        cur.executemany("UPDATE users SET balance = MAX(0, balance - ? * ?), referrals_count = referrals_count - ? WHERE id = ?",
+                        [(reward, n, n, referer_id) for referer_id, n in counts.items()])
+        invalidate_user()
+    for referer_id, referee_id in penalized:
+        outbox.send(referer_id, f"-$ {reward}: реферал {referee_id} неактивен")
+    logger.info("inactivity check: %d referrals penalized", len(penalized))
+
+# Первый прогон вскоре после старта: иначе при ежедневных рестартах проверка не доходила бы до срабатывания
+scheduler.every(86400, check_inactivity, first=60)
+def compact_logs():
+    # Свёртка старых партиций может занять время — не держим поток планировщика
+    threading.Thread(target=log_partitions.compact, daemon=True).start()
+
+scheduler.every(86400, compact_logs, first=300)
+
+scheduler.every(3600, conversations.purge, first=120)
+
+broadcast_engine.resume()
+recover_activations()
+# Прогреваем кэш подписок для тех, кто был активен за последние сутки
+prewarm_subscriptions([row[0] for row in query_all("SELECT id FROM users WHERE last_activity >= ? ORDER BY last_activity DESC LIMIT 1000",
+                                                   (datetime.now(tz) - timedelta(days=1),))])
+
+def stop_bot(signum, frame):
+    # SIGTERM по умолчанию завершает процесс мимо atexit; останавливаем polling, и выход идёт штатно
+    logger.info("signal %d received, stopping", signum)
+    bot.stop_polling()
+
+signal.signal(signal.SIGTERM, stop_bot)
+signal.signal(signal.SIGINT, stop_bot)
 
 bot.infinity_polling()
\ No newline at end of file
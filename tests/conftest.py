@@ -0,0 +1,39 @@
+import os
+import signal
+import sys
+import tempfile
+import types
+
+import telebot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# saxu8 при импорте читает config и photos, открывает bot.db в текущем каталоге и уходит в polling
+config = types.ModuleType('config')
+config.BOT_TOKEN = '123:TEST'
+config.ADMIN_IDS = [1]
+config.CHANNEL = '@test'
+config.REFERRAL_REWARD = 1.0
+config.MIN_WITHDRAW = 50
+config.INACTIVITY_DAYS = 7
+config.PRICES = {'hour': 5, '30min': 2}
+config.SUBSCRIPTIONS = {
+    'Elite Access': {'payment_link': 'http://test', 'price_increase_hour': 6, 'price_increase_30min': 3},
+    'VIP Nexus': {'payment_link': 'http://test', 'price_increase_hour': 15, 'price_increase_30min': 7.5},
+}
+sys.modules['config'] = config
+
+photos = types.ModuleType('photos')
+photos.PHOTOS = {}
+sys.modules['photos'] = photos
+
+telebot.TeleBot.infinity_polling = lambda self, *args, **kwargs: None
+os.chdir(tempfile.mkdtemp(prefix='saxu8-tests-'))
+
+# saxu8 ставит свои обработчики SIGTERM/SIGINT; pytest должен прерываться как обычно
+_handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+import saxu8  # noqa: E402,F401
+for signum, handler in _handlers.items():
+    signal.signal(signum, handler)
+
@@ -0,0 +1,87 @@
+import types
+
+import pytest
+from telebot import types as tg
+
+import saxu8
+
+ADMIN = 1
+USER = 801
+PHONE = '9000000801'
+
+
+def code_message(text='12345'):
+    return tg.Message.de_json({'message_id': 1, 'date': 0, 'chat': {'id': ADMIN, 'type': 'private'},
+                               'from': {'id': ADMIN, 'is_bot': False, 'first_name': 'A'}, 'text': text})
+
+
+def pending():
+    return saxu8.query_one("SELECT * FROM pending_activations WHERE phone_number = ?", (PHONE,))
+
+
+@pytest.fixture(autouse=True)
+def queued_number():
+    saxu8.execute("INSERT OR REPLACE INTO users (id, username, reputation) VALUES (?, ?, ?)", (USER, 'activation', 10.0))
+    saxu8.invalidate_user(USER)
+    saxu8.number_queue.clear()
+    saxu8.number_queue.push(USER, PHONE, 'vc')
+    yield
+    saxu8.claim_activation(PHONE)
+    saxu8.number_queue.clear()
+
+
+def test_code_sent_records_message_and_arms_deadline(monkeypatch):
+    sent = []
+
+    def send_message(chat_id, text, **kwargs):
+        sent.append(chat_id)
+        return types.SimpleNamespace(message_id=55)
+    monkeypatch.setattr(saxu8.bot, 'send_message', send_message)
+    saxu8.process_send_code(code_message(), PHONE, ADMIN)
+    assert sent == [USER, ADMIN]
+    assert PHONE not in saxu8.number_queue
+    row = pending()
+    assert (row['user_id'], row['admin_id'], row['message_id']) == (USER, ADMIN, 55)
+    assert saxu8.scheduler.cancel(('activation', PHONE))
+
+
+def test_activation_is_written_before_the_code_goes_out(monkeypatch):
+    seen = []
+
+    def send_message(chat_id, text, **kwargs):
+        if chat_id == USER:
+            row = pending()
+            seen.append((row['message_id'], PHONE in saxu8.number_queue))
+        return types.SimpleNamespace(message_id=56)
+    monkeypatch.setattr(saxu8.bot, 'send_message', send_message)
+    saxu8.process_send_code(code_message(), PHONE, ADMIN)
+    assert seen == [(None, False)]
+
+
+def test_failed_send_puts_number_back(monkeypatch):
+    added_time = saxu8.number_queue.get(PHONE)['added_time']
+    notices = []
+
+    def send_message(chat_id, text, **kwargs):
+        if chat_id == USER:
+            raise RuntimeError("chat not found")
+        notices.append(text)
+    monkeypatch.setattr(saxu8.bot, 'send_message', send_message)
+    saxu8.process_send_code(code_message(), PHONE, ADMIN)
+    assert pending() is None
+    assert saxu8.number_queue.get(PHONE)['added_time'] == added_time
+    assert not saxu8.scheduler.cancel(('activation', PHONE))
+    assert notices == ["Не удалось отправить код, номер возвращён в очередь"]
+
+
+def test_activation_left_by_a_crash_expires_without_a_message(monkeypatch):
+    deleted, notices = [], []
+    monkeypatch.setattr(saxu8.bot, 'delete_message', lambda chat_id, message_id: deleted.append(message_id))
+    monkeypatch.setattr(saxu8.bot, 'send_message', lambda chat_id, text, **kwargs: notices.append(chat_id))
+    with saxu8.transaction():
+        saxu8.number_queue.remove(PHONE)
+        saxu8.start_activation(PHONE, USER, ADMIN, 'vc')
+    saxu8.expire_activation(PHONE)
+    assert pending() is None
+    assert deleted == []
+    assert notices == [USER]
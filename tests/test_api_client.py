@@ -0,0 +1,111 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import saxu8
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.requests = []
+        self.answers = []  # (status, body, delay) по очереди; последний повторяется
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot123:TEST/"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append(self.path.split('?')[0].rsplit('/', 1)[-1])
+        answers = self.server.answers
+        status, body, delay = answers.pop(0) if len(answers) > 1 else answers[0]
+        if delay:
+            time.sleep(delay)
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except ConnectionError:
+            pass  # клиент уже ушёл по таймауту
+
+    def log_message(self, *args):
+        pass
+
+
+OK = (200, {'ok': True, 'result': True}, 0)
+BAD_GATEWAY = (502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, 0)
+
+
+@pytest.fixture
+def server():
+    server = FakeBotApi()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    return saxu8.ApiClient(pool_size=2, max_attempts=3, max_wait=0.01)
+
+
+def test_post_timing_out_after_send_is_not_retried(server, client):
+    server.answers = [(200, {'ok': True, 'result': True}, 0.5)]
+    with pytest.raises(requests.ReadTimeout):
+        client('post', server.url + 'sendMessage', params={'chat_id': 1, 'text': 'hi'}, timeout=0.1)
+    assert server.requests == ['sendMessage']
+
+
+def test_idempotent_method_is_retried_after_read_timeout(server, client):
+    server.answers = [(200, {'ok': True, 'result': True}, 0.5), OK]
+    response = client('post', server.url + 'editMessageText', params={'chat_id': 1, 'text': 'hi'}, timeout=0.2)
+    assert response.status_code == 200
+    assert server.requests == ['editMessageText', 'editMessageText']
+
+
+def test_server_error_is_retried_only_for_idempotent_methods(server, client):
+    server.answers = [BAD_GATEWAY, OK]
+    assert client('post', server.url + 'sendMessage', timeout=1).status_code == 502
+    server.answers = [BAD_GATEWAY, OK]
+    assert client('post', server.url + 'getMe', timeout=1).status_code == 200
+    assert server.requests == ['sendMessage', 'getMe', 'getMe']
+
+
+def test_short_retry_after_is_waited_out(server):
+    paused = []
+    client = saxu8.ApiClient(pool_size=2, max_attempts=3, max_wait=0.01, on_retry_after=paused.append)
+    server.answers = [(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0}}, 0), OK]
+    assert client('post', server.url + 'sendMessage', timeout=1).status_code == 200
+    assert server.requests == ['sendMessage', 'sendMessage']
+    assert paused == [0]
+
+
+def test_long_retry_after_is_returned_to_caller(server, client):
+    server.answers = [(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 30}}, 0), OK]
+    assert client('post', server.url + 'sendMessage', timeout=1).status_code == 429
+    assert server.requests == ['sendMessage']
+
+
+def test_refused_connection_is_retried_for_any_method(client):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    with pytest.raises(requests.ConnectionError):
+        client('post', f"http://127.0.0.1:{port}/bot123:TEST/sendMessage", timeout=1)
+    [(name, calls, errors, retries, _, _)] = client.stats()
+    assert (name, calls, errors, retries) == ('sendMessage', 1, 1, 2)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+import saxu8
+
+USER_ID = 9001
+
+
+def clear(path):
+    for kind, column in saxu8.LOG_COLUMNS.items():
+        for table in saxu8.log_partitions.tables(kind):
+            saxu8.execute(f"DELETE FROM {table} WHERE {column} = ?", (USER_ID,), path=path)
+
+
+@pytest.fixture
+def log_path():
+    # Партиции по месяцам общие для базы логов, поэтому пишем в неё под своим user_id
+    path = saxu8.LOG_DB_PATH
+    clear(path)
+    yield path
+    clear(path)
+
+
+def actions(path, kind='logs', user_id=USER_ID):
+    column = saxu8.LOG_COLUMNS[kind]
+    return [row[0] for table in saxu8.log_partitions.tables(kind)
+            for row in saxu8.query_all(f"SELECT action FROM {table} WHERE {column} = ? ORDER BY id", (user_id,), path=path)]
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_flushes_after_interval(log_path):
+    log = saxu8.AuditLog(log_path)
+    log.FLUSH_INTERVAL = 0.05
+    log.write('logs', (USER_ID, 'a', None))
+    log.write('admin_logs', (USER_ID, 'b', None))
+    assert wait_for(lambda: log.stats()['written'] == 2)
+    assert actions(log_path) == ['a']
+    assert actions(log_path, 'admin_logs') == ['b']
+    assert log.stats()['batches'] == 1
+    log.close()
+
+
+def test_flushes_full_batch_without_waiting(log_path):
+    log = saxu8.AuditLog(log_path)
+    log.FLUSH_INTERVAL = 60
+    log.BATCH = 3
+    for action in 'abc':
+        log.write('logs', (USER_ID, action, None))
+    assert wait_for(lambda: actions(log_path) == ['a', 'b', 'c'])
+    log.close()
+
+
+def test_close_writes_buffered_rows(log_path):
+    log = saxu8.AuditLog(log_path)
+    log.FLUSH_INTERVAL = 60
+    for action in 'ab':
+        log.write('logs', (USER_ID, action, None))
+    log.close()
+    assert actions(log_path) == ['a', 'b']
+    assert not log._thread.is_alive()
+
+
+def test_close_does_not_hang_on_stuck_writer(log_path, monkeypatch):
+    release = threading.Event()
+    log = saxu8.AuditLog(log_path, maxsize=1)
+    log.FLUSH_INTERVAL = 0
+    monkeypatch.setattr(log, '_flush', lambda batch: release.wait())
+    log.write('logs', (USER_ID, 'a', None))
+    assert wait_for(lambda: log._buffer.empty())
+    log.write('logs', (USER_ID, 'b', None))
+    started = time.monotonic()
+    log.close(timeout=0.2)
+    assert time.monotonic() - started < 1
+    release.set()
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+
+import saxu8
+
+
+@pytest.fixture
+def router(monkeypatch):
+    answered = []
+    monkeypatch.setattr(saxu8.bot, 'answer_callback_query', lambda callback_id, *args, **kwargs: answered.append(callback_id))
+    router = saxu8.CallbackRouter()
+    router.answered = answered
+    return router
+
+
+def call(data):
+    return SimpleNamespace(id='cb', data=data)
+
+
+def test_exact_and_prefix_routes(router):
+    seen = []
+    router.route("stats", "stats_refresh")(lambda c: seen.append(('stats', c.data)))
+    router.prefix("select_number_", str)(lambda c, phone: seen.append(('select', phone)))
+    router.dispatch(call("stats"))
+    router.dispatch(call("stats_refresh"))
+    router.dispatch(call("select_number_79990001122"))
+    assert seen == [('stats', 'stats'), ('stats', 'stats_refresh'), ('select', '79990001122')]
+
+
+def test_prefix_arguments_are_typed_and_last_takes_rest(router):
+    seen = []
+    router.prefix("pay_", int, float, str)(lambda c, user_id, amount, note: seen.append((user_id, amount, note)))
+    router.dispatch(call("pay_42_2.5_a_b"))
+    assert seen == [(42, 2.5, 'a_b')]
+
+
+def test_bad_or_unknown_payload_is_answered_and_counted(router):
+    router.prefix("pay_", int, float)(lambda c, user_id, amount: pytest.fail("must not be called"))
+    router.dispatch(call("pay_x_1"))
+    router.dispatch(call("pay_1"))
+    router.dispatch(call("nothing"))
+    assert router.unmatched == 3
+    assert router.answered == ['cb', 'cb', 'cb']
+
+
+def test_duplicates_are_rejected(router):
+    router.route("stats")(lambda c: None)
+    router.prefix("pg_", str)(lambda c, rest: None)
+    with pytest.raises(ValueError):
+        router.route("stats")(lambda c: None)
+    with pytest.raises(ValueError):
+        router.prefix("pg_", str)(lambda c, rest: None)
+
+
+@pytest.mark.parametrize("first, second", [
+    (("prefix", "skip_"), ("route", "skip_mega_content")),
+    (("route", "skip_mega_content"), ("prefix", "skip_")),
+    (("prefix", "skip_"), ("prefix", "skip_mega_")),
+    (("prefix", "skip_mega_"), ("prefix", "skip_")),
+])
+def test_ambiguous_routes_are_rejected(router, first, second):
+    def register(kind, name):
+        if kind == "route":
+            router.route(name)(lambda c: None)
+        else:
+            router.prefix(name, str)(lambda c, rest: None)
+    register(*first)
+    with pytest.raises(ValueError):
+        register(*second)
+
+
+def test_stats_count_calls_and_errors(router):
+    def boom(c):
+        raise RuntimeError
+    router.route("ok")(lambda c: None)
+    router.route("boom")(boom)
+    router.dispatch(call("ok"))
+    router.dispatch(call("ok"))
+    with pytest.raises(RuntimeError):
+        router.dispatch(call("boom"))
+    stats = {name: (calls, errors) for name, calls, errors, _, _ in router.stats()['top']}
+    assert stats == {'ok': (2, 0), 'boom': (1, 1)}
+
+
+def test_bot_routes_have_one_owner():
+    # Ни одно точное действие бота не попадает под префикс
+    assert [action for action in saxu8.callbacks.exact if saxu8.callbacks._match_prefix(action)] == []
@@ -0,0 +1,94 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import saxu8
+
+CHAT = 900
+
+
+@pytest.fixture
+def store():
+    store = saxu8.ConversationStore(ttl=60, negative_ttl=0)
+    yield store
+    store.clear(CHAT)
+
+
+def message(text='hi'):
+    return SimpleNamespace(chat=SimpleNamespace(id=CHAT), text=text)
+
+
+def test_claim_takes_state_once(store):
+    store.set(CHAT, 'draft', amount=5)
+    assert store.state(CHAT) == 'draft'
+    assert store.claim(CHAT) == ('draft', {'amount': 5})
+    assert store.claim(CHAT) is None
+    assert store.state(CHAT) is None
+
+
+def test_claim_filters_by_state(store):
+    store.set(CHAT, 'draft')
+    assert store.claim(CHAT, 'other') is None
+    assert store.claim(CHAT, 'other', 'draft') == ('draft', {})
+
+
+def test_concurrent_claims_have_one_winner(store):
+    store.set(CHAT, 'draft')
+    start = threading.Barrier(8)
+    results = []
+
+    def claim():
+        start.wait()
+        results.append(store.claim(CHAT))
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [result for result in results if result] == [('draft', {})]
+
+
+def test_expired_state_is_not_claimed_and_purged(store):
+    store.ttl = 0.05
+    store.set(CHAT, 'draft')
+    time.sleep(0.1)
+    assert store.state(CHAT) is None
+    assert store.claim(CHAT) is None
+    store.purge()
+    assert saxu8.query_one("SELECT COUNT(*) FROM conversations WHERE chat_id = ?", (CHAT,))[0] == 0
+
+
+def test_step_receives_message_and_payload(store):
+    seen = []
+
+    def ask_amount(message, user_id):
+        seen.append((message.text, user_id))
+    store.step(ask_amount)
+    store.expect(CHAT, ask_amount, user_id=7)
+    assert store.pending(message())
+    store.handle(message('10'))
+    assert seen == [('10', 7)]
+    assert not store.pending(message())
+
+
+def test_expect_requires_registered_step(store):
+    with pytest.raises(ValueError):
+        store.expect(CHAT, lambda message: None)
+
+
+def test_expired_step_falls_back_to_normal_handling(store, monkeypatch):
+    processed = []
+    monkeypatch.setattr(saxu8.bot, 'process_new_messages', processed.extend)
+
+    def ask_amount(message):
+        pytest.fail("expired step must not run")
+    store.step(ask_amount)
+    store.ttl = 0.05
+    store.expect(CHAT, ask_amount)
+    time.sleep(0.1)
+    msg = message()
+    store.handle(msg)
+    assert processed == [msg]
@@ -0,0 +1,195 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import saxu8
+
+# Схема bot.db до введения миграций — с неё обновляются рабочие базы
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY, username TEXT, reputation REAL DEFAULT 10.0, balance REAL DEFAULT 0.0,
+    subscription_type TEXT, subscription_end DATETIME, referral_code TEXT, referrals_count INTEGER DEFAULT 0,
+    profit_level TEXT DEFAULT 'новичок', card_number TEXT, cvv TEXT, card_balance REAL DEFAULT 0.0,
+    card_status TEXT DEFAULT 'inactive', card_password TEXT, card_activation_date DATETIME, phone_number TEXT,
+    last_activity DATETIME, api_token TEXT, block_reason TEXT
+);
+CREATE TABLE admins (id INTEGER PRIMARY KEY);
+CREATE TABLE queue (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, phone_number TEXT UNIQUE, added_time DATETIME, type TEXT);
+CREATE TABLE working (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, phone_number TEXT UNIQUE, start_time DATETIME, admin_id INTEGER, type TEXT);
+CREATE TABLE successful (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, phone_number TEXT, hold_time TEXT,
+                         acceptance_time DATETIME, flight_time DATETIME, type TEXT);
+CREATE TABLE blocked (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, phone_number TEXT, type TEXT);
+CREATE TABLE referrals (referer_id INTEGER, referee_id INTEGER, PRIMARY KEY (referer_id, referee_id));
+CREATE TABLE withdraw_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, status TEXT DEFAULT 'pending');
+CREATE TABLE logs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, timestamp DATETIME);
+CREATE TABLE admin_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, admin_id INTEGER, action TEXT, timestamp DATETIME);
+CREATE TABLE status (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE card_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, timestamp DATETIME, type TEXT);
+CREATE TABLE transfers (id INTEGER PRIMARY KEY AUTOINCREMENT, from_user_id INTEGER, to_user_id INTEGER, amount REAL, timestamp DATETIME);
+"""
+
+
+def columns(path, table):
+    return [row[1] for row in saxu8.query_all(f"PRAGMA table_info({table})", path=path)]
+
+
+def tables(path):
+    return {row[0] for row in saxu8.query_all("SELECT name FROM sqlite_master WHERE type = 'table'", path=path)}
+
+
+def indexes(path):
+    return {row[0] for row in saxu8.query_all("SELECT name FROM sqlite_master WHERE type = 'index'", path=path)}
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    path = str(tmp_path / "bot.db")
+    now = datetime.now(saxu8.tz)
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO status (key, value) VALUES ('work_status', 'Stop')")
+    conn.execute("INSERT INTO admins (id) VALUES (1), (42)")
+    conn.execute("INSERT INTO users (id, username, subscription_type, last_activity) VALUES (1, 'a', 'VIP Nexus', ?)", (now,))
+    conn.execute("INSERT INTO users (id, username, last_activity) VALUES (2, 'b', ?)", (now - timedelta(days=30),))
+    conn.execute("INSERT INTO referrals (referer_id, referee_id) VALUES (1, 2)")
+    conn.execute("INSERT INTO successful (user_id, phone_number, hold_time, type) VALUES (1, '+1', '01:35', 'vc')")
+    conn.execute("INSERT INTO transfers (from_user_id, to_user_id, amount, timestamp) VALUES (1, 2, 5.0, ?)", (now,))
+    conn.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (1, -5.0, ?, 'transfer_out')", (now,))
+    conn.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (2, 5.0, ?, 'transfer_in')", (now,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_migrations_upgrade_baseline_schema(baseline_db):
+    saxu8.run_migrations(baseline_db)
+
+    versions = [row[0] for row in saxu8.query_all("SELECT version FROM schema_version ORDER BY version", path=baseline_db)]
+    assert versions == [version for version, _ in saxu8.MIGRATIONS]
+    assert {'idx_users_username', 'idx_queue_user_id', 'idx_transfers_from'} <= indexes(baseline_db)
+    assert not {'admins', 'status', 'logs', 'admin_logs'} & tables(baseline_db)
+    settings = {row[0]: row[1] for row in saxu8.query_all("SELECT key, value FROM settings", path=baseline_db)}
+    assert settings['admins'] == '[1, 42]'
+    assert settings['work_status'] == '"Stop"'
+    assert 'cursor' not in columns(baseline_db, 'broadcast_jobs')
+    assert saxu8.query_one("SELECT penalized_at FROM referrals", path=baseline_db)[0] is not None
+    assert columns(baseline_db, 'subscription_tiers') == ['name', 'priority']
+    hold = saxu8.query_one("SELECT hold_minutes, payout FROM successful", path=baseline_db)
+    assert tuple(hold) == (95, saxu8.hold_payout('VIP Nexus', 95))
+    assert saxu8.query_one("SELECT pending_payout FROM users WHERE id = 1", path=baseline_db)[0] == hold['payout']
+    assert [row[0] for row in saxu8.query_all("SELECT transfer_id FROM card_history ORDER BY id", path=baseline_db)] == [1, 1]
+
+
+def test_migrations_are_applied_once(baseline_db):
+    saxu8.run_migrations(baseline_db)
+    saxu8.run_migrations(baseline_db)
+    assert saxu8.query_one("SELECT COUNT(*) FROM schema_version", path=baseline_db)[0] == len(saxu8.MIGRATIONS)
+
+
+def test_fresh_database_is_at_latest_version():
+    assert saxu8.query_one("SELECT MAX(version) FROM schema_version")[0] == saxu8.MIGRATIONS[-1][0]
+    assert not {'admins', 'status', 'logs', 'admin_logs'} & tables(saxu8.DB_PATH)
+    assert saxu8.settings.is_admin(1)
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "t.db")
+    saxu8.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)", path=path)
+    return path
+
+
+def names(path):
+    return [row[0] for row in saxu8.query_all("SELECT name FROM items ORDER BY id", path=path)]
+
+
+def test_transaction_commits(db):
+    with saxu8.transaction(db) as cur:
+        cur.execute("INSERT INTO items (name) VALUES ('a')")
+    assert names(db) == ['a']
+    assert not saxu8.get_conn(db).in_transaction
+
+
+def test_transaction_rolls_back_on_error(db):
+    with pytest.raises(RuntimeError):
+        with saxu8.transaction(db) as cur:
+            cur.execute("INSERT INTO items (name) VALUES ('a')")
+            raise RuntimeError
+    assert names(db) == []
+    assert not saxu8.get_conn(db).in_transaction
+
+
+def test_nested_transaction_joins_outer(db):
+    with saxu8.transaction(db) as cur:
+        cur.execute("INSERT INTO items (name) VALUES ('outer')")
+        with saxu8.transaction(db) as inner:
+            inner.execute("INSERT INTO items (name) VALUES ('inner')")
+        # Вложенный блок не коммитит сам
+        assert saxu8.get_conn(db).in_transaction
+    assert names(db) == ['outer', 'inner']
+
+
+def test_nested_error_rolls_back_outer(db):
+    with pytest.raises(RuntimeError):
+        with saxu8.transaction(db) as cur:
+            cur.execute("INSERT INTO items (name) VALUES ('outer')")
+            with saxu8.transaction(db) as inner:
+                inner.execute("INSERT INTO items (name) VALUES ('inner')")
+                raise RuntimeError
+    assert names(db) == []
+
+
+def test_failed_commit_rolls_back(tmp_path):
+    path = str(tmp_path / "fk.db")
+    saxu8.get_conn(path).execute("PRAGMA foreign_keys=ON")
+    saxu8.execute("CREATE TABLE parents (id INTEGER PRIMARY KEY)", path=path)
+    saxu8.execute("CREATE TABLE children (parent_id INTEGER REFERENCES parents(id) DEFERRABLE INITIALLY DEFERRED)", path=path)
+    with pytest.raises(sqlite3.IntegrityError):
+        with saxu8.transaction(path) as cur:
+            cur.execute("INSERT INTO children (parent_id) VALUES (1)")
+    assert not saxu8.get_conn(path).in_transaction
+    assert saxu8.query_one("SELECT COUNT(*) FROM children", path=path)[0] == 0
+    # Следующая транзакция в этом потоке открывается как обычно
+    saxu8.execute("INSERT INTO parents (id) VALUES (1)", path=path)
+    assert saxu8.query_one("SELECT COUNT(*) FROM parents", path=path)[0] == 1
+
+
+def test_on_commit_runs_after_commit(db):
+    hooks = []
+    with saxu8.transaction(db) as cur:
+        cur.execute("INSERT INTO items (name) VALUES ('a')")
+        saxu8.on_commit(lambda: hooks.append(names(db)), path=db)
+        assert hooks == []
+    assert hooks == [['a']]
+
+
+def test_on_commit_dropped_on_rollback(db):
+    hooks = []
+    with pytest.raises(RuntimeError):
+        with saxu8.transaction(db) as cur:
+            cur.execute("INSERT INTO items (name) VALUES ('a')")
+            saxu8.on_commit(lambda: hooks.append(True), path=db)
+            raise RuntimeError
+    assert hooks == []
+    # Хук отменённой транзакции не всплывает в следующей
+    with saxu8.transaction(db) as cur:
+        cur.execute("INSERT INTO items (name) VALUES ('b')")
+    assert hooks == []
+
+
+def test_on_commit_waits_for_outer_transaction(db):
+    hooks = []
+    with saxu8.transaction(db) as cur:
+        cur.execute("INSERT INTO items (name) VALUES ('outer')")
+        with saxu8.transaction(db) as inner:
+            inner.execute("INSERT INTO items (name) VALUES ('inner')")
+            saxu8.on_commit(lambda: hooks.append(True), path=db)
+        assert hooks == []
+    assert hooks == [True]
+
+
+def test_on_commit_outside_transaction_runs_at_once(db):
+    hooks = []
+    saxu8.on_commit(lambda: hooks.append(True), path=db)
+    assert hooks == [True]
@@ -0,0 +1,24 @@
+import pytest
+
+import saxu8
+
+
+@pytest.fixture
+def holder():
+    saxu8.execute("INSERT INTO users (id, username, pending_payout) VALUES (800, 'h', 0)")
+    saxu8.payout_total.invalidate()
+    yield 800
+    saxu8.execute("DELETE FROM users WHERE id = 800")
+    saxu8.payout_total.invalidate()
+
+
+def test_payout_total_is_cached_until_invalidated(holder):
+    total = saxu8.payout_total.get()
+    saxu8.execute("UPDATE users SET pending_payout = 7.5 WHERE id = ?", (holder,))
+    # Без инвалидации страницы /holdall не пересчитывают сумму
+    assert saxu8.payout_total.get() == total
+    with saxu8.transaction() as cur:
+        cur.execute("UPDATE users SET pending_payout = 10 WHERE id = ?", (holder,))
+        saxu8.payout_total.invalidate()
+    assert saxu8.payout_total.get() == total + 10
+
@@ -0,0 +1,98 @@
+import threading
+import types
+
+import pytest
+from telebot import types as tg
+
+import saxu8
+
+
+@pytest.fixture
+def lanes():
+    executor = saxu8.LaneExecutor(types.SimpleNamespace(exception_handler=None), 2, 1, 4)
+    yield executor
+    executor.close()
+
+
+def drain(executor, chat_id):
+    done = threading.Event()
+    assert executor.submit(chat_id, done.set)
+    assert done.wait(2)
+
+
+def test_chat_tasks_run_serially_in_order(lanes):
+    seen, running, overlaps = [], [0], []
+    lock = threading.Lock()
+
+    def task(i):
+        with lock:
+            running[0] += 1
+            overlaps.append(running[0])
+        seen.append(i)
+        with lock:
+            running[0] -= 1
+
+    for i in range(50):
+        lanes.put(task, i)
+    drain(lanes, 0)
+    assert seen == list(range(50))
+    assert max(overlaps) == 1
+
+
+def test_task_from_own_lane_runs_inline(lanes):
+    order = []
+    done = threading.Event()
+
+    def inner():
+        order.append('inner')
+
+    def outer():
+        assert lanes.submit(5, inner)
+        order.append('outer')
+        done.set()
+
+    assert lanes.submit(5, outer)
+    assert done.wait(2)
+    assert order == ['inner', 'outer']
+
+
+def test_submit_to_full_lane_returns_false(lanes):
+    release = threading.Event()
+    started = threading.Event()
+    lanes.submit(3, lambda: (started.set(), release.wait(2)))
+    assert started.wait(2)
+    for _ in range(4):
+        assert lanes.submit(3, lambda: None)
+    assert not lanes.submit(3, lambda: None)
+    assert lanes.stats()['waits'] == 1
+    release.set()
+    done = threading.Event()
+    lanes.lane_for(3).put((done.set, (), {}))
+    assert done.wait(2)
+
+
+def test_failing_handler_is_counted_and_lane_keeps_running(lanes):
+    def boom():
+        raise RuntimeError("boom")
+
+    lanes.submit(7, boom)
+    drain(lanes, 7)
+    assert lanes.stats()['failed'] == 1
+
+
+def test_is_slow_update_does_not_query_database(monkeypatch):
+    message = tg.Message.de_json({'message_id': 1, 'date': 0, 'chat': {'id': 4242, 'type': 'private'},
+                                  'from': {'id': 4242, 'is_bot': False, 'first_name': 'T'}, 'text': '/export'})
+
+    def no_db(*args, **kwargs):
+        raise AssertionError("is_slow_update hit the database")
+
+    monkeypatch.setattr(saxu8, 'query_one', no_db)
+    assert saxu8.is_slow_update(message)
+    message.text = 'hello'
+    assert not saxu8.is_slow_update(message)
+    saxu8.conversations.cache.put(4242, ('process_broadcast', saxu8.time.time() + 60))
+    try:
+        assert saxu8.is_slow_update(message)
+    finally:
+        saxu8.conversations.cache.invalidate(4242)
@@ -0,0 +1,162 @@
+from datetime import datetime
+
+import pytest
+
+import saxu8
+
+queue = saxu8.number_queue
+
+
+def add_user(user_id, reputation=10.0, subscription_type=None):
+    saxu8.execute("INSERT OR REPLACE INTO users (id, username, reputation, subscription_type) VALUES (?, ?, ?, ?)",
+                  (user_id, f"u{user_id}", reputation, subscription_type))
+    saxu8.invalidate_user(user_id)
+
+
+def phones():
+    return [item['phone_number'] for item in queue.page(limit=100)]
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    queue.clear()
+    yield
+    queue.clear()
+
+
+def test_order_follows_tier_reputation_and_time():
+    add_user(101)
+    add_user(102, reputation=20.0)
+    add_user(103, subscription_type='VIP Nexus')
+    add_user(104, subscription_type='Elite Access')
+    for user_id, phone in [(101, '9000000101'), (102, '9000000102'), (103, '9000000103'), (104, '9000000104'), (101, '9000000105')]:
+        assert queue.push(user_id, phone, 'vc')
+    assert phones() == ['9000000103', '9000000104', '9000000102', '9000000101', '9000000105']
+    assert phones() == [item['phone_number'] for item in saxu8.get_sorted_queue()]
+
+
+def test_reload_matches_table():
+    add_user(101)
+    add_user(102, subscription_type='VIP Nexus')
+    queue.push(101, '9000000101', 'vc')
+    queue.push(102, '9000000102', 'max')
+    before = phones()
+    queue.load()
+    assert phones() == before
+    assert len(queue) == 2
+
+
+def test_duplicate_push_is_refused():
+    add_user(101)
+    assert queue.push(101, '9000000101', 'vc')
+    assert queue.push(101, '9000000101', 'vc') is None
+    assert len(queue) == 1
+
+
+def test_push_of_phone_only_in_table_is_refused():
+    add_user(101)
+    saxu8.execute("INSERT INTO queue (user_id, phone_number, added_time, type) VALUES (101, '9000000101', ?, 'vc')",
+                  (saxu8.datetime.now(saxu8.tz),))
+    assert queue.push(101, '9000000101', 'vc') is None
+    assert '9000000101' not in queue
+
+
+def test_rollback_leaves_queue_unchanged():
+    add_user(101)
+    queue.push(101, '9000000101', 'vc')
+    with pytest.raises(RuntimeError):
+        with saxu8.transaction():
+            queue.remove('9000000101')
+            queue.push(101, '9000000102', 'vc')
+            raise RuntimeError
+    assert phones() == ['9000000101']
+    assert [row[0] for row in saxu8.query_all("SELECT phone_number FROM queue")] == ['9000000101']
+
+
+def test_changes_apply_after_commit():
+    add_user(101)
+    queue.push(101, '9000000101', 'vc')
+    with saxu8.transaction():
+        assert queue.remove('9000000101')['phone_number'] == '9000000101'
+        queue.push(101, '9000000102', 'vc')
+        assert phones() == ['9000000101']
+    assert phones() == ['9000000102']
+
+
+def test_remove_checks_owner():
+    add_user(101)
+    add_user(102)
+    queue.push(101, '9000000101', 'vc')
+    assert queue.remove('9000000101', user_id=102) is None
+    assert queue.remove('9000000101', user_id=101)
+    assert len(queue) == 0
+
+
+def test_reputation_change_reorders_after_commit():
+    add_user(101)
+    add_user(102)
+    queue.push(101, '9000000101', 'vc')
+    queue.push(102, '9000000102', 'vc')
+    with pytest.raises(RuntimeError):
+        with saxu8.transaction():
+            saxu8.update_user(102, reputation=50.0)
+            raise RuntimeError
+    assert phones() == ['9000000101', '9000000102']
+    saxu8.update_user(102, reputation=50.0)
+    assert phones() == ['9000000102', '9000000101']
+
+
+def walk(direction, limit=2):
+    # Проходит всю очередь keyset-страницами вперёд или назад
+    pages, page = [], queue.page_after(limit=limit)
+    if direction == 'p':
+        while page:
+            last = page
+            page = queue.page_after(after=queue.cursor(page[-1]), limit=limit)
+        page = last
+    while page:
+        pages.append([item['phone_number'] for item in page])
+        bound = queue.cursor(page[0] if direction == 'p' else page[-1])
+        page = queue.page_after(before=bound, limit=limit) if direction == 'p' else queue.page_after(after=bound, limit=limit)
+    return pages
+
+
+def test_keyset_pages_cover_queue_in_order():
+    add_user(101)
+    add_user(102, subscription_type='VIP Nexus')
+    for i in range(5):
+        queue.push(101 + i % 2, f'900000020{i}', 'vc')
+    expected = phones()
+    forward = walk('n')
+    assert [phone for page in forward for phone in page] == expected
+    assert max(len(page) for page in forward) == 2
+    backward = walk('p')
+    assert [phone for page in reversed(backward) for phone in page] == expected
+
+
+def test_page_after_removed_cursor_continues():
+    add_user(101)
+    for i in range(4):
+        queue.push(101, f'900000030{i}', 'vc')
+    first = queue.page_after(limit=2)
+    queue.remove(first[-1]['phone_number'])
+    rest = queue.page_after(after=queue.cursor(first[-1]), limit=10)
+    assert [item['phone_number'] for item in rest] == ['9000000302', '9000000303']
+
+
+@pytest.mark.parametrize("key", [
+    (-4, -10.0, 1234567890123456, 17),
+    (0, -12.5, 0, 1),
+    (-1, 0.1, -86400000000, 2 ** 40),
+    (-3.25, 1e-05, 3),
+])
+def test_cursor_round_trip(key):
+    encoded = saxu8.encode_cursor(key)
+    assert saxu8.decode_cursor(encoded) == key
+    assert [type(v) for v in saxu8.decode_cursor(encoded)] == [type(v) for v in key]
+
+
+def test_queue_cursor_round_trip():
+    item = {'priority': 4, 'reputation': 10.0, 'added_time': datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=saxu8.tz), 'id': 7}
+    key = queue.cursor(item)
+    assert saxu8.decode_cursor(saxu8.encode_cursor(key)) == key
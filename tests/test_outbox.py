@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+import saxu8
+
+
+@pytest.fixture
+def outbox():
+    return saxu8.Outbox(saxu8.TokenBucket(1000), saxu8.ChatRateLimiter(1000, burst=100), workers=1)
+
+
+def hold_worker(outbox):
+    # Занимает единственный воркер, пока тест складывает задачи в очередь
+    started, release = threading.Event(), threading.Event()
+    outbox.submit(-1, lambda: (started.set(), release.wait(2)))
+    assert started.wait(2)
+    return release
+
+
+def wait_for(sent, count):
+    deadline = time.monotonic() + 2
+    while len(sent) < count:
+        assert time.monotonic() < deadline, f"only {len(sent)} of {count} sends happened"
+        time.sleep(0.01)
+
+
+def test_urgent_tasks_go_first(outbox):
+    sent = []
+    release = hold_worker(outbox)
+    outbox.submit(1, lambda: sent.append('bulk'), saxu8.PRIORITY_BULK)
+    outbox.submit(2, lambda: sent.append('notice'), saxu8.PRIORITY_NOTICE)
+    outbox.submit(3, lambda: sent.append('flight'), saxu8.PRIORITY_FLIGHT)
+    outbox.submit(4, lambda: sent.append('activation'), saxu8.PRIORITY_ACTIVATION)
+    release.set()
+    wait_for(sent, 4)
+    assert sent == ['activation', 'flight', 'notice', 'bulk']
+
+
+def test_same_priority_keeps_arrival_order(outbox):
+    sent = []
+    release = hold_worker(outbox)
+    for i in range(5):
+        outbox.submit(10 + i, lambda i=i: sent.append(i))
+    release.set()
+    wait_for(sent, 5)
+    assert sent == list(range(5))
+
+
+def test_queued_edits_of_one_message_are_coalesced(outbox, monkeypatch):
+    sent = []
+    monkeypatch.setattr(saxu8.bot, 'edit_message_text', lambda text, chat_id, message_id, **kwargs: sent.append((chat_id, message_id, text)))
+    release = hold_worker(outbox)
+    outbox.edit(5, 9, "one")
+    outbox.edit(5, 9, "two")
+    outbox.edit(5, 10, "other")
+    outbox.edit(5, 9, "three")
+    assert len(outbox) == 2
+    release.set()
+    wait_for(sent, 2)
+    assert sent == [(5, 9, "three"), (5, 10, "other")]
+    assert outbox.coalesced == 2
+
+
+def test_edit_after_send_is_not_coalesced(outbox, monkeypatch):
+    sent = []
+    monkeypatch.setattr(saxu8.bot, 'edit_message_text', lambda text, chat_id, message_id, **kwargs: sent.append(text))
+    outbox.edit(5, 9, "one")
+    wait_for(sent, 1)
+    outbox.edit(5, 9, "two")
+    wait_for(sent, 2)
+    assert sent == ["one", "two"]
+    assert outbox.coalesced == 0
+
+
+def test_one_send_in_flight_per_chat():
+    outbox = saxu8.Outbox(saxu8.TokenBucket(1000), saxu8.ChatRateLimiter(1000, burst=100), workers=3)
+    sent, running, overlaps = [], [0], []
+    lock = threading.Lock()
+
+    def send(i):
+        with lock:
+            running[0] += 1
+            overlaps.append(running[0])
+        time.sleep(0.005)
+        sent.append(i)
+        with lock:
+            running[0] -= 1
+
+    for i in range(10):
+        outbox.submit(7, lambda i=i: send(i))
+    wait_for(sent, 10)
+    assert sent == list(range(10))
+    assert max(overlaps) == 1
+
+
+def test_call_returns_the_sent_message(outbox):
+    assert outbox.call(8, lambda: 'message') == 'message'
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import saxu8
+
+
+@pytest.fixture
+def referrals(monkeypatch):
+    sent = []
+    monkeypatch.setattr(saxu8.outbox, 'send', lambda chat_id, text, **kwargs: sent.append(chat_id))
+    now = datetime.now(saxu8.tz)
+    stale = now - timedelta(days=saxu8.config.INACTIVITY_DAYS + 1)
+    saxu8.execute("INSERT INTO users (id, username, balance, referrals_count, last_activity) VALUES (500, 'r', 5.0, 3, ?)", (now,))
+    for referee_id, last_activity in [(501, stale), (502, stale), (503, now)]:
+        saxu8.execute("INSERT INTO users (id, username, last_activity) VALUES (?, ?, ?)", (referee_id, f"u{referee_id}", last_activity))
+        saxu8.execute("INSERT INTO referrals (referer_id, referee_id) VALUES (500, ?)", (referee_id,))
+    saxu8.invalidate_user()
+    yield sent
+    saxu8.execute("DELETE FROM referrals WHERE referer_id = 500")
+    saxu8.execute("DELETE FROM users WHERE id BETWEEN 500 AND 503")
+    saxu8.invalidate_user()
+
+
+def test_inactive_referrals_are_penalized_once(referrals):
+    reward = saxu8.settings.get('referral_reward')
+    saxu8.check_inactivity()
+    saxu8.check_inactivity()
+
+    user = saxu8.get_user(500)
+    assert user['balance'] == 5.0 - 2 * reward
+    assert user['referrals_count'] == 1
+    assert referrals == [500, 500]
+    penalized = saxu8.query_all("SELECT referee_id FROM referrals WHERE referer_id = 500 AND penalized_at IS NOT NULL ORDER BY referee_id")
+    assert [row[0] for row in penalized] == [501, 502]
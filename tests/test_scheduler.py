@@ -0,0 +1,68 @@
+import threading
+import time
+
+import saxu8
+
+
+def collect():
+    fired, done = [], threading.Event()
+
+    def callback(value):
+        fired.append(value)
+        done.set()
+    return fired, done, callback
+
+
+def test_callbacks_fire_in_deadline_order():
+    scheduler = saxu8.Scheduler()
+    fired, done = [], threading.Event()
+    now = time.time()
+    scheduler.at(now + 0.06, lambda: (fired.append('late'), done.set()))
+    scheduler.at(now + 0.02, fired.append, 'early')
+    assert done.wait(2)
+    assert fired == ['early', 'late']
+
+
+def test_cancel_skips_callback():
+    scheduler = saxu8.Scheduler()
+    fired, done, callback = collect()
+    scheduler.after(0.02, callback, 'cancelled', key='job')
+    assert scheduler.cancel('job')
+    assert not scheduler.cancel('job')
+    scheduler.after(0.04, callback, 'kept')
+    assert done.wait(2)
+    time.sleep(0.02)
+    assert fired == ['kept']
+
+
+def test_same_key_replaces_entry():
+    scheduler = saxu8.Scheduler()
+    fired, done, callback = collect()
+    scheduler.after(0.02, callback, 'first', key='job')
+    scheduler.after(0.04, callback, 'second', key='job')
+    assert done.wait(2)
+    time.sleep(0.04)
+    assert fired == ['second']
+
+
+def test_every_repeats_until_cancelled():
+    scheduler = saxu8.Scheduler()
+    ticks = threading.Semaphore(0)
+    scheduler.every(0.01, ticks.release, key='tick')
+    for _ in range(3):
+        assert ticks.acquire(timeout=2)
+    scheduler.cancel('tick')
+    time.sleep(0.03)
+    while ticks.acquire(blocking=False):
+        pass
+    time.sleep(0.05)
+    assert not ticks.acquire(blocking=False)
+
+
+def test_failing_callback_does_not_stop_scheduler():
+    scheduler = saxu8.Scheduler()
+    fired, done, callback = collect()
+    scheduler.after(0.01, lambda: 1 / 0)
+    scheduler.after(0.03, callback, 'after error')
+    assert done.wait(2)
+    assert fired == ['after error']
@@ -0,0 +1,35 @@
+import threading
+
+import saxu8
+
+
+def test_concurrent_admin_changes_are_not_lost():
+    start = threading.Barrier(8)
+
+    def add(user_id):
+        start.wait()
+        saxu8.settings.add_admin(user_id)
+
+    threads = [threading.Thread(target=add, args=(1000 + i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        stored = saxu8.json.loads(saxu8.query_one("SELECT value FROM settings WHERE key = 'admins'")[0])
+        assert {1000 + i for i in range(8)} <= set(stored)
+        assert all(saxu8.settings.is_admin(1000 + i) for i in range(8))
+    finally:
+        for i in range(8):
+            saxu8.settings.remove_admin(1000 + i)
+
+
+def test_write_publishes_new_snapshot():
+    version, snapshot = saxu8.settings.version, saxu8.settings.snapshot
+    saxu8.settings.set('min_hold_minutes', 42)
+    try:
+        assert saxu8.settings.get('min_hold_minutes') == 42
+        assert saxu8.settings.version == version + 1
+        assert snapshot.values['min_hold_minutes'] == saxu8.MIN_HOLD_MINUTES
+    finally:
+        saxu8.settings.set('min_hold_minutes', saxu8.MIN_HOLD_MINUTES)
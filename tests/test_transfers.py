@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+import saxu8
+
+SENDER, RECIPIENT = 700, 701
+
+
+@pytest.fixture(autouse=True)
+def cards():
+    for user_id, balance in [(SENDER, 10.0), (RECIPIENT, 0.0)]:
+        saxu8.execute("INSERT INTO users (id, username, card_balance, card_status) VALUES (?, ?, ?, 'active')",
+                      (user_id, f"u{user_id}", balance))
+    saxu8.invalidate_user()
+    yield
+    saxu8.conversations.clear(SENDER)
+    for table, column in [('transfers', 'from_user_id'), ('card_history', 'user_id'), ('users', 'id')]:
+        saxu8.execute(f"DELETE FROM {table} WHERE {column} IN (?, ?)", (SENDER, RECIPIENT))
+    saxu8.invalidate_user()
+
+
+def balance(user_id):
+    return saxu8.query_one("SELECT card_balance FROM users WHERE id = ?", (user_id,))[0]
+
+
+def history_count():
+    return saxu8.query_one("SELECT COUNT(*) FROM card_history WHERE user_id IN (?, ?)", (SENDER, RECIPIENT))[0]
+
+
+def test_transfer_moves_balance_and_links_history():
+    transfer_id = saxu8.transfer_card_balance(SENDER, RECIPIENT, 4.0)
+    assert (balance(SENDER), balance(RECIPIENT)) == (6.0, 4.0)
+    rows = saxu8.query_all("SELECT user_id, amount FROM card_history WHERE transfer_id = ? ORDER BY id", (transfer_id,))
+    assert [tuple(row) for row in rows] == [(SENDER, -4.0), (RECIPIENT, 4.0)]
+
+
+def test_insufficient_balance_changes_nothing():
+    assert saxu8.transfer_card_balance(SENDER, RECIPIENT, 10.5) is None
+    assert (balance(SENDER), balance(RECIPIENT)) == (10.0, 0.0)
+    assert history_count() == 0
+
+
+def test_unknown_recipient_rolls_back_debit():
+    with pytest.raises(ValueError):
+        saxu8.transfer_card_balance(SENDER, 799, 1.0)
+    assert balance(SENDER) == 10.0
+    assert history_count() == 0
+
+
+def test_self_transfer_is_rejected():
+    with pytest.raises(ValueError):
+        saxu8.transfer_card_balance(SENDER, SENDER, 1.0)
+
+
+def test_concurrent_debits_cannot_overdraw():
+    start = threading.Barrier(8)
+    results = []
+
+    def transfer():
+        start.wait()
+        results.append(saxu8.transfer_card_balance(SENDER, RECIPIENT, 3.0))
+
+    threads = [threading.Thread(target=transfer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(result is not None for result in results) == 3
+    assert (balance(SENDER), balance(RECIPIENT)) == (1.0, 9.0)
+    assert saxu8.query_one("SELECT COUNT(*) FROM transfers WHERE from_user_id = ?", (SENDER,))[0] == 3
+
+
+def test_confirmation_token_is_single_use():
+    token = saxu8.offer_transfer(SENDER, RECIPIENT, 2.0)
+    assert saxu8.take_transfer(SENDER, token) == (RECIPIENT, 2.0)
+    assert saxu8.take_transfer(SENDER, token) is None
+
+
+def test_new_offer_replaces_previous_token():
+    stale = saxu8.offer_transfer(SENDER, RECIPIENT, 2.0)
+    fresh = saxu8.offer_transfer(SENDER, RECIPIENT, 3.0)
+    assert saxu8.take_transfer(SENDER, fresh) == (RECIPIENT, 3.0)
+    saxu8.offer_transfer(SENDER, RECIPIENT, 4.0)
+    assert saxu8.take_transfer(SENDER, stale) is None